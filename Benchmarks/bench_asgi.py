@@ -0,0 +1,67 @@
+import asyncio
+import json
+import os
+import time
+from unittest import mock
+from asgiref.sync import async_to_sync
+from channels.testing import HttpCommunicator
+from django.test import TransactionTestCase, Client
+from Benchmarks.utils import save_report
+from TestUtils.token import TestMockToken
+from Users.auth import AuthRequester
+from Users.models import Profile
+from UsersService.routing import application
+
+
+class AsgiConcurrencyBenchmark(TransactionTestCase):
+    """
+    Сколько запросов, ждущих auth-сервис, обслуживает один воркер: синхронный (WSGI, по одному запросу за раз)
+    против ASGI (все запросы в полете на одном event loop'е)
+    Задержка auth-сервиса имитируется через BENCH_SERVICE_LATENCY_MS
+    """
+    databases = '__all__'
+    REQUESTS = int(os.getenv('BENCH_ASGI_REQUESTS', 100))
+    SERVICE_LATENCY = float(os.getenv('BENCH_SERVICE_LATENCY_MS', 50)) / 1000
+
+    def setUp(self):
+        self.token = TestMockToken()
+        Profile.objects.bulk_create([Profile(user_id=x) for x in range(1, self.REQUESTS + 1)])
+        self.body = json.dumps({'pin_sprite': 3}).encode()
+
+    def _slow_user_info(self, requester, token):
+        time.sleep(self.SERVICE_LATENCY)
+        return None, {'id': 0, 'is_superuser': True}
+
+    def _run_sync(self):
+        client = Client()
+        for user_id in range(1, self.REQUESTS + 1):
+            response = client.patch(f'/api/profiles/{user_id}/', self.body, content_type='application/json',
+                                    HTTP_AUTHORIZATION=self.token.token)
+            self.assertEqual(response.status_code, 202)
+
+    async def _run_asgi(self):
+        headers = [(b'authorization', self.token.token.encode()), (b'content-type', b'application/json'),
+                   (b'content-length', str(len(self.body)).encode()), (b'host', b'testserver')]
+        communicators = [HttpCommunicator(application, 'PATCH', f'/api/profiles/{user_id}/', body=self.body,
+                                          headers=headers) for user_id in range(1, self.REQUESTS + 1)]
+        responses = await asyncio.gather(*[x.get_response(timeout=60) for x in communicators])
+        self.assertTrue(all(x['status'] == 202 for x in responses))
+
+    def _measure(self, func):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        return {
+            'requests': self.REQUESTS,
+            'seconds': elapsed,
+            'throughput_rps': self.REQUESTS / elapsed,
+        }
+
+    def testConcurrency(self):
+        with mock.patch.object(AuthRequester, 'get_user_info', autospec=True, side_effect=self._slow_user_info):
+            results = {
+                'sync (wsgi worker)': self._measure(self._run_sync),
+                'asgi (one event loop)': self._measure(async_to_sync(self._run_asgi)),
+            }
+        meta = {'service_latency_ms': self.SERVICE_LATENCY * 1000}
+        save_report('asgi_concurrency', results, meta)
@@ -0,0 +1,99 @@
+import os
+from itertools import count
+from unittest import mock
+from Benchmarks.utils import BenchmarkTestCase
+from Users.auth import AuthRequester
+from Users.models import Profile
+
+
+class EndpointsBenchmark(BenchmarkTestCase):
+    """
+    Прогон всех урлов из Users/urls.py на засеянной базе (SQLite и мок-реквестеры)
+    Размер базы задается BENCH_PROFILES (от 1k до 1M), по каждому урлу считаются пропускная способность,
+    p50/p95/p99 и число запросов в базу на запрос
+        BENCH_PROFILES=100000 python manage.py test Benchmarks.bench_endpoints --pattern="bench_*.py"
+    """
+    PROFILES = int(os.getenv('BENCH_PROFILES', 1000))
+    SEED_CHUNK_SIZE = 5000
+    BATCH_SIZE = 50
+    NEW_USER_CASES = ('POST profiles/', 'POST profiles/register/')
+
+    @classmethod
+    def setUpTestData(cls):
+        # id проставляем сами: bulk_create на SQLite не возвращает первичные ключи
+        for start in range(1, cls.PROFILES + 1, cls.SEED_CHUNK_SIZE):
+            end = min(start + cls.SEED_CHUNK_SIZE, cls.PROFILES + 1)
+            profiles = Profile.objects.bulk_create([
+                Profile(id=x, user_id=x, rating=(x * 7919) % 5000, money=10 ** 9, pic_id=x if x % 2 else None)
+                for x in range(start, end)
+            ])
+            Profile.create_default_ownership(profiles)
+
+    def setUp(self):
+        super().setUp()
+        self.path = self.url_prefix + 'profiles/'
+        self.token.set_role(self.token.ROLES.SUPERUSER)
+        # Новые user_id и id пинов/ачивок для пишущих запросов, чтобы они не упирались в уникальность
+        self.new_ids = count(self.PROFILES + 1)
+        self.owned_ids = count(1000)
+
+    def _user_id(self, i):
+        """
+        Псевдослучайный существующий юзер (чтобы не читать одну и ту же горячую строку)
+        """
+        return (i * 7919) % self.PROFILES + 1
+
+    def _new_auth_user(self, requester, token):
+        return None, {'id': next(self.new_ids), 'username': 'bench', 'is_superuser': False}
+
+    def _cases(self):
+        return {
+            'GET profiles/': lambda i: self.get_response_and_check_status(
+                self.path, data={'limit': 100, 'offset': self._user_id(i) % max(self.PROFILES - 100, 1)}),
+            'GET profiles/ [cursor]': lambda i: self.get_response_and_check_status(
+                self.path, data={'pagination': 'cursor', 'limit': 100}),
+            'POST profiles/': lambda i: self.post_response_and_check_status(self.path, data={}),
+            'POST profiles/register/': lambda i: self.post_response_and_check_status(
+                self.path + 'register/', data={'username': f'bench{i}', 'password': '123456'}),
+            'GET profiles/leaderboard/': lambda i: self.get_response_and_check_status(
+                self.path + 'leaderboard/', data={'limit': 100}),
+            'GET profiles/batch/': lambda i: self.get_response_and_check_status(
+                self.path + 'batch/',
+                data={'user_ids': ','.join(str(self._user_id(i + x)) for x in range(self.BATCH_SIZE))}),
+            'POST profiles/batch/': lambda i: self.post_response_and_check_status(
+                self.path + 'batch/', data={'user_ids': [self._user_id(i + x) for x in range(self.BATCH_SIZE)]},
+                expected_status_code=200),
+            'POST profiles/update_rating/': lambda i: self.post_response_and_check_status(
+                self.path + 'update_rating/',
+                data={'updates': [{'user_id': self._user_id(i + x), 'd_rating': 1}
+                                  for x in range(self.BATCH_SIZE)]},
+                expected_status_code=202),
+            'GET profiles/<id>/': lambda i: self.get_response_and_check_status(
+                f'{self.path}{self._user_id(i)}/'),
+            'PATCH profiles/<id>/': lambda i: self.patch_response_and_check_status(
+                f'{self.path}{self._user_id(i)}/', data={'pin_sprite': i % 10}, expected_status_code=202),
+            'POST profiles/<id>/add_achievement/': lambda i: self.post_response_and_check_status(
+                f'{self.path}{self._user_id(i)}/add_achievement/', data={'achievement_id': next(self.owned_ids)}),
+            'POST profiles/<id>/buy_pin/': lambda i: self.post_response_and_check_status(
+                f'{self.path}{self._user_id(i)}/buy_pin/', data={'pin_id': next(self.owned_ids), 'price': 1}),
+            'PATCH profiles/<id>/update_rating/': lambda i: self.patch_response_and_check_status(
+                f'{self.path}{self._user_id(i)}/update_rating/', data={'d_rating': 1}, expected_status_code=202),
+            'GET profiles/<id>/rank/': lambda i: self.get_response_and_check_status(
+                f'{self.path}{self._user_id(i)}/rank/'),
+            # Удаляем с конца, чтобы не задеть профили, которые читают остальные кейсы (они уже прогнаны)
+            'DELETE profiles/<id>/': lambda i: self.delete_response_and_check_status(
+                f'{self.path}{self.PROFILES - i - self.WARMUP}/', expected_status_code=204),
+        }
+
+    def testEndpoints(self):
+        cases = self._cases()
+        results = {}
+        # Регистрация и создание профиля берут user_id из auth, поэтому для них он каждый раз новый
+        with mock.patch.object(AuthRequester, 'get_user_info', autospec=True, side_effect=self._new_auth_user):
+            for case in self.NEW_USER_CASES:
+                results[case] = self.measure(cases[case])
+        for case, func in cases.items():
+            if case not in results:
+                results[case] = self.measure(func)
+        results = {case: results[case] for case in cases}
+        self.report(f'endpoints_{self.PROFILES}', results, meta={'profiles': self.PROFILES})
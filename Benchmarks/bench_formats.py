@@ -0,0 +1,49 @@
+import os
+from rest_framework.renderers import JSONRenderer
+from Benchmarks.utils import BenchmarkTestCase
+from Users.models import Profile, UnlockedPin, ProfileAchievement
+from Users.fast_serializers import profile_reader, get_owned_ids
+from Users.renderers import FastJSONRenderer, MessagePackRenderer
+from Users.compression import compress, brotli
+
+
+class ResponseFormatsBenchmark(BenchmarkTestCase):
+    """
+    Размер и время кодирования списка профилей: JSONRenderer, FastJSONRenderer и MessagePack, каждый без сжатия,
+    с gzip и с brotli (если он установлен)
+    """
+    PROFILES = int(os.getenv('BENCH_FORMATS_PROFILES', 10000))
+    ITERATIONS = int(os.getenv('BENCH_FORMATS_ITERATIONS', 20))
+    WARMUP = 2
+
+    def setUp(self):
+        super().setUp()
+        Profile.objects.bulk_create([Profile(user_id=x, rating=x % 1000, money=x % 500, pic_id=x if x % 2 else None)
+                                     for x in range(1, self.PROFILES + 1)])
+        profiles = list(Profile.objects.only('id'))
+        UnlockedPin.objects.bulk_create([UnlockedPin(profile=x, pin_id=i) for x in profiles for i in (1, 2)])
+        ProfileAchievement.objects.bulk_create([ProfileAchievement(profile=x, achievement_id=1) for x in profiles])
+        rows = list(Profile.objects.values(*profile_reader.columns))
+        owned = get_owned_ids(x['id'] for x in rows)
+        self.data = [profile_reader.to_representation(x, owned[x['id']]) for x in rows]
+
+    def _case(self, renderer, encoding=None):
+        def encode(i):
+            content = renderer.render(self.data)
+            return compress(content, encoding) if encoding else content
+        ret = self.measure(encode, count_queries=False)
+        ret['bytes'] = len(encode(0))
+        return ret
+
+    def testFormats(self):
+        renderers = {
+            'json [drf]': JSONRenderer(),
+            'json [fast]': FastJSONRenderer(),
+            'msgpack': MessagePackRenderer(),
+        }
+        encodings = [None, 'gzip'] + (['br'] if brotli is not None else [])
+        results = {}
+        for name, renderer in renderers.items():
+            for encoding in encodings:
+                results[f'{name} + {encoding}' if encoding else name] = self._case(renderer, encoding)
+        self.report('response_formats', results, meta={'profiles': self.PROFILES})
@@ -0,0 +1,49 @@
+from rest_framework.renderers import JSONRenderer
+from Benchmarks.utils import BenchmarkTestCase
+from Users.models import Profile, UnlockedPin, ProfileAchievement
+from Users.serializers import ProfilesListSerializer, ProfileSerializer
+from Users.fast_serializers import profiles_list_reader, profile_reader, get_owned_ids
+from Users.renderers import FastJSONRenderer
+
+
+class SerializationBenchmark(BenchmarkTestCase):
+    """
+    Сериализация страницы профилей: ModelSerializer + JSONRenderer против .values() + FastJSONRenderer
+    """
+    PAGE_SIZE = 1000
+    ITERATIONS = 50
+
+    def setUp(self):
+        super().setUp()
+        Profile.objects.bulk_create([Profile(user_id=x, pic_id=x if x % 2 else None)
+                                     for x in range(1, self.PAGE_SIZE + 1)])
+        profiles = list(Profile.objects.all())
+        UnlockedPin.objects.bulk_create([UnlockedPin(profile=x, pin_id=1) for x in profiles])
+        ProfileAchievement.objects.bulk_create([ProfileAchievement(profile=x, achievement_id=1) for x in profiles])
+
+    def _list_drf(self, i):
+        return JSONRenderer().render(ProfilesListSerializer(instance=Profile.objects.all(), many=True).data)
+
+    def _list_fast(self, i):
+        return FastJSONRenderer().render(
+            profiles_list_reader.many(Profile.objects.values(*profiles_list_reader.columns)))
+
+    def _detail_drf(self, i):
+        profiles = Profile.objects.prefetch_related('pins', 'achievements')
+        return JSONRenderer().render(ProfileSerializer(instance=profiles, many=True).data)
+
+    def _detail_fast(self, i):
+        rows = list(Profile.objects.values(*profile_reader.columns))
+        owned = get_owned_ids(x['id'] for x in rows)
+        return FastJSONRenderer().render([profile_reader.to_representation(x, owned[x['id']]) for x in rows])
+
+    def testSerialization(self):
+        self.assertEqual(self._list_fast(0), self._list_drf(0))
+        self.assertEqual(self._detail_fast(0), self._detail_drf(0))
+        results = {
+            f'list x{self.PAGE_SIZE} [drf]': self.measure(self._list_drf),
+            f'list x{self.PAGE_SIZE} [fast]': self.measure(self._list_fast),
+            f'detail x{self.PAGE_SIZE} [drf]': self.measure(self._detail_drf),
+            f'detail x{self.PAGE_SIZE} [fast]': self.measure(self._detail_fast),
+        }
+        self.report('serialization', results, meta={'page_size': self.PAGE_SIZE})
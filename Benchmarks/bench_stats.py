@@ -0,0 +1,34 @@
+from django.test import override_settings
+from Benchmarks.utils import BenchmarkTestCase
+from Users.models import Profile
+from Users.stats import stats_queue
+
+
+class StatsLatencyBenchmark(BenchmarkTestCase):
+    """
+    Задержка запросов без статистики, с синхронной статистикой и с отправкой через фоновую очередь
+    """
+    MODES = ('off', 'sync', 'queue')
+
+    def setUp(self):
+        super().setUp()
+        self.profile = Profile.objects.create(user_id=1, money=10 ** 9)
+        self.path = f'{self.url_prefix}profiles/{self.profile.user_id}/'
+        self.pin_counter = 100
+
+    def _buy_pin(self, i):
+        self.pin_counter += 1
+        _ = self.post_response_and_check_status(url=self.path + 'buy_pin/',
+                                                data={'pin_id': self.pin_counter, 'price': 1})
+
+    def _get_profile(self, i):
+        _ = self.get_response_and_check_status(url=self.path)
+
+    def testStatsLatency(self):
+        results = {}
+        for mode in self.MODES:
+            with override_settings(STATS_MODE=mode):
+                results[f'GET profile [{mode}]'] = self.measure(self._get_profile)
+                results[f'POST buy_pin [{mode}]'] = self.measure(self._buy_pin)
+                stats_queue.flush()
+        self.report('stats_latency', results, meta={'queue': stats_queue.metrics()})
@@ -0,0 +1,153 @@
+import json
+import math
+import os
+import time
+from datetime import datetime
+from typing import Callable, List, Dict, Optional
+from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from TestUtils.models import BaseTestCase
+
+
+def percentile(sorted_samples: List[float], p: float) -> float:
+    """
+    Перцентиль по уже отсортированной выборке (ближайший ранг)
+    """
+    if not sorted_samples:
+        return 0.0
+    k = max(math.ceil(p / 100 * len(sorted_samples)) - 1, 0)
+    return sorted_samples[min(k, len(sorted_samples) - 1)]
+
+
+def summarize(samples: List[float], queries: List[int] = None) -> Dict[str, float]:
+    """
+    Сводка по замерам (время в миллисекундах)
+    """
+    samples = sorted(samples)
+    total = sum(samples)
+    ret = {
+        'count': len(samples),
+        'throughput_rps': len(samples) / total if total else 0.0,
+        'mean_ms': total / len(samples) * 1000 if samples else 0.0,
+        'p50_ms': percentile(samples, 50) * 1000,
+        'p95_ms': percentile(samples, 95) * 1000,
+        'p99_ms': percentile(samples, 99) * 1000,
+    }
+    if queries is not None:
+        ret['queries_per_request'] = sum(queries) / len(queries) if queries else 0.0
+    return ret
+
+
+def load_report(name: str, output_dir: str) -> Optional[dict]:
+    """
+    Чтение ранее сохраненного <output_dir>/<name>.json (None, если его нет)
+    """
+    path = os.path.join(output_dir, f'{name}.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_reports(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float) -> List[str]:
+    """
+    Поиск регрессий относительно прошлого прогона
+    Регрессия -- p95 выросла или пропускная способность упала больше, чем на threshold (доля), либо запросов в базу
+    на один запрос стало больше
+    """
+    regressions = []
+    for case, values in results.items():
+        old = baseline.get(case)
+        if not old:
+            continue
+        if old.get('p95_ms') and values.get('p95_ms', 0) > old['p95_ms'] * (1 + threshold):
+            regressions.append(f'{case}: p95 {old["p95_ms"]:.3f}ms -> {values["p95_ms"]:.3f}ms')
+        if old.get('throughput_rps') and values.get('throughput_rps', 0) < old['throughput_rps'] * (1 - threshold):
+            regressions.append(f'{case}: throughput {old["throughput_rps"]:.1f} -> {values["throughput_rps"]:.1f} rps')
+        if 'queries_per_request' in old and values.get('queries_per_request', 0) > old['queries_per_request']:
+            regressions.append(f'{case}: queries per request '
+                               f'{old["queries_per_request"]:.2f} -> {values["queries_per_request"]:.2f}')
+    return regressions
+
+
+def save_report(name: str, results: Dict[str, dict], meta: dict = None, output_dir: str = None,
+                regressions: List[str] = None):
+    """
+    Печать результатов таблицей и сохранение в <output_dir>/<name>.json
+    """
+    output_dir = output_dir or BenchmarkTestCase.OUTPUT_DIR
+    columns = sorted({k for x in results.values() for k in x.keys()})
+    print(f'\n{name}')
+    print(' | '.join(['case'.ljust(36)] + [x.rjust(20) for x in columns]))
+    for case, values in results.items():
+        cells = [f'{values[x]:.3f}' if isinstance(values.get(x), float) else str(values.get(x, ''))
+                 for x in columns]
+        print(' | '.join([case.ljust(36)] + [x.rjust(20) for x in cells]))
+    for regression in regressions or []:
+        print(f'REGRESSION {regression}')
+
+    os.makedirs(output_dir, exist_ok=True)
+    data = {
+        'name': name,
+        'created_dt': datetime.utcnow().isoformat(),
+        'database': connection.vendor,
+        'meta': meta or {},
+        'results': results,
+    }
+    if regressions is not None:
+        data['regressions'] = regressions
+    with open(os.path.join(output_dir, f'{name}.json'), 'w') as f:
+        json.dump(data, f, indent=2)
+    return data
+
+
+class BenchmarkTestCase(BaseTestCase):
+    """
+    База для бенчмарков
+    Гоняются тем же раннером, что и тесты (тестовая база и мок-реквестеры), но в обычный прогон не попадают:
+        python manage.py test Benchmarks --pattern="bench_*.py"
+    Результаты пишутся в JSON в BENCH_OUTPUT_DIR, чтобы прогоны можно было сравнивать
+    Если задан BENCH_BASELINE_DIR, результаты сравниваются с лежащим там прошлым прогоном, а при
+    BENCH_FAIL_ON_REGRESSION=1 найденные регрессии валят бенчмарк
+    """
+    ITERATIONS = int(os.getenv('BENCH_ITERATIONS', 200))
+    WARMUP = int(os.getenv('BENCH_WARMUP', 20))
+    OUTPUT_DIR = os.getenv('BENCH_OUTPUT_DIR', os.path.join(settings.BASE_DIR, 'bench_results'))
+    BASELINE_DIR = os.getenv('BENCH_BASELINE_DIR', None)
+    REGRESSION_THRESHOLD = float(os.getenv('BENCH_REGRESSION_THRESHOLD', 0.2))
+    FAIL_ON_REGRESSION = os.getenv('BENCH_FAIL_ON_REGRESSION', '0') == '1'
+
+    def measure(self, func: Callable, iterations: int = None, count_queries: bool = True) -> Dict[str, float]:
+        """
+        Замер времени вызова func
+        :param func: Функция без аргументов (получает номер итерации, если принимает его)
+        :param iterations: Сколько раз мерить (по умолчанию BENCH_ITERATIONS)
+        :param count_queries: Считать ли запросы в базу на каждый вызов
+        """
+        iterations = iterations or self.ITERATIONS
+        for i in range(self.WARMUP):
+            func(-i - 1)
+        samples, queries = [], []
+        for i in range(iterations):
+            if count_queries:
+                with CaptureQueriesContext(connection) as captured:
+                    start = time.perf_counter()
+                    func(i)
+                    samples.append(time.perf_counter() - start)
+                queries.append(len(captured))
+            else:
+                start = time.perf_counter()
+                func(i)
+                samples.append(time.perf_counter() - start)
+        return summarize(samples, queries if count_queries else None)
+
+    def report(self, name: str, results: Dict[str, dict], meta: dict = None):
+        regressions = None
+        baseline = load_report(name, self.BASELINE_DIR) if self.BASELINE_DIR else None
+        if baseline is not None:
+            regressions = compare_reports(results, baseline['results'], self.REGRESSION_THRESHOLD)
+        data = save_report(name, results, meta, output_dir=self.OUTPUT_DIR, regressions=regressions)
+        if regressions and self.FAIL_ON_REGRESSION:
+            self.fail('\n'.join(regressions))
+        return data
@@ -1,5 +1,8 @@
 from django.contrib import admin
-from Users.models import Profile
+from Users.models import Profile, UnlockedPin, ProfileAchievement, IdempotencyKey
 
 # Register your models here.
 admin.site.register(Profile)
+admin.site.register(UnlockedPin)
+admin.site.register(ProfileAchievement)
+admin.site.register(IdempotencyKey)
@@ -0,0 +1,26 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from django.conf import settings
+
+
+_service_executor = None
+
+
+def get_service_executor() -> ThreadPoolExecutor:
+    """
+    Отдельный пул для блокирующих запросов в другие сервисы, чтобы они не занимали поток работы с базой
+    """
+    global _service_executor
+    if _service_executor is None:
+        _service_executor = ThreadPoolExecutor(max_workers=settings.ASYNC_SERVICE_CALL_WORKERS,
+                                               thread_name_prefix='service-calls')
+    return _service_executor
+
+
+async def call_service(func, *args, **kwargs):
+    """
+    Вызов реквестера из корутины без блокировки event loop'а
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(get_service_executor(), partial(func, *args, **kwargs))
@@ -1,5 +1,21 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import request_started
+from django.db.backends.signals import connection_created
 
 
 class UsersConfig(AppConfig):
     name = 'Users'
+
+    def ready(self):
+        if settings.PROFILE_UPDATES_ENABLED and not settings.CHANNEL_LAYERS_REDIS_URL:
+            raise ImproperlyConfigured('PROFILE_UPDATES_ENABLED requires CHANNEL_LAYERS_REDIS_URL')
+        if settings.RATING_WRITE_BEHIND and not settings.RATING_JOURNAL_DIR:
+            raise ImproperlyConfigured('RATING_WRITE_BEHIND requires RATING_JOURNAL_DIR')
+        from Users.db import db_health
+        from Users.http_pool import install
+        connection_created.connect(db_health.on_connection_created, dispatch_uid='users_db_connection_created')
+        request_started.connect(db_health.check, dispatch_uid='users_db_health_check')
+        if settings.HTTP_POOL_ENABLED:
+            install()
@@ -0,0 +1,159 @@
+import jwt
+from django.conf import settings
+from rest_framework.exceptions import APIException
+from ApiRequesters.Auth.AuthRequester import AuthRequester
+from ApiRequesters.utils import get_token_from_request
+from ApiRequesters.exceptions import BaseApiRequestError, UnexpectedResponse
+from Users.caches import TTLLRUCache
+from Users.aio import call_service
+from Users.timing import phase
+
+
+_token_info_cache = None
+
+
+def get_token_info_cache() -> TTLLRUCache:
+    """
+    Кэш token -> user info для токенов, которые нельзя проверить локально (пересоздается при смене настроек)
+    """
+    global _token_info_cache
+    params = (settings.AUTH_TOKEN_CACHE_SIZE, settings.AUTH_TOKEN_CACHE_TTL)
+    if _token_info_cache is None or (_token_info_cache.maxsize, _token_info_cache.ttl) != params:
+        _token_info_cache = TTLLRUCache(*params)
+    return _token_info_cache
+
+
+def _is_access_token(claims) -> bool:
+    return isinstance(claims, dict) and \
+        claims.get(settings.AUTH_JWT_TOKEN_TYPE_CLAIM) == settings.AUTH_JWT_ACCESS_TOKEN_TYPE
+
+
+def decode_token_locally(token: str):
+    """
+    Проверка JWT ключом из настроек без похода в auth-сервис: подпись, срок, aud и iss (если заданы) и тип токена
+    :return: {'id': ..., 'is_superuser': ...} или None, если локально проверить токен нельзя
+    """
+    if not settings.AUTH_JWT_VERIFY_KEY or not token:
+        return None
+    try:
+        claims = jwt.decode(token, settings.AUTH_JWT_VERIFY_KEY, algorithms=[settings.AUTH_JWT_ALGORITHM],
+                            audience=settings.AUTH_JWT_AUDIENCE, issuer=settings.AUTH_JWT_ISSUER)
+    except jwt.InvalidTokenError:
+        # Протухший, чужой или не для нас выданный токен -- пусть auth-сервис сам ответит нужной ошибкой
+        return None
+    # Refresh-токен подписан тем же ключом, но доступа не дает
+    if not _is_access_token(claims):
+        return None
+    try:
+        return {
+            'id': claims[settings.AUTH_JWT_USER_ID_CLAIM],
+            'is_superuser': claims[settings.AUTH_JWT_SUPERUSER_CLAIM],
+        }
+    except KeyError:
+        return None
+
+
+def read_issued_token(sign_up_response: dict):
+    """
+    Юзер из access-токена, который auth-сервис только что выдал в ответе на регистрацию
+    Принимает только сам ответ auth-сервиса, а не токены из запросов. Подпись проверяется, если задан
+    AUTH_JWT_VERIFY_KEY, иначе токену верим, потому что получили его напрямую от auth-сервиса
+    :return: {'id': ..., 'is_superuser': ...} или None, если это не access-JWT с нужными полями
+    """
+    token = sign_up_response.get('access') if isinstance(sign_up_response, dict) else None
+    if not token:
+        return None
+    if settings.AUTH_JWT_VERIFY_KEY:
+        return decode_token_locally(token)
+    try:
+        claims = jwt.decode(token, options={'verify_signature': False})
+    except jwt.InvalidTokenError:
+        return None
+    if not _is_access_token(claims) or settings.AUTH_JWT_USER_ID_CLAIM not in claims:
+        return None
+    return {
+        'id': claims[settings.AUTH_JWT_USER_ID_CLAIM],
+        # Только что зарегистрированный юзер суперюзером быть не может
+        'is_superuser': claims.get(settings.AUTH_JWT_SUPERUSER_CLAIM, False),
+    }
+
+
+class AuthServiceError(APIException):
+    """
+    Ошибка auth-сервиса, которую надо отдать клиенту как есть (с кодом auth-сервиса)
+    """
+    def __init__(self, error: BaseApiRequestError):
+        if isinstance(error, UnexpectedResponse):
+            super().__init__(detail=error.body)
+            self.status_code = error.code
+        else:
+            super().__init__(detail=str(error))
+            self.status_code = 500
+
+
+class AuthContext:
+    """
+    Информация о том, кто делает запрос
+    Ходит в auth-сервис лениво и не больше одного раза за запрос, ошибка тоже запоминается
+    Если настроена локальная проверка JWT, то в user_info будут только id и is_superuser
+    """
+    def __init__(self, request):
+        self._request = request
+        self._fetched = False
+        self._user_info = None
+        self._error = None
+
+    @property
+    def token(self):
+        return get_token_from_request(self._request)
+
+    def _fetch(self):
+        self._fetched = True
+        token = self.token
+        self._user_info = decode_token_locally(token)
+        if self._user_info is not None:
+            return
+        use_cache = settings.AUTH_TOKEN_CACHE_TTL > 0 and token
+        if use_cache:
+            self._user_info = get_token_info_cache().get(token)
+            if self._user_info is not None:
+                return
+        try:
+            with phase('requesters'):
+                _, self._user_info = AuthRequester().get_user_info(token)
+        except BaseApiRequestError as e:
+            self._error = e
+            return
+        if use_cache:
+            get_token_info_cache().set(token, self._user_info)
+
+    async def afetch(self):
+        """
+        Асинхронный поход в auth-сервис (для ASGI), дальше user_info отдается из контекста
+        """
+        if not self._fetched:
+            await call_service(self._fetch)
+
+    @property
+    def user_info(self) -> dict:
+        """
+        :return: JSON юзера из auth-сервиса
+        :raises BaseApiRequestError: Если auth-сервис ответил ошибкой
+        """
+        if not self._fetched:
+            self._fetch()
+        if self._error is not None:
+            raise self._error
+        return self._user_info
+
+
+def get_auth_context(request) -> AuthContext:
+    """
+    Контекст из запроса (джанговского или DRF), если мидлварь его не повесила -- создается тут же
+    """
+    http_request = getattr(request, '_request', request)
+    context = getattr(http_request, 'auth_context', None)
+    if context is None:
+        context = AuthContext(http_request)
+        http_request.auth_context = context
+    return context
@@ -0,0 +1,70 @@
+import gzip
+from typing import Dict, Optional
+import brotli
+from django.conf import settings
+from django.utils.cache import patch_vary_headers
+from Users.timing import phase
+
+
+def _parse_accept_encoding(header: str) -> Dict[str, float]:
+    """
+    :return: Словарь кодировка -> q из заголовка Accept-Encoding
+    """
+    ret = {}
+    for item in header.split(','):
+        name, *params = [x.strip() for x in item.split(';')]
+        if not name:
+            continue
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        ret[name.lower()] = q
+    return ret
+
+
+def choose_encoding(accept_encoding: str) -> Optional[str]:
+    """
+    Кодировка для ответа: brotli, если клиент его принимает, иначе gzip (None -- без сжатия)
+    """
+    accepted = _parse_accept_encoding(accept_encoding)
+    for name in ('br', 'gzip'):
+        if accepted.get(name, accepted.get('*', 0.0)) > 0:
+            return name
+    return None
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == 'br':
+        return brotli.compress(data, quality=settings.RESPONSE_COMPRESSION_BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=settings.RESPONSE_COMPRESSION_GZIP_LEVEL, mtime=0)
+
+
+def compress_response(request, response):
+    """
+    Сжатие ответа больше RESPONSE_COMPRESSION_MIN_SIZE (если клиент умеет и сжатие действительно помогает)
+    """
+    if response.streaming or response.has_header('Content-Encoding'):
+        return response
+    if len(response.content) < settings.RESPONSE_COMPRESSION_MIN_SIZE:
+        return response
+    patch_vary_headers(response, ('Accept-Encoding', ))
+    encoding = choose_encoding(request.META.get('HTTP_ACCEPT_ENCODING', ''))
+    if encoding is None:
+        return response
+    with phase('serialization'):
+        content = compress(response.content, encoding)
+    if len(content) >= len(response.content):
+        return response
+    response.content = content
+    response['Content-Length'] = str(len(content))
+    response['Content-Encoding'] = encoding
+    # Сжатый ответ уже не тот же байт в байт, поэтому ETag становится слабым
+    etag = response.get('ETag')
+    if etag and etag.startswith('"'):
+        response['ETag'] = f'W/{etag}'
+    return response
@@ -0,0 +1,209 @@
+import json
+from io import BytesIO
+from channels.db import database_sync_to_async
+from channels.generic.http import AsyncHttpConsumer
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from channels.http import AsgiRequest
+from django.conf import settings
+from django.core import signals
+from django.core.handlers.base import BaseHandler
+from django.http import Http404
+from ApiRequesters.utils import get_token_from_request
+from Users.aio import call_service
+from Users.auth import get_auth_context
+from Users.media import image_validator
+from Users.middleware import get_view_label
+from Users.serializers import SignUpSerializer
+from Users.timing import start_request, end_request, finish_request, phase
+from Users.updates import profile_updates
+from Users.views import SignUpView, ProfileDetailView
+
+
+class _MiddlewareHandler(BaseHandler):
+    """
+    Обработчик Django без WSGI/ASGI-обвязки: урл, все мидлвари из MIDDLEWARE и вьюха
+    """
+    def __init__(self):
+        super().__init__()
+        self.load_middleware()
+
+
+_handler = None
+
+
+def get_handler() -> _MiddlewareHandler:
+    global _handler
+    if _handler is None:
+        _handler = _MiddlewareHandler()
+    return _handler
+
+
+class ViewConsumer(AsyncHttpConsumer):
+    """
+    Асинхронная обертка над DRF-вьюхой для ASGI
+    Запросы в auth и media делаются заранее и без блокировки event loop'а (результаты остаются в кэшах запроса),
+    в поток работы с базой уходит обработка запроса Django -- со всеми мидлварями, как у AsgiHandler
+    Вьюха должна быть доступна в urls.py по тому же пути, что и в роутинге
+    """
+    view = None
+    auth_on_get = True
+
+    @classmethod
+    def for_view(cls, view_class, auth_on_get: bool = True):
+        attrs = {
+            'view': staticmethod(view_class.as_view()),
+            'auth_on_get': auth_on_get,
+        }
+        return type(f'{view_class.__name__}Consumer', (cls, ), attrs)
+
+    def build_request(self, body: bytes):
+        return AsgiRequest(self.scope, BytesIO(body))
+
+    async def send_django_response(self, response):
+        headers = [(k.encode('latin1'), v.encode('latin1')) for k, v in response.items()]
+        await self.send_response(response.status_code, response.content, headers=headers)
+
+    async def prefetch(self, request, body: bytes):
+        if request.method != 'GET' or self.auth_on_get:
+            await get_auth_context(request).afetch()
+        try:
+            pic_id = json.loads(body).get('pic_id') if body else None
+        except (ValueError, AttributeError):
+            pic_id = None
+        if isinstance(pic_id, int):
+            await call_service(image_validator.is_valid, pic_id, get_token_from_request(request))
+
+    def run_view(self, request):
+        signals.request_started.send(sender=self.__class__, scope=self.scope)
+        try:
+            return get_handler().get_response(request)
+        finally:
+            signals.request_finished.send(sender=self.__class__)
+
+    async def handle(self, body):
+        # Замер начинается до мидлварей, чтобы в него попали и запросы в другие сервисы
+        timings = start_request() if settings.REQUEST_TIMING_ENABLED else None
+        try:
+            request = self.build_request(body)
+            with phase('requesters'):
+                await self.prefetch(request, body)
+            response = await database_sync_to_async(self.run_view, thread_sensitive=True)(request)
+        finally:
+            end_request()
+        if timings is not None:
+            finish_request(timings, get_view_label(request), response)
+        await self.send_django_response(response)
+
+
+class SignUpConsumer(ViewConsumer):
+    """
+    Асинхронная регистрация: запрос в auth ждется без блокировки воркера, а профиль создает и ответ собирает
+    сама SignUpView (с ее обработкой ошибок и ключами идемпотентности)
+    """
+    async def prefetch(self, request, body: bytes):
+        if request.META.get('HTTP_IDEMPOTENCY_KEY'):
+            # Повтор с ключом не должен снова идти в auth, так что регистрирует вьюха, уже проверив ключ
+            return
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return
+        if not isinstance(data, dict) or not SignUpSerializer(data=data).is_valid():
+            # Ошибку валидации вернет вьюха
+            return
+        try:
+            request.registration = (await call_service(SignUpView.register_in_auth, data), None)
+        except SignUpView.REGISTRATION_ERRORS as e:
+            request.registration = (None, e)
+
+
+class ProfileUpdatesConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Подписка на изменения профилей по WebSocket вместо опроса GET /profiles/<user_id>/
+    Клиент шлет {"action": "subscribe" | "unsubscribe", "user_id": ...}, в ответ на подписку получает профиль
+    целиком ({"type": "profile", ...}), а дальше -- только изменившиеся поля ({"type": "diff", "changes": {...}})
+    Профиль, как и GET, доступен без авторизации
+    """
+    async def connect(self):
+        # Профили, на группы которых подписан сокет, и последний отправленный клиенту JSON каждого
+        self.subscribed = set()
+        self.profiles = {}
+        profile_updates.connections += 1
+        await self.accept()
+
+    async def disconnect(self, code):
+        for user_id in list(self.subscribed):
+            await self.unsubscribe(user_id)
+        profile_updates.connections -= 1
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        try:
+            content = await self.decode_json(text_data or '')
+        except ValueError:
+            return await self.send_json({'type': 'error', 'error': 'Invalid JSON'})
+        await self.receive_json(content)
+
+    async def receive_json(self, content, **kwargs):
+        try:
+            action, user_id = content['action'], int(content['user_id'])
+        except (KeyError, TypeError, ValueError):
+            return await self.send_json({'type': 'error', 'error': 'Необходимо указать action и user_id'})
+        if action == 'subscribe':
+            await self.subscribe(user_id)
+        elif action == 'unsubscribe':
+            await self.unsubscribe(user_id)
+            await self.send_json({'type': 'unsubscribed', 'user_id': user_id})
+        else:
+            await self.send_json({'type': 'error', 'user_id': user_id, 'error': 'action -- subscribe или unsubscribe'})
+
+    async def read_profile(self, user_id: int):
+        """
+        :return: JSON профиля (тот же, что отдает GET) или None, если профиля нет
+        Оповещение приходит сразу после коммита, так что читаем из мастера: с отстающей реплики разница вышла бы
+        пустой или старой
+        """
+        get_entry = database_sync_to_async(ProfileDetailView.get_entry, thread_sensitive=True)
+        try:
+            entry = await get_entry(user_id, fresh=True)
+        except Http404:
+            return None
+        return entry.data
+
+    async def subscribe(self, user_id: int):
+        if user_id not in self.subscribed:
+            if len(self.subscribed) >= settings.PROFILE_UPDATES_MAX_SUBSCRIPTIONS:
+                return await self.send_json({'type': 'error', 'user_id': user_id,
+                                             'error': f'Нельзя подписаться больше чем на '
+                                                      f'{settings.PROFILE_UPDATES_MAX_SUBSCRIPTIONS} профилей'})
+            # В группу встаем до чтения, чтобы не пропустить изменение между чтением и подпиской
+            await self.channel_layer.group_add(profile_updates.group_name(user_id), self.channel_name)
+            self.subscribed.add(user_id)
+            profile_updates.subscriptions += 1
+        data = await self.read_profile(user_id)
+        if data is None:
+            await self.unsubscribe(user_id)
+            return await self.send_json({'type': 'error', 'user_id': user_id,
+                                         'error': 'Такого пользователя не существует'})
+        self.profiles[user_id] = data
+        await self.send_json({'type': 'profile', 'user_id': user_id, 'data': data})
+
+    async def unsubscribe(self, user_id: int):
+        self.profiles.pop(user_id, None)
+        if user_id in self.subscribed:
+            self.subscribed.discard(user_id)
+            profile_updates.subscriptions -= 1
+            await self.channel_layer.group_discard(profile_updates.group_name(user_id), self.channel_name)
+
+    async def profile_changed(self, event):
+        user_id = event['user_id']
+        old = self.profiles.get(user_id)
+        if old is None:
+            return
+        data = await self.read_profile(user_id)
+        if data is None:
+            await self.unsubscribe(user_id)
+            return await self.send_json({'type': 'deleted', 'user_id': user_id})
+        changes = {k: v for k, v in data.items() if old.get(k) != v}
+        if changes:
+            self.profiles[user_id] = data
+            await self.send_json({'type': 'diff', 'user_id': user_id, 'changes': changes})
@@ -0,0 +1,42 @@
+import time
+from django.conf import settings
+from django.db import connections
+
+
+class ConnectionHealthChecker:
+    """
+    Проверка постоянных соединений с базой (CONN_MAX_AGE) в начале запроса
+    Не чаще раза в DB_HEALTH_CHECK_INTERVAL секунд на соединение, мертвое соединение закрывается,
+    и джанга откроет новое при первом запросе в базу
+    """
+    def __init__(self):
+        self.opened = 0
+        self.health_checks = 0
+        self.health_check_failures = 0
+
+    def on_connection_created(self, sender, connection, **kwargs):
+        self.opened += 1
+        connection.health_checked_at = time.monotonic()
+
+    def check(self, **kwargs):
+        now = time.monotonic()
+        for connection in connections.all():
+            if connection.connection is None or connection.in_atomic_block:
+                continue
+            if now - getattr(connection, 'health_checked_at', 0) < settings.DB_HEALTH_CHECK_INTERVAL:
+                continue
+            connection.health_checked_at = now
+            self.health_checks += 1
+            if not connection.is_usable():
+                self.health_check_failures += 1
+                connection.close()
+
+    def metrics(self):
+        return {
+            'opened': self.opened,
+            'health_checks': self.health_checks,
+            'health_check_failures': self.health_check_failures,
+        }
+
+
+db_health = ConnectionHealthChecker()
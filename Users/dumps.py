@@ -0,0 +1,124 @@
+import csv
+import json
+from typing import Iterable, Iterator, Tuple
+from django.utils.dateparse import parse_datetime
+from Users.fast_serializers import profile_reader, OWNED_FIELDS
+
+# Что попадает в дамп: JSON профиля без id (у каждой базы и шарда он свой)
+DUMP_FIELDS = tuple(x for x in profile_reader.field_names if x != 'id')
+INT_FIELDS = ('user_id', 'rating', 'money', 'pin_sprite', 'geopin_sprite', 'pic_id')
+NULLABLE_FIELDS = ('pic_id', )
+FORMATS = ('jsonl', 'csv')
+
+
+class DumpFormatError(ValueError):
+    """
+    Битая строка дампа
+    """
+    pass
+
+
+def detect_format(path: str, fmt: str = None) -> str:
+    """
+    Формат дампа: явно заданный или по расширению файла (по умолчанию jsonl)
+    """
+    if fmt:
+        return fmt
+    return 'csv' if path.lower().endswith('.csv') else 'jsonl'
+
+
+class JsonlWriter:
+    """
+    Один JSON профиля на строку
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, record: dict):
+        self.stream.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+
+class CsvWriter:
+    """
+    CSV с заголовком, списки пинов и ачивок -- через запятую в одной ячейке
+    """
+    def __init__(self, stream):
+        self.writer = csv.DictWriter(stream, fieldnames=DUMP_FIELDS, lineterminator='\n')
+        self.writer.writeheader()
+
+    def write(self, record: dict):
+        record = dict(record)
+        for name in OWNED_FIELDS:
+            record[name] = ','.join(str(x) for x in record[name])
+        self.writer.writerow(record)
+
+
+def get_writer(stream, fmt: str):
+    return CsvWriter(stream) if fmt == 'csv' else JsonlWriter(stream)
+
+
+def _parse_csv_value(name: str, value: str):
+    if name in OWNED_FIELDS:
+        return [x for x in value.split(',') if x.strip()]
+    return value if value != '' else None
+
+
+def read_records(stream, fmt: str) -> Iterator[Tuple[int, dict]]:
+    """
+    Построчное чтение дампа
+    :return: Пары (номер строки, запись как есть)
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, {k: _parse_csv_value(k, v) for k, v in record.items() if k in DUMP_FIELDS}
+        return
+    for line_num, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            raise DumpFormatError(f'line {line_num}: {e}')
+        if not isinstance(record, dict):
+            raise DumpFormatError(f'line {line_num}: expected an object')
+        yield line_num, record
+
+
+def clean_record(record: dict) -> dict:
+    """
+    Приведение записи дампа к значениям полей профиля (отсутствующие поля не возвращаются)
+    :raises DumpFormatError: Если запись не годится
+    """
+    ret = {}
+    try:
+        for name in INT_FIELDS:
+            if record.get(name) is not None:
+                ret[name] = int(record[name])
+                if ret[name] < 0:
+                    raise ValueError(f'{name} must not be negative')
+            elif name in NULLABLE_FIELDS and name in record:
+                ret[name] = None
+        for name in OWNED_FIELDS:
+            if record.get(name) is not None:
+                ret[name] = [int(x) for x in record[name]]
+        if record.get('created_dt'):
+            ret['created_dt'] = parse_datetime(record['created_dt'])
+            if ret['created_dt'] is None:
+                raise ValueError(f'wrong created_dt {record["created_dt"]}')
+    except (TypeError, ValueError) as e:
+        raise DumpFormatError(str(e))
+    if not ret.get('user_id'):
+        raise DumpFormatError('user_id is required')
+    return ret
+
+
+def chunked(iterable: Iterable, size: int):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
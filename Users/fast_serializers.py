@@ -0,0 +1,91 @@
+from typing import Iterable, Dict, List
+from rest_framework import serializers
+from Users.models import UnlockedPin, ProfileAchievement
+from Users.serializers import ProfilesListSerializer, ProfileSerializer
+from Users.timing import phase
+
+
+class FastReadSerializer:
+    """
+    Быстрая сериализация на чтение поверх .values()
+    Колонки и конвертеры заранее собираются из полей DRF-сериализатора, так что вывод совпадает с ним байт в байт,
+    но без создания объектов моделей и обхода полей на каждую строку
+    SerializerMethodField'ы сюда не попадают -- их значения передаются в to_representation через extra
+    """
+    # Для этих полей to_representation на своих же значениях ничего не меняет (а method-поля приходят готовыми)
+    IDENTITY_FIELDS = (serializers.IntegerField, serializers.BooleanField, serializers.CharField,
+                       serializers.SerializerMethodField)
+
+    def __init__(self, serializer_class, field_names: Iterable[str] = None):
+        self.serializer_class = serializer_class
+        self._subsets = {}
+        fields = serializer_class(fields=field_names).fields
+        self.field_names = tuple(fields.keys())
+        self.columns = tuple(name for name, field in fields.items()
+                             if not isinstance(field, serializers.SerializerMethodField))
+        self.extra_fields = tuple(name for name in self.field_names if name not in self.columns)
+        self._mappers = tuple(
+            (name, name in self.columns,
+             None if isinstance(field, self.IDENTITY_FIELDS) else field.to_representation)
+            for name, field in fields.items()
+        )
+
+    def only(self, field_names: Iterable[str] = None) -> 'FastReadSerializer':
+        """
+        Сериализатор только для field_names (для ?fields=); None -- все поля
+        """
+        if field_names is None:
+            return self
+        key = tuple(field_names)
+        if key not in self._subsets:
+            self._subsets[key] = FastReadSerializer(self.serializer_class, key)
+        return self._subsets[key]
+
+    def to_representation(self, row: dict, extra: dict = None) -> dict:
+        with phase('serialization'):
+            return self._to_representation(row, extra)
+
+    def _to_representation(self, row: dict, extra: dict = None) -> dict:
+        ret = {}
+        for name, is_column, converter in self._mappers:
+            value = row[name] if is_column else extra[name]
+            if converter is not None and value is not None:
+                value = converter(value)
+            ret[name] = value
+        return ret
+
+    def many(self, rows: Iterable[dict]) -> List[dict]:
+        rows = list(rows)
+        with phase('serialization'):
+            return [self._to_representation(row) for row in rows]
+
+
+OWNED_FIELDS = ('unlocked_pins', 'achievements')
+
+
+def get_owned_ids(profile_ids: Iterable[int], using: str = None,
+                  fields: Iterable[str] = OWNED_FIELDS) -> Dict[int, Dict[str, list]]:
+    """
+    Пины и ачивки пачки профилей двумя запросами
+    :param using: Шард, в котором лежат профили
+    :param fields: Что из этого нужно (лишних запросов не делаем)
+    :return: Словарь profile_id -> {'unlocked_pins': [...], 'achievements': [...]}
+    """
+    profile_ids = list(profile_ids)
+    fields = tuple(fields)
+    ret = {x: {name: [] for name in fields} for x in profile_ids}
+    if 'unlocked_pins' in fields:
+        pins = UnlockedPin.objects.using(using).filter(profile_id__in=profile_ids).order_by('id') \
+            .values_list('profile_id', 'pin_id')
+        for profile_id, pin_id in pins:
+            ret[profile_id]['unlocked_pins'].append(pin_id)
+    if 'achievements' in fields:
+        achievements = ProfileAchievement.objects.using(using).filter(profile_id__in=profile_ids).order_by('id') \
+            .values_list('profile_id', 'achievement_id')
+        for profile_id, achievement_id in achievements:
+            ret[profile_id]['achievements'].append(achievement_id)
+    return ret
+
+
+profiles_list_reader = FastReadSerializer(ProfilesListSerializer)
+profile_reader = FastReadSerializer(ProfileSerializer)
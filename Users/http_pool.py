@@ -0,0 +1,239 @@
+import importlib
+import sys
+import time
+from http.cookiejar import DefaultCookiePolicy
+from threading import Lock
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3 import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import EmptyPoolError
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from Users.metrics import Histogram
+
+
+class PoolStats:
+    """
+    Использование пулов HTTP-соединений: сколько соединений открыто и занято, сколько ждали свободного
+    и сколько раз так и не дождались
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self.requests = 0
+        self.connections_created = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.pool_timeouts = 0
+        self.wait_histogram = Histogram('users_http_pool_wait_seconds', 'Ожидание соединения из пула',
+                                        ('host', ), buckets=(0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0))
+
+    def request_sent(self):
+        with self._lock:
+            self.requests += 1
+
+    def connection_created(self):
+        with self._lock:
+            self.connections_created += 1
+
+    def acquired(self, host: str, wait: float):
+        with self._lock:
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+        self.wait_histogram.observe(wait, host)
+
+    def timed_out(self, host: str, wait: float):
+        with self._lock:
+            self.pool_timeouts += 1
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+        self.wait_histogram.observe(wait, host)
+
+    def released(self):
+        with self._lock:
+            self.in_use -= 1
+
+    def metrics(self):
+        return {
+            'requests': self.requests,
+            'connections_created': self.connections_created,
+            'in_use': self.in_use,
+            'max_in_use': self.max_in_use,
+            'wait_seconds': self.wait_seconds,
+            'max_wait_seconds': self.max_wait_seconds,
+            'pool_timeouts': self.pool_timeouts,
+        }
+
+
+pool_stats = PoolStats()
+
+
+class InstrumentedPoolMixin:
+    """
+    Пул urllib3, который отчитывается в pool_stats
+    """
+    def _new_conn(self):
+        pool_stats.connection_created()
+        return super()._new_conn()
+
+    def _get_conn(self, timeout=None):
+        # requests не передает pool_timeout, а с block=True без него ждали бы свободного соединения вечно
+        if timeout is None:
+            timeout = settings.HTTP_POOL_TIMEOUT
+        started = time.perf_counter()
+        try:
+            conn = super()._get_conn(timeout)
+        except EmptyPoolError:
+            pool_stats.timed_out(self.host, time.perf_counter() - started)
+            raise
+        pool_stats.acquired(self.host, time.perf_counter() - started)
+        return conn
+
+    def _put_conn(self, conn):
+        pool_stats.released()
+        super()._put_conn(conn)
+
+
+class InstrumentedHTTPConnectionPool(InstrumentedPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class InstrumentedHTTPSConnectionPool(InstrumentedPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """
+    Адаптер с инструментированными пулами соединений (по пулу на хост)
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': InstrumentedHTTPConnectionPool,
+            'https': InstrumentedHTTPSConnectionPool,
+        }
+
+    def send(self, request, **kwargs):
+        try:
+            return super().send(request, **kwargs)
+        except EmptyPoolError as e:
+            # Для вызывающего это такая же недоступность сервиса, как и ошибка соединения
+            raise requests.ConnectionError(e, request=request)
+
+
+_session = None
+_session_lock = Lock()
+
+
+def get_session() -> requests.Session:
+    """
+    Общая на процесс сессия с keep-alive соединениями
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                # Сессия общая для всех запросов, поэтому куки одного ответа не должны уходить в чужие запросы
+                session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+                adapter = PooledHTTPAdapter(pool_connections=settings.HTTP_POOL_HOSTS,
+                                            pool_maxsize=settings.HTTP_POOL_MAXSIZE,
+                                            pool_block=settings.HTTP_POOL_BLOCK,
+                                            max_retries=settings.HTTP_MAX_RETRIES)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+
+def pooled_request(method, url, **kwargs):
+    """
+    Замена requests.request: тот же интерфейс, но через общую сессию и с таймаутами по умолчанию
+    """
+    kwargs.setdefault('timeout', (settings.HTTP_CONNECT_TIMEOUT, settings.HTTP_READ_TIMEOUT))
+    pool_stats.request_sent()
+    return get_session().request(method=method, url=url, **kwargs)
+
+
+class PooledRequests:
+    """
+    То же, что модуль requests (get, post, ... и все остальное), но запросы идут через общую сессию
+    """
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+    @staticmethod
+    def request(method, url, **kwargs):
+        return pooled_request(method, url, **kwargs)
+
+    def get(self, url, params=None, **kwargs):
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('get', url, params=params, **kwargs)
+
+    def options(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('options', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', False)
+        return self.request('head', url, **kwargs)
+
+    def post(self, url, data=None, json=None, **kwargs):
+        return self.request('post', url, data=data, json=json, **kwargs)
+
+    def put(self, url, data=None, **kwargs):
+        return self.request('put', url, data=data, **kwargs)
+
+    def patch(self, url, data=None, **kwargs):
+        return self.request('patch', url, data=data, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('delete', url, **kwargs)
+
+
+pooled_requests = PooledRequests()
+# Модули реквестеров, которые ходят в другие сервисы (базовый реквестер подтягивается ими же)
+REQUESTER_MODULES = ('ApiRequesters.Auth.AuthRequester', 'ApiRequesters.Media.MediaRequester',
+                     'ApiRequesters.Awards.AwardsRequester', 'ApiRequesters.Stats.decorators')
+REQUESTS_FUNCTIONS = ('request', 'get', 'options', 'head', 'post', 'put', 'patch', 'delete')
+
+
+def _patch_module(module) -> bool:
+    """
+    Подмена requests (или импортированных из него функций) в модуле на pooled_requests
+    :return: Ходит ли теперь модуль через общую сессию (в том числе если его уже подменили)
+    """
+    patched = False
+    if getattr(module, 'requests', None) in (requests, pooled_requests):
+        module.requests = pooled_requests
+        patched = True
+    for func in REQUESTS_FUNCTIONS:
+        if getattr(module, func, None) in (getattr(requests, func), getattr(pooled_requests, func)):
+            setattr(module, func, getattr(pooled_requests, func))
+            patched = True
+    return patched
+
+
+def install():
+    """
+    Пускает запросы реквестеров ApiRequesters через общую сессию: в модулях ApiRequesters requests (или
+    импортированные из него функции) подменяются на pooled_requests. Остальной процесс ходит обычным requests
+    Модули реквестеров импортируются тут же, так что подменяются и они, и то, что они импортируют
+    :return: Имена подмененных модулей
+    :raises ImproperlyConfigured: Если модуля реквестера нет или ни один модуль не ходит через requests (библиотеку
+    переделали, и без ошибки пул молча перестал бы работать)
+    """
+    for name in REQUESTER_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError as e:
+            raise ImproperlyConfigured(f'HTTP_POOL_ENABLED: cannot import {name} ({e}), set HTTP_POOL_ENABLED=0')
+    patched = [name for name, module in list(sys.modules.items())
+               if module is not None and name.split('.')[0] == 'ApiRequesters' and _patch_module(module)]
+    if not patched:
+        raise ImproperlyConfigured('HTTP_POOL_ENABLED: no ApiRequesters module calls requests, '
+                                   'set HTTP_POOL_ENABLED=0')
+    return patched
@@ -0,0 +1,234 @@
+import hashlib
+import hmac
+import json
+from datetime import timedelta
+from contextlib import ExitStack
+from functools import wraps
+from typing import Callable, Optional
+from django.conf import settings
+from django.db import transaction, IntegrityError, DEFAULT_DB_ALIAS
+from django.utils import timezone
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+from Users.models import IdempotencyKey
+from Users.sharding import is_enabled as sharding_enabled, shard_for
+
+
+HEADER = 'HTTP_IDEMPOTENCY_KEY'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+
+
+def _digest(value: str) -> str:
+    # С SECRET_KEY, чтобы по дампу базы нельзя было перебором восстановить тело запроса (например, пароль)
+    return hmac.new(settings.SECRET_KEY.encode(), value.encode(), hashlib.sha256).hexdigest()
+
+
+def get_fingerprint(request) -> str:
+    return _digest(json.dumps(request.data, sort_keys=True, cls=JSONEncoder))
+
+
+def get_checkpoint(request) -> Optional[dict]:
+    """
+    Промежуточный результат, сохраненный (save_checkpoint) прошлой попыткой запроса с тем же ключом
+    :return: Сохраненное или None, если это первая попытка или ключа нет
+    """
+    record = getattr(request, 'idempotency_record', None)
+    if record is None or not record.checkpoint:
+        return None
+    return json.loads(record.checkpoint)
+
+
+def save_checkpoint(request, data: dict):
+    """
+    Сохранение того, что вьюха уже сделала и не может сделать второй раз (например, создала юзера в auth)
+    Если дальше запрос упадет с 5xx, ключ освобождается, и повтор продолжит с сохраненного (get_checkpoint)
+    """
+    record = getattr(request, 'idempotency_record', None)
+    if record is None:
+        return
+    record.checkpoint = json.dumps(data, cls=JSONEncoder)
+    record.save(update_fields=['checkpoint'])
+
+
+def _get_live(scope: str, key: str) -> Optional[IdempotencyKey]:
+    """
+    Действующая запись ключа (протухшая удаляется)
+    """
+    record = IdempotencyKey.objects.filter(scope=scope, key=key).first()
+    if record is not None and record.expires_dt <= timezone.now():
+        record.delete()
+        return None
+    return record
+
+
+def _reclaim(record: IdempotencyKey, fingerprint: str) -> bool:
+    """
+    Захват ключа, освобожденного упавшим запросом (см. save_checkpoint)
+    :return: Захвачен ли ключ этим запросом
+    """
+    if record.status_code is not None or record.in_progress or record.fingerprint != fingerprint:
+        return False
+    claimed = IdempotencyKey.objects.filter(id=record.id, status_code=None, in_progress=False).update(in_progress=True)
+    # Не захватили -- значит, успел параллельный повтор, и этот получит 409
+    record.in_progress = True
+    return bool(claimed)
+
+
+def _release(record: IdempotencyKey):
+    """
+    Ключ запроса, упавшего с ошибкой сервера: удаляется (повтор выполнится заново), а если вьюха успела
+    сохранить промежуточный результат -- освобождается для повтора, который продолжит с него
+    """
+    if record.checkpoint:
+        record.in_progress = False
+        record.save(update_fields=['in_progress'])
+    else:
+        record.delete()
+
+
+def _claim(scope: str, key: str, fingerprint: str):
+    """
+    Захват ключа новой записью "в процессе"
+    :return: Пара (запись, создана ли она сейчас); если ключ успел захватить параллельный запрос -- его запись
+    """
+    try:
+        with transaction.atomic():
+            record = IdempotencyKey.objects.create(
+                scope=scope, key=key, fingerprint=fingerprint,
+                expires_dt=timezone.now() + timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL))
+        return record, True
+    except IntegrityError:
+        return IdempotencyKey.objects.get(scope=scope, key=key), False
+
+
+def _write_alias(kwargs) -> Optional[str]:
+    """
+    База, в которой вьюха меняет профиль (None -- заранее неизвестно)
+    """
+    if not sharding_enabled():
+        return DEFAULT_DB_ALIAS
+    return shard_for(kwargs['user_id']) if 'user_id' in kwargs else None
+
+
+def _response(result):
+    return result[0] if isinstance(result, tuple) else result
+
+
+def _run_in_transaction(func, codec, scope: str, key: str, fingerprint: str, self, request, args, kwargs):
+    """
+    Ключ в той же базе, что и профиль: захват, изменения и ответ -- одна транзакция
+    Упавший запрос не оставляет ни изменений, ни ключа, а параллельный с тем же ключом ждет ее на уникальном индексе
+    """
+    with transaction.atomic():
+        record, created = _claim(scope, key, fingerprint)
+        if not created:
+            return _replay(record, fingerprint, codec)
+        request.idempotency_record = record
+        result = func(self, request, *args, **kwargs)
+        response = _response(result)
+        if response.status_code >= 500:
+            # Ошибку сервера клиент должен иметь возможность повторить: откатываются и изменения, и ключ
+            transaction.set_rollback(True)
+        else:
+            _save_response(record, response, codec)
+        return result
+
+
+def _run_claimed(func, codec, using: Optional[str], record: IdempotencyKey, self, request, args, kwargs):
+    """
+    Ключ захвачен отдельно (короткой транзакцией в default), вьюха выполняется в транзакции шарда или вовсе без
+    транзакции (using=None), а ответ сохраняется после ее коммита. Если сохранить его не удалось (упал воркер),
+    ключ так и остается "в процессе" до конца TTL и заново не выполняется
+    """
+    request.idempotency_record = record
+    try:
+        with transaction.atomic(using=using) if using is not None else ExitStack():
+            result = func(self, request, *args, **kwargs)
+            response = _response(result)
+            if response.status_code >= 500 and using is not None:
+                transaction.set_rollback(True, using=using)
+    except Exception:
+        # Изменения откатились вместе с транзакцией шарда, так что запрос можно повторить
+        _release(record)
+        raise
+    if response.status_code >= 500:
+        _release(record)
+    else:
+        _save_response(record, response, codec)
+    return result
+
+
+def _save_response(record: IdempotencyKey, response, codec):
+    store, _ = codec
+    record.status_code = response.status_code
+    record.response = json.dumps(store(response.data) if store is not None else response.data, cls=JSONEncoder)
+    record.save(update_fields=['status_code', 'response'])
+
+
+def _replay(record: IdempotencyKey, fingerprint: str, codec) -> Response:
+    _, replay = codec
+    if record.fingerprint != fingerprint:
+        return Response({'error': 'Idempotency-Key уже использован с другим запросом'}, status=422)
+    if record.status_code is None and record.in_progress:
+        return Response({'error': 'Запрос с этим Idempotency-Key еще выполняется'}, status=409)
+    data = json.loads(record.response)
+    return Response(replay(data) if replay is not None else data, status=record.status_code,
+                    headers={REPLAYED_HEADER: 'true'})
+
+
+def purge_expired(chunk_size: int = 1000) -> int:
+    """
+    Удаление протухших ключей пачками (по индексу на expires_dt)
+    :return: Сколько ключей удалено
+    """
+    now = timezone.now()
+    deleted = 0
+    while True:
+        ids = list(IdempotencyKey.objects.filter(expires_dt__lte=now).values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            return deleted
+        deleted += IdempotencyKey.objects.filter(id__in=ids).delete()[0]
+
+
+def idempotent(scope: str, store: Callable[[dict], dict] = None, replay: Callable[[dict], dict] = None,
+               client: Callable[[Request], str] = None, atomic: bool = True):
+    """
+    Декоратор метода вьюхи для поддержки заголовка Idempotency-Key
+    Ответ (кроме 5xx) сохраняется в одной транзакции с изменениями профиля, и повтор запроса с тем же ключом
+    получает его, не выполняя вьюху еще раз. Незавершенный запрос держит ключ до конца TTL (повтор получает 409)
+    Ключи живут IDEMPOTENCY_KEY_TTL секунд и не пересекаются между scope и аргументами урла (например, user_id)
+    :param store: Что из ответа сохранять (по умолчанию -- ответ целиком), например без секретов
+    :param replay: Ответ повтора из сохраненного store (по умолчанию -- сохраненное как есть)
+    :param client: Чьи ключи (если урл этого не задает), ключи разных клиентов не пересекаются
+    :param atomic: False -- вьюха ходит в другие сервисы, и держать на это время транзакцию с ключом нельзя:
+    ключ захватывается короткой транзакцией, а вьюха выполняется без нее
+    """
+    codec = (store, replay)
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, request, *args, **kwargs):
+            key = request.META.get(HEADER)
+            if not key:
+                return func(self, request, *args, **kwargs)
+            if len(key) > IdempotencyKey.KEY_MAX_LENGTH:
+                return Response({'error': f'Idempotency-Key длиннее {IdempotencyKey.KEY_MAX_LENGTH} символов'},
+                                status=400)
+            full_scope = ':'.join([scope] + [str(kwargs[x]) for x in sorted(kwargs)] +
+                                  ([_digest(client(request))] if client is not None else []))
+            fingerprint = get_fingerprint(request)
+            using = _write_alias(kwargs) if atomic else None
+            record = _get_live(full_scope, key)
+            if record is not None:
+                if not _reclaim(record, fingerprint):
+                    return _replay(record, fingerprint, codec)
+                return _run_claimed(func, codec, using, record, self, request, args, kwargs)
+            if using == DEFAULT_DB_ALIAS:
+                return _run_in_transaction(func, codec, full_scope, key, fingerprint, self, request, args, kwargs)
+            record, created = _claim(full_scope, key, fingerprint)
+            if not created:
+                return _replay(record, fingerprint, codec)
+            return _run_claimed(func, codec, using, record, self, request, args, kwargs)
+        return wrapper
+    return decorator
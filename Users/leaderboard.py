@@ -0,0 +1,200 @@
+from bisect import bisect_left, bisect_right, insort
+from typing import Optional, List, Tuple
+from django.conf import settings
+
+
+class InMemorySortedSet:
+    """
+    Заглушка сортированного множества редиса (для тестов и локального запуска)
+    Поддерживает только те команды, которыми пользуется Leaderboard
+    """
+    def __init__(self):
+        self._scores = {}
+        self._sorted = {}
+        self._values = {}
+
+    def _parse_bound(self, value):
+        value = str(value)
+        if value in ('+inf', '-inf'):
+            return float(value), False
+        if value.startswith('('):
+            return float(value[1:]), True
+        return float(value), False
+
+    def zadd(self, name, mapping: dict):
+        scores = self._scores.setdefault(name, {})
+        items = self._sorted.setdefault(name, [])
+        for member, score in mapping.items():
+            member = str(member).encode()
+            if member in scores:
+                items.pop(bisect_left(items, (scores[member], member)))
+            scores[member] = float(score)
+            insort(items, (float(score), member))
+        return len(mapping)
+
+    def zrem(self, name, *members):
+        scores = self._scores.get(name, {})
+        items = self._sorted.get(name, [])
+        removed = 0
+        for member in members:
+            member = str(member).encode()
+            if member in scores:
+                items.pop(bisect_left(items, (scores.pop(member), member)))
+                removed += 1
+        return removed
+
+    def zscore(self, name, member):
+        return self._scores.get(name, {}).get(str(member).encode())
+
+    def zcard(self, name):
+        return len(self._scores.get(name, {}))
+
+    def zcount(self, name, min_score, max_score):
+        items = self._sorted.get(name, [])
+        lo, lo_excl = self._parse_bound(min_score)
+        hi, hi_excl = self._parse_bound(max_score)
+        # Ключи -- пары (score, member), поэтому границы сравниваем с парой, где member меньше/больше любого
+        start = bisect_right(items, (lo, b'\xff' * 32)) if lo_excl else bisect_left(items, (lo, b''))
+        end = bisect_left(items, (hi, b'')) if hi_excl else bisect_right(items, (hi, b'\xff' * 32))
+        return max(end - start, 0)
+
+    def zrevrange(self, name, start, end, withscores=False):
+        items = self._sorted.get(name, [])[::-1]
+        end = len(items) if end == -1 else end + 1
+        sliced = items[start:end]
+        if withscores:
+            return [(m, s) for s, m in sliced]
+        return [m for s, m in sliced]
+
+    def set(self, name, value):
+        self._values[name] = str(value).encode()
+        return True
+
+    def exists(self, *names):
+        return sum(1 for x in names if x in self._values or x in self._scores)
+
+    def delete(self, *names):
+        for name in names:
+            self._scores.pop(name, None)
+            self._sorted.pop(name, None)
+            self._values.pop(name, None)
+
+
+class Leaderboard:
+    """
+    Зеркало рейтинга профилей в сортированном множестве редиса
+    Включается настройкой LEADERBOARD_REDIS_URL ('memory://' -- заглушка в памяти процесса), если она не задана,
+    редис недоступен или зеркало еще не залито командой rebuild_leaderboard, все методы чтения возвращают None и
+    запрос идет в базу по индексу на rating. Неудавшаяся запись снимает метку заполненности: зеркало отстало, и до
+    следующего rebuild_leaderboard читается база
+    """
+    KEY = 'profiles:leaderboard'
+    # Ставится только после полной заливки: пока ее нет, в множестве может быть лишь часть игроков
+    POPULATED_KEY = 'profiles:leaderboard:populated'
+    # При равном счете редис отдает участников в обратном лексикографическом порядке, поэтому храним не user_id,
+    # а MEMBER_BASE - user_id с нулями слева: равные по рейтингу идут по возрастанию user_id, как и в базе
+    MEMBER_BASE = 10 ** 10
+
+    def __init__(self):
+        self._clients = {}
+
+    @property
+    def client(self):
+        url = getattr(settings, 'LEADERBOARD_REDIS_URL', None)
+        if not url:
+            return None
+        if url not in self._clients:
+            if url == 'memory://':
+                self._clients[url] = InMemorySortedSet()
+            else:
+                import redis
+                self._clients[url] = redis.Redis.from_url(url)
+        return self._clients[url]
+
+    @property
+    def enabled(self):
+        return self.client is not None
+
+    def _call(self, method: str, *args, **kwargs):
+        client = self.client
+        if client is None:
+            return None
+        try:
+            return getattr(client, method)(*args, **kwargs)
+        except Exception:
+            # Зеркало -- не источник правды, поэтому его падение не должно ронять запрос
+            return None
+
+    def _write(self, method: str, *args):
+        if self._call(method, *args) is None and self.enabled:
+            # Зеркало разошлось с базой: пусть читают базу, пока его не перезальют (метка тоже может не сняться,
+            # если редис лежит целиком, но тогда не удадутся и чтения)
+            self._call('delete', self.POPULATED_KEY)
+
+    def _member(self, user_id: int) -> str:
+        return f'{self.MEMBER_BASE - int(user_id):010d}'
+
+    def _user_id(self, member) -> int:
+        return self.MEMBER_BASE - int(member)
+
+    @property
+    def populated(self) -> bool:
+        return bool(self._call('exists', self.POPULATED_KEY))
+
+    def update(self, user_id: int, rating: int):
+        self._write('zadd', self.KEY, {self._member(user_id): rating})
+
+    def update_many(self, ratings: dict):
+        """
+        :param ratings: Словарь user_id -> rating
+        """
+        if ratings:
+            self._write('zadd', self.KEY, {self._member(k): v for k, v in ratings.items()})
+
+    def remove(self, user_id: int):
+        self._write('zrem', self.KEY, self._member(user_id))
+
+    def rank(self, user_id: int) -> Optional[int]:
+        if not self.populated:
+            return None
+        score = self._call('zscore', self.KEY, self._member(user_id))
+        if score is None:
+            return None
+        count = self._call('zcount', self.KEY, f'({score}', '+inf')
+        return None if count is None else count + 1
+
+    def top(self, limit: int) -> Optional[List[Tuple[int, int]]]:
+        if not self.populated:
+            return None
+        top = self._call('zrevrange', self.KEY, 0, limit - 1, withscores=True)
+        if top is None:
+            return None
+        return [(self._user_id(member), int(score)) for member, score in top]
+
+    def rebuild(self, pairs, chunk_size: int = 1000):
+        """
+        Полная перезаливка зеркала; метка заполненности ставится, только если залилось все
+        :param pairs: Итерируемое пар (user_id, rating)
+        :return: Количество залитых профилей
+        """
+        if not self.enabled:
+            return 0
+        self._call('delete', self.POPULATED_KEY, self.KEY)
+        count = 0
+        failed = False
+        chunk = {}
+        for user_id, rating in pairs:
+            chunk[self._member(user_id)] = rating
+            if len(chunk) >= chunk_size:
+                failed |= self._call('zadd', self.KEY, chunk) is None
+                count += len(chunk)
+                chunk = {}
+        if chunk:
+            failed |= self._call('zadd', self.KEY, chunk) is None
+            count += len(chunk)
+        if not failed:
+            self._call('set', self.POPULATED_KEY, 1)
+        return count
+
+
+leaderboard = Leaderboard()
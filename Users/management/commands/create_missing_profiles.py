@@ -0,0 +1,69 @@
+import sys
+from itertools import chain
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from Users.dumps import chunked
+from Users.http_pool import pooled_request
+from Users.models import Profile
+
+
+class Command(BaseCommand):
+    help = 'Создает профили (с дефолтными пинами и ачивками) юзерам auth-сервиса, у которых их нет'
+
+    def add_arguments(self, parser):
+        parser.add_argument('user_ids', nargs='*', type=int, help='id юзеров в auth-сервисе')
+        parser.add_argument('--file', help='Файл с id юзеров по одному на строку ("-" -- stdin)')
+        parser.add_argument('--from-auth', action='store_true',
+                            help='Взять id всех юзеров из auth-сервиса (AUTH_USERS_URL)')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Сколько профилей создавать за раз')
+
+    def _read_ids(self, path):
+        stream = sys.stdin if path == '-' else open(path)
+        try:
+            for line in stream:
+                line = line.strip()
+                if line:
+                    yield int(line)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+    def _fetch_auth_ids(self):
+        """
+        id юзеров auth-сервиса постранично, без загрузки всего списка в память
+        """
+        url = settings.AUTH_USERS_URL
+        headers = {'Authorization': f'Bearer {settings.AUTH_USERS_TOKEN}'} if settings.AUTH_USERS_TOKEN else {}
+        while url:
+            response = pooled_request('GET', url, headers=headers)
+            if response.status_code != 200:
+                raise CommandError(f'Auth service returned {response.status_code} for {url}')
+            page = response.json()
+            users, url = (page, None) if isinstance(page, list) else (page['results'], page.get('next'))
+            for user in users:
+                yield int(user['id'])
+
+    def handle(self, *args, **options):
+        user_ids = list(options['user_ids'])
+        if options['file']:
+            try:
+                user_ids += list(self._read_ids(options['file']))
+            except (OSError, ValueError) as e:
+                raise CommandError(f'Cannot read user ids: {e}')
+        if options['from_auth'] and not settings.AUTH_USERS_URL:
+            raise CommandError('Set AUTH_USERS_URL to fetch user ids from the auth service')
+        if not user_ids and not options['from_auth']:
+            raise CommandError('Pass user ids as arguments, with --file or --from-auth')
+
+        ids = chain(user_ids, self._fetch_auth_ids() if options['from_auth'] else [])
+        seen = set()
+        created = 0
+        try:
+            for chunk in chunked(ids, options['chunk_size']):
+                chunk = [x for x in dict.fromkeys(chunk) if x not in seen]
+                seen.update(chunk)
+                created += len(Profile.create_for_users(chunk))
+        except (requests.RequestException, KeyError, TypeError, ValueError) as e:
+            raise CommandError(f'Cannot fetch user ids from the auth service: {e}. Created {created} profiles so far')
+        self.stdout.write(self.style.SUCCESS(f'Created {created} missing profiles of {len(seen)} users'))
@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+from Users.dumps import DUMP_FIELDS, FORMATS, detect_format, get_writer, chunked
+from Users.fast_serializers import profile_reader, get_owned_ids
+from Users.models import Profile
+from Users.sharding import get_shards
+
+
+class Command(BaseCommand):
+    help = 'Выгружает все профили (с пинами и ачивками) в JSONL или CSV, не держа их в памяти'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', nargs='?', default='-', help='Куда писать ("-" -- stdout)')
+        parser.add_argument('--format', choices=FORMATS, help='Формат (по умолчанию по расширению, иначе jsonl)')
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Сколько строк читать из базы за раз (и сколько профилей за раз дополнять пинами)')
+
+    def _export_shard(self, shard, writer, chunk_size):
+        reader = profile_reader.only(DUMP_FIELDS)
+        # Серверный курсор: в памяти только текущая пачка
+        rows = Profile.objects.using(shard).order_by('id').values('id', *reader.columns).iterator(chunk_size=chunk_size)
+        exported = 0
+        for chunk in chunked(rows, chunk_size):
+            owned = get_owned_ids([x['id'] for x in chunk], using=shard)
+            for row in chunk:
+                writer.write(reader.to_representation(row, owned[row['id']]))
+            exported += len(chunk)
+            self.stderr.write(f'{shard or "default"}: exported {exported}')
+        return exported
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = detect_format(path, options['format'])
+        try:
+            stream = self.stdout if path == '-' else open(path, 'w', newline='', encoding='utf-8')
+        except OSError as e:
+            raise CommandError(f'Cannot open {path}: {e}')
+        try:
+            writer = get_writer(stream, fmt)
+            exported = sum(self._export_shard(x, writer, options['chunk_size']) for x in get_shards())
+        finally:
+            if stream is not self.stdout:
+                stream.close()
+        self.stderr.write(self.style.SUCCESS(f'Exported {exported} profiles'))
@@ -0,0 +1,95 @@
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from Users.dumps import FORMATS, DumpFormatError, detect_format, read_records, clean_record, chunked
+from Users.fast_serializers import OWNED_FIELDS
+from Users.leaderboard import leaderboard
+from Users.models import Profile, UnlockedPin, ProfileAchievement, profile_changed
+from Users.sharding import group_by_shard
+
+
+class Command(BaseCommand):
+    help = 'Загружает профили из JSONL или CSV (формат export_profiles) пачками, не держа файл в памяти'
+
+    # Поля профиля, которые обновляются у уже существующих профилей с --update
+    UPDATE_FIELDS = ('rating', 'money', 'pin_sprite', 'geopin_sprite', 'pic_id', 'created_dt')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Откуда читать ("-" -- stdin)')
+        parser.add_argument('--format', choices=FORMATS, help='Формат (по умолчанию по расширению, иначе jsonl)')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Сколько профилей загружать за транзакцию')
+        parser.add_argument('--update', action='store_true',
+                            help='Обновлять уже существующие профили (по умолчанию они пропускаются)')
+
+    def _import_shard(self, shard, records, update):
+        """
+        Загрузка пачки одного шарда в одной транзакции
+        :return: (создано, обновлено)
+        """
+        qs = Profile.objects.using(shard)
+        with transaction.atomic(using=shard):
+            existing = {x.user_id: x for x in qs.filter(user_id__in=list(records))}
+            new = [Profile(**{k: v for k, v in x.items() if k not in OWNED_FIELDS})
+                   for user_id, x in records.items() if user_id not in existing]
+            qs.bulk_create(new, ignore_conflicts=True)
+            # bulk_create возвращает id не на всех базах, а auto_now_add перетирает дату создания -- перечитываем
+            # и возвращаем дату из дампа
+            created = list(qs.filter(user_id__in=[x.user_id for x in new]))
+            for profile in created:
+                profile.created_dt = records[profile.user_id].get('created_dt', profile.created_dt)
+            qs.bulk_update(created, ['created_dt'])
+            updated = list(existing.values()) if update else []
+            for profile in updated:
+                for name in self.UPDATE_FIELDS:
+                    setattr(profile, name, records[profile.user_id].get(name, getattr(profile, name)))
+            qs.bulk_update(updated, self.UPDATE_FIELDS)
+
+            # Пины и ачивки из дампа только добавляются; профилям без них в дампе -- дефолтные
+            defaults = [x for x in created if any(name not in records[x.user_id] for name in OWNED_FIELDS)]
+            Profile.create_default_ownership(defaults, ignore_conflicts=True)
+            touched = created + updated
+            UnlockedPin.objects.using(shard).bulk_create([
+                UnlockedPin(profile=x, pin_id=pin_id) for x in touched
+                for pin_id in records[x.user_id].get('unlocked_pins', [])
+            ], ignore_conflicts=True)
+            ProfileAchievement.objects.using(shard).bulk_create([
+                ProfileAchievement(profile=x, achievement_id=achievement_id) for x in touched
+                for achievement_id in records[x.user_id].get('achievements', [])
+            ], ignore_conflicts=True)
+            for profile in updated:
+                profile_changed(profile.user_id, using=shard)
+        leaderboard.update_many({x.user_id: x.rating for x in touched})
+        return len(created), len(updated)
+
+    def _clean(self, records):
+        for line_num, record in records:
+            try:
+                yield clean_record(record)
+            except DumpFormatError as e:
+                raise DumpFormatError(f'line {line_num}: {e}')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = detect_format(path, options['format'])
+        try:
+            stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+        except OSError as e:
+            raise CommandError(f'Cannot open {path}: {e}')
+        total, created, updated = 0, 0, 0
+        try:
+            for chunk in chunked(self._clean(read_records(stream, fmt)), options['chunk_size']):
+                # Если user_id в пачке повторяется, берем последнюю запись
+                records = {x['user_id']: x for x in chunk}
+                for shard, user_ids in group_by_shard(records.keys()).items():
+                    c, u = self._import_shard(shard, {x: records[x] for x in user_ids}, options['update'])
+                    created += c
+                    updated += u
+                total += len(chunk)
+                self.stdout.write(f'Processed {total} records: {created} created, {updated} updated')
+        except DumpFormatError as e:
+            raise CommandError(f'Cannot import {path}: {e}. Rows before this chunk are already imported')
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        self.stdout.write(self.style.SUCCESS(f'Imported {total} records: {created} created, {updated} updated, '
+                                             f'{total - created - updated} skipped'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+from Users.idempotency import purge_expired
+
+
+class Command(BaseCommand):
+    help = 'Удаляет ключи идемпотентности, у которых истек IDEMPOTENCY_KEY_TTL (запускать по крону)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Сколько ключей удалять за раз')
+
+    def handle(self, *args, **options):
+        deleted = purge_expired(options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} expired idempotency keys'))
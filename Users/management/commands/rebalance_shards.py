@@ -0,0 +1,86 @@
+from collections import defaultdict
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Case, When, Value, DateTimeField
+from Users import sharding
+from Users.models import Profile, UnlockedPin, ProfileAchievement
+from Users.profile_cache import profile_cache
+
+
+class Command(BaseCommand):
+    help = 'Переносит профили (с пинами и ачивками) в шарды, которые им назначает кольцо после добавления шардов'
+
+    # Поля профиля, которые переезжают как есть (id в новом шарде свой)
+    COPY_FIELDS = ('user_id', 'rating', 'money', 'pin_sprite', 'geopin_sprite', 'pic_id')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Сколько профилей переносить за раз')
+        parser.add_argument('--dry-run', action='store_true', help='Только посчитать, сколько профилей переедет')
+
+    def _copy(self, target, profiles):
+        """
+        Копия профилей в шард target. Профили, которые уже там (прерванный прошлый прогон или запись после смены
+        кольца), не трогаются -- они новее
+        """
+        user_ids = [x.user_id for x in profiles]
+        owned = {'pins': defaultdict(list), 'achievements': defaultdict(list)}
+        source = profiles[0]._state.db
+        for profile_id, pin_id in UnlockedPin.objects.using(source).filter(profile__in=profiles).order_by('id') \
+                .values_list('profile_id', 'pin_id'):
+            owned['pins'][profile_id].append(pin_id)
+        for profile_id, achievement_id in ProfileAchievement.objects.using(source).filter(profile__in=profiles) \
+                .order_by('id').values_list('profile_id', 'achievement_id'):
+            owned['achievements'][profile_id].append(achievement_id)
+
+        with transaction.atomic(using=target):
+            qs = Profile.objects.using(target)
+            existing = set(qs.filter(user_id__in=user_ids).values_list('user_id', flat=True))
+            to_copy = [x for x in profiles if x.user_id not in existing]
+            if not to_copy:
+                return
+            qs.bulk_create([Profile(**{f: getattr(x, f) for f in self.COPY_FIELDS}) for x in to_copy])
+            # auto_now_add при вставке перетирает дату создания, возвращаем исходную
+            qs.filter(user_id__in=[x.user_id for x in to_copy]).update(created_dt=Case(
+                *[When(user_id=x.user_id, then=Value(x.created_dt)) for x in to_copy], output_field=DateTimeField()))
+            new_ids = dict(qs.filter(user_id__in=[x.user_id for x in to_copy]).values_list('user_id', 'id'))
+            UnlockedPin.objects.using(target).bulk_create([
+                UnlockedPin(profile_id=new_ids[x.user_id], pin_id=pin_id)
+                for x in to_copy for pin_id in owned['pins'][x.id]
+            ])
+            ProfileAchievement.objects.using(target).bulk_create([
+                ProfileAchievement(profile_id=new_ids[x.user_id], achievement_id=achievement_id)
+                for x in to_copy for achievement_id in owned['achievements'][x.id]
+            ])
+
+    def _move(self, source, user_ids):
+        profiles = list(Profile.objects.using(source).filter(user_id__in=user_ids))
+        by_target = defaultdict(list)
+        for profile in profiles:
+            by_target[sharding.shard_for(profile.user_id)].append(profile)
+        for target, items in by_target.items():
+            self._copy(target, items)
+        # Удаляем только после копирования: если упадем посередине, повторный прогон просто доделает перенос
+        with transaction.atomic(using=source):
+            Profile.objects.using(source).filter(user_id__in=user_ids).delete()
+        for user_id in user_ids:
+            profile_cache.invalidate(user_id, using=source)
+        return len(profiles)
+
+    def handle(self, *args, **options):
+        if not sharding.is_enabled():
+            self.stdout.write(self.style.WARNING('DATABASE_SHARD_URLS is not set, nothing to rebalance'))
+            return
+        chunk_size = options['chunk_size']
+        moved = 0
+        for source in sharding.get_shards():
+            user_ids = Profile.objects.using(source).order_by('user_id').values_list('user_id', flat=True)
+            misplaced = [x for x in user_ids.iterator(chunk_size=chunk_size) if sharding.shard_for(x) != source]
+            self.stdout.write(f'{source}: {len(misplaced)} profiles to move')
+            if options['dry_run']:
+                moved += len(misplaced)
+                continue
+            for start in range(0, len(misplaced), chunk_size):
+                moved += self._move(source, misplaced[start:start + chunk_size])
+                self.stdout.write(f'{source}: moved {min(start + chunk_size, len(misplaced))}/{len(misplaced)}')
+        verb = 'Would move' if options['dry_run'] else 'Moved'
+        self.stdout.write(self.style.SUCCESS(f'{verb} {moved} profiles'))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from Users.leaderboard import leaderboard
+from Users.models import Profile
+from Users.sharding import sharded
+
+
+class Command(BaseCommand):
+    help = 'Перезаливает зеркало рейтинга в редисе из базы'
+
+    def handle(self, *args, **options):
+        if not leaderboard.enabled:
+            self.stdout.write(self.style.WARNING('LEADERBOARD_REDIS_URL is not set, nothing to rebuild'))
+            return
+        pairs = sharded(Profile.objects.values_list('user_id', 'rating')).iterator(chunk_size=1000)
+        count = leaderboard.rebuild(pairs)
+        self.stdout.write(self.style.SUCCESS(f'Leaderboard rebuilt with {count} profiles'))
@@ -0,0 +1,50 @@
+from typing import Optional
+from django.conf import settings
+from ApiRequesters.Media.MediaRequester import MediaRequester
+from ApiRequesters.exceptions import BaseApiRequestError, UnexpectedResponse
+from Users.caches import TTLLRUCache
+from Users.timing import phase
+
+
+class ImageValidator:
+    """
+    Проверка существования картинок в media-сервисе с кэшем по id картинки
+    Кэш общий для всех юзеров, поэтому в нем только ответы, не зависящие от токена: картинка есть или 404.
+    Положительные и отрицательные живут в кэше разное время, остальные ошибки не кэшируются
+    """
+    def __init__(self):
+        self._cache = None
+
+    @property
+    def cache(self) -> TTLLRUCache:
+        if self._cache is None or self._cache.maxsize != settings.MEDIA_VALIDATION_CACHE_SIZE:
+            self._cache = TTLLRUCache(settings.MEDIA_VALIDATION_CACHE_SIZE, settings.MEDIA_VALIDATION_POSITIVE_TTL)
+        return self._cache
+
+    def _check_remote(self, image_id: int, token: str) -> Optional[bool]:
+        """
+        :return: True/False, если media-сервис ответил, что картинка есть или ее нет (404), None -- иначе
+        (недоступен, 5xx, токен не подошел)
+        """
+        try:
+            with phase('requesters'):
+                _ = MediaRequester().get_image_info(image_id, token)
+            valid = True
+        except UnexpectedResponse as e:
+            if e.code != 404:
+                return None
+            valid = False
+        except BaseApiRequestError:
+            return None
+        ttl = settings.MEDIA_VALIDATION_POSITIVE_TTL if valid else settings.MEDIA_VALIDATION_NEGATIVE_TTL
+        self.cache.set(image_id, valid, ttl=ttl)
+        return valid
+
+    def is_valid(self, image_id: int, token: str) -> bool:
+        valid = self.cache.get(image_id)
+        if valid is None:
+            valid = self._check_remote(image_id, token)
+        return bool(valid)
+
+
+image_validator = ImageValidator()
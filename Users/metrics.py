@@ -0,0 +1,95 @@
+from bisect import bisect_left
+from threading import Lock
+from typing import Dict, Callable
+from django.conf import settings
+
+
+registry = []
+
+
+class Histogram:
+    """
+    Гистограмма с метками в формате Prometheus (без зависимостей, наблюдение -- один bisect под локом)
+    """
+    def __init__(self, name: str, documentation: str, labelnames, buckets=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets or settings.METRICS_BUCKETS))
+        self._series = {}
+        self._lock = Lock()
+        registry.append(self)
+
+    def observe(self, value: float, *labels):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # Счетчики по бакетам (последний -- +Inf), сумма, количество
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    def _labels(self, labels, extra: str = None):
+        items = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, labels)]
+        if extra:
+            items.append(extra)
+        return '{' + ','.join(items) + '}' if items else ''
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._series.items()]
+        for labels, counts, total, count in sorted(series):
+            cumulative = 0
+            for le, bucket_count in zip(self.buckets + (float('inf'), ), counts):
+                cumulative += bucket_count
+                le = '+Inf' if le == float('inf') else repr(float(le))
+                bucket_labels = self._labels(labels, f'le="{le}"')
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{self._labels(labels)} {total!r}')
+            lines.append(f'{self.name}_count{self._labels(labels)} {count}')
+        return lines
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+request_duration = Histogram('users_request_duration_seconds', 'Время обработки запроса',
+                             ('view', 'status'))
+request_phase_duration = Histogram('users_request_phase_duration_seconds', 'Время фаз обработки запроса',
+                                   ('view', 'status', 'phase'))
+
+
+def observe_request(view: str, status: int, timings):
+    request_duration.observe(timings.total, view, str(status))
+    for phase, duration in timings.phases.items():
+        request_phase_duration.observe(duration, view, str(status), phase)
+
+
+def render_metrics(gauge_sources: Dict[str, Callable[[], dict]] = None) -> str:
+    """
+    Все метрики в текстовом формате Prometheus
+    :param gauge_sources: Словарь имя -> функция, возвращающая словарь числовых показателей (кэши, очереди и т.п.)
+    """
+    lines = []
+    for histogram in registry:
+        lines += histogram.render()
+    for source, func in (gauge_sources or {}).items():
+        try:
+            values = func()
+        except Exception:
+            continue
+        for key, value in values.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            name = f'users_{source}_{key}'
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,81 @@
+from django.conf import settings
+from Users.auth import get_auth_context
+from Users.timing import start_request, end_request, finish_request, get_current
+from Users.routers import replica_request
+from Users.compression import compress_response
+
+
+class AuthContextMiddleware:
+    """
+    Вешает на запрос AuthContext, через который пермишны и вьюхи узнают, кто делает запрос
+    (ASGI-консюмер мог уже повесить его и заполнить заранее)
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        get_auth_context(request)
+        return self.get_response(request)
+
+
+def get_view_label(request) -> str:
+    """
+    Имя вьюхи для меток метрик (по классу, чтобы число меток не зависело от id в урле)
+    """
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    view_class = getattr(match.func, 'view_class', None)
+    return view_class.__name__ if view_class is not None else match.view_name
+
+
+class RequestTimingMiddleware:
+    """
+    Замер фаз запроса (база, другие сервисы, сериализация, статистика): отдаются в заголовке Server-Timing и
+    копятся в гистограммах для /metrics
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not settings.REQUEST_TIMING_ENABLED:
+            return self.get_response(request)
+        timings = get_current()
+        if timings is not None:
+            # Запрос уже замеряет ASGI-консюмер, он же и завершит замер
+            with timings.track_db():
+                return self.get_response(request)
+        timings = start_request()
+        try:
+            with timings.track_db():
+                response = self.get_response(request)
+        finally:
+            end_request()
+        finish_request(timings, get_view_label(request), response)
+        return response
+
+
+class ReplicaPinningMiddleware:
+    """
+    Границы запроса для ReplicaRouter (пишущие запросы и чтение сразу после записи идут в мастер)
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with replica_request(request):
+            return self.get_response(request)
+
+
+class CompressionMiddleware:
+    """
+    Сжатие больших ответов (gzip/brotli по Accept-Encoding)
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if not settings.RESPONSE_COMPRESSION_ENABLED:
+            return response
+        return compress_response(request, response)
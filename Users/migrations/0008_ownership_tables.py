@@ -0,0 +1,93 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def _parse_ids(value: str):
+    return [int(x) for x in value.split(',') if x.strip()]
+
+
+def strings_to_rows(apps, schema_editor):
+    Profile = apps.get_model('Users', 'Profile')
+    UnlockedPin = apps.get_model('Users', 'UnlockedPin')
+    ProfileAchievement = apps.get_model('Users', 'ProfileAchievement')
+    # Миграция гоняется по каждому шарду, поэтому работаем с той базой, которую мигрируем
+    db = schema_editor.connection.alias
+    pins, achievements = [], []
+    for profile_id, unlocked_pins, achievements_str in Profile.objects.using(db) \
+            .values_list('id', 'unlocked_pins', 'achievements').iterator():
+        # dict.fromkeys -- выкидываем дубли, сохраняя порядок
+        pins += [UnlockedPin(profile_id=profile_id, pin_id=x) for x in dict.fromkeys(_parse_ids(unlocked_pins))]
+        achievements += [ProfileAchievement(profile_id=profile_id, achievement_id=x)
+                         for x in dict.fromkeys(_parse_ids(achievements_str))]
+    UnlockedPin.objects.using(db).bulk_create(pins, batch_size=1000)
+    ProfileAchievement.objects.using(db).bulk_create(achievements, batch_size=1000)
+
+
+def rows_to_strings(apps, schema_editor):
+    Profile = apps.get_model('Users', 'Profile')
+    UnlockedPin = apps.get_model('Users', 'UnlockedPin')
+    ProfileAchievement = apps.get_model('Users', 'ProfileAchievement')
+    db = schema_editor.connection.alias
+    pins, achievements = {}, {}
+    for profile_id, pin_id in UnlockedPin.objects.using(db).order_by('id').values_list('profile_id', 'pin_id'):
+        pins.setdefault(profile_id, []).append(str(pin_id))
+    for profile_id, achievement_id in ProfileAchievement.objects.using(db).order_by('id') \
+            .values_list('profile_id', 'achievement_id'):
+        achievements.setdefault(profile_id, []).append(str(achievement_id))
+    for profile in Profile.objects.using(db).all():
+        profile.unlocked_pins = ','.join(pins.get(profile.id, []))
+        profile.achievements = ','.join(achievements.get(profile.id, []))
+        profile.save(update_fields=['unlocked_pins', 'achievements'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Users', '0007_auto_20200523_0838'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnlockedPin',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pin_id', models.PositiveIntegerField()),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pins',
+                                              to='Users.Profile')),
+            ],
+        ),
+        # related_name проставляется после удаления текстового поля achievements, чтобы не было конфликта имен
+        migrations.CreateModel(
+            name='ProfileAchievement',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('achievement_id', models.PositiveIntegerField()),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+',
+                                              to='Users.Profile')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='unlockedpin',
+            constraint=models.UniqueConstraint(fields=('profile', 'pin_id'), name='unique_profile_pin'),
+        ),
+        migrations.AddConstraint(
+            model_name='profileachievement',
+            constraint=models.UniqueConstraint(fields=('profile', 'achievement_id'),
+                                               name='unique_profile_achievement'),
+        ),
+        migrations.RunPython(strings_to_rows, rows_to_strings),
+        migrations.RemoveField(
+            model_name='profile',
+            name='achievements',
+        ),
+        migrations.RemoveField(
+            model_name='profile',
+            name='unlocked_pins',
+        ),
+        migrations.AlterField(
+            model_name='profileachievement',
+            name='profile',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='achievements',
+                                    to='Users.Profile'),
+        ),
+    ]
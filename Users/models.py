@@ -1,45 +1,340 @@
-from django.db import models
+from collections import defaultdict
+from django.db import models, transaction, router, IntegrityError
+from typing import Dict, Tuple, Iterable, List
+from django.db.models import F, Exists, OuterRef, Case, When, Value
+from django.db.models.functions import Greatest
 from django.contrib.auth.models import User
-from django.core.validators import validate_comma_separated_integer_list
+from Users.leaderboard import leaderboard
+from Users.profile_cache import profile_cache
+from Users.updates import profile_updates
+from Users.sharding import shard_for, get_shards, group_by_shard, sharded, is_enabled as is_sharding_enabled
+
+
+def profile_changed(user_id: int, using: str = None):
+    """
+    Профиль изменился: сброс кэша и оповещение подписчиков по WebSocket
+    """
+    profile_cache.invalidate(user_id, using=using)
+    profile_updates.notify(user_id, using=using)
+
+
+class ProfileQuerySet(models.QuerySet):
+    def for_user(self, user_id):
+        """
+        Профили из шарда, в котором лежит профиль user_id
+        """
+        return self.using(shard_for(user_id))
+
+    def create(self, **kwargs):
+        # Без явного .using() новый профиль создается в своем шарде
+        if self._db is None and is_sharding_enabled() and 'user_id' in kwargs:
+            return self.for_user(kwargs['user_id']).create(**kwargs)
+        return super().create(**kwargs)
 
 
 class Profile(models.Model):
     """
     Профиль пользователя
     """
+    DEFAULT_UNLOCKED_PINS = (1, 2)
+    DEFAULT_ACHIEVEMENTS = (1, )
+    # Сколько денег получает игрок за каждую сыгранную игру (изменение рейтинга)
+    MATCH_REWARD = 100
+    # Сколько профилей обновляется одним UPDATE'ом при пакетном изменении рейтинга
+    BULK_UPDATE_CHUNK_SIZE = 200
+
     user_id = models.PositiveIntegerField(null=False, blank=False, unique=True)
     rating = models.PositiveIntegerField(null=False, default=0)
     money = models.PositiveIntegerField(null=False, default=0)
     created_dt = models.DateTimeField(auto_now_add=True)
     pin_sprite = models.PositiveIntegerField(default=1, null=False)
     geopin_sprite = models.PositiveIntegerField(default=2, null=False)
-    unlocked_pins = models.TextField(blank=True, null=False, default='1,2',
-                                     validators=[validate_comma_separated_integer_list])
-    achievements = models.TextField(blank=True, null=False, default='1',
-                                    validators=[validate_comma_separated_integer_list])
     pic_id = models.PositiveIntegerField(null=True)
 
+    objects = ProfileQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-rating', 'user_id'], name='profile_rating_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        is_new = self._state.adding
+        # Новый профиль уходит в шард по user_id, поэтому транзакцию открываем в той же базе, что и запись
+        kwargs['using'] = kwargs.get('using') or router.db_for_write(Profile, instance=self)
+        with transaction.atomic(using=kwargs['using']):
+            super().save(*args, **kwargs)
+            if is_new:
+                self.create_default_ownership([self])
+        if is_new:
+            leaderboard.update(self.user_id, self.rating)
+        profile_changed(self.user_id, using=kwargs['using'])
+
+    def delete(self, *args, **kwargs):
+        user_id, using = self.user_id, self._state.db
+        ret = super().delete(*args, **kwargs)
+        leaderboard.remove(user_id)
+        profile_changed(user_id, using=using)
+        return ret
+
+    @classmethod
+    def create_default_ownership(cls, profiles, ignore_conflicts: bool = False):
+        """
+        Выдача дефолтных пинов и ачивок только что созданным профилям (нужно и для bulk_create, который не зовет save)
+        :param profiles: Профили с уже проставленными id
+        :param ignore_conflicts: Пропускать то, что у профиля уже есть
+        """
+        by_db = defaultdict(list)
+        for profile in profiles:
+            by_db[profile._state.db].append(profile)
+        for db, items in by_db.items():
+            UnlockedPin.objects.using(db).bulk_create([UnlockedPin(profile=p, pin_id=x)
+                                                       for p in items for x in cls.DEFAULT_UNLOCKED_PINS],
+                                                      ignore_conflicts=ignore_conflicts)
+            ProfileAchievement.objects.using(db).bulk_create([ProfileAchievement(profile=p, achievement_id=x)
+                                                              for p in items for x in cls.DEFAULT_ACHIEVEMENTS],
+                                                             ignore_conflicts=ignore_conflicts)
+
+    @classmethod
+    def create_for_users(cls, user_ids: Iterable[int]) -> List['Profile']:
+        """
+        Пакетное создание профилей (с дефолтными пинами и ачивками) тем юзерам, у которых их еще нет
+        :return: Созданные профили
+        """
+        created = []
+        for shard, shard_user_ids in group_by_shard(set(user_ids)).items():
+            created += cls._create_for_users(shard, set(shard_user_ids))
+        leaderboard.update_many({x.user_id: x.rating for x in created})
+        return created
+
+    @classmethod
+    def _create_for_users(cls, using, user_ids):
+        qs = cls.objects.using(using)
+        with transaction.atomic(using=using):
+            existing = set(qs.filter(user_id__in=user_ids).values_list('user_id', flat=True))
+            missing = sorted(user_ids - existing)
+            if not missing:
+                return []
+            qs.bulk_create([cls(user_id=x) for x in missing], ignore_conflicts=True)
+            # bulk_create возвращает id не на всех базах, поэтому перечитываем. Профиль, который успела создать
+            # параллельная регистрация, уже со своими пинами -- их пропустит ignore_conflicts
+            created = list(qs.filter(user_id__in=missing))
+            cls.create_default_ownership(created, ignore_conflicts=True)
+        return created
+
+    def _owned_ids(self, related_name: str, field: str):
+        # Если связи уже подтянуты через prefetch_related -- в базу не ходим
+        cache = getattr(self, '_prefetched_objects_cache', {})
+        if related_name in cache:
+            return [getattr(x, field) for x in sorted(cache[related_name], key=lambda x: x.id)]
+        return list(getattr(self, related_name).order_by('id').values_list(field, flat=True))
+
+    def _clear_prefetched(self, related_name: str):
+        getattr(self, '_prefetched_objects_cache', {}).pop(related_name, None)
+
     def get_unlocked_pins(self):
-        return [int(x) for x in self.unlocked_pins.split(',')]
+        return self._owned_ids('pins', 'pin_id')
+
+    def has_pin(self, pin_id: int):
+        return self.pins.filter(pin_id=pin_id).exists()
 
-    def add_pin(self, pin_id: int, price: int, save: bool = True):
-        self.unlocked_pins += f',{pin_id}'
-        self.money -= price
-        if save:
-            self.save()
+    def add_pin(self, pin_id: int, price: int):
+        """
+        Покупка пина одним условным UPDATE'ом (денег хватает и пина еще нет) + вставка в таблицу пинов
+        :return: False, если пин уже есть у пользователя или не хватает денег
+        """
+        db = self._state.db
+        owned = UnlockedPin.objects.filter(profile=OuterRef('pk'), pin_id=pin_id)
+        try:
+            with transaction.atomic(using=db):
+                updated = Profile.objects.using(db).filter(~Exists(owned), pk=self.pk, money__gte=price) \
+                    .update(money=F('money') - price)
+                if not updated:
+                    return False
+                # Если параллельный запрос успел купить этот же пин -- упадем на unique и откатим списание денег
+                UnlockedPin.objects.using(db).create(profile=self, pin_id=pin_id)
+                # Остаток читаем в той же транзакции: ошибка чтения откатит покупку, а не спрячет ее результат
+                self.refresh_from_db(using=db, fields=['money'])
+        except IntegrityError:
+            return False
+        self._clear_prefetched('pins')
+        profile_changed(self.user_id, using=db)
+        return True
 
     def get_achievements(self):
-        return [int(x) for x in self.achievements.split(',')]
+        return self._owned_ids('achievements', 'achievement_id')
+
+    def has_achievement(self, achievement_id: int):
+        return self.achievements.filter(achievement_id=achievement_id).exists()
+
+    def add_achievement(self, achievement_id: int):
+        """
+        Выдача ачивки
+        :return: False, если ачивка уже есть у пользователя
+        """
+        try:
+            with transaction.atomic(using=self._state.db):
+                ProfileAchievement.objects.using(self._state.db).create(profile=self, achievement_id=achievement_id)
+        except IntegrityError:
+            return False
+        self._clear_prefetched('achievements')
+        profile_changed(self.user_id, using=self._state.db)
+        return True
+
+    def update_rating(self, d_rating: int, d_money: int = 0):
+        """
+        Изменение рейтинга (не ниже нуля) и денег одним UPDATE'ом без чтения-изменения-записи
+        """
+        fields = {'rating': Greatest(F('rating') + d_rating, 0)}
+        if d_money:
+            fields['money'] = F('money') + d_money
+        Profile.objects.using(self._state.db).filter(pk=self.pk).update(**fields)
+        self.refresh_from_db(fields=['rating', 'money'])
+        leaderboard.update(self.user_id, self.rating)
+        profile_changed(self.user_id, using=self._state.db)
 
-    def add_achievement(self, achievement_id: int, save: bool = True):
-        self.achievements += f',{achievement_id}'
-        if save:
-            self.save()
+    @classmethod
+    def bulk_update_rating(cls, deltas: Dict[int, Tuple[int, int]], floors: Dict[int, int] = None,
+                           batch_id: str = None):
+        """
+        Пакетное изменение рейтинга и денег в одной транзакции на шард, по одному UPDATE'у с CASE на пачку профилей
+        :param deltas: Словарь user_id -> (d_rating, d_money)
+        :param floors: Словарь user_id -> нижняя граница нового рейтинга (по умолчанию 0)
+        :param batch_id: Id пачки: в шард, куда пачка с этим id уже записана, она повторно не пишется
+        :return: Словарь user_id -> (rating, money) после обновления, только для существующих профилей
+        """
+        ret = {}
+        for shard, user_ids in group_by_shard(deltas).items():
+            updated = cls._bulk_update_rating(shard, {x: deltas[x] for x in user_ids}, floors or {}, batch_id)
+            for user_id, (rating, _) in updated.items():
+                leaderboard.update(user_id, rating)
+                profile_changed(user_id, using=shard)
+            ret.update(updated)
+        return ret
 
-    def update_rating(self, d_rating: int, save: bool = True):
-        self.rating = max(self.rating + d_rating, 0)
-        if save:
-            self.save()
+    @classmethod
+    def _bulk_update_rating(cls, using, deltas: Dict[int, Tuple[int, int]], floors: Dict[int, int], batch_id: str):
+        items = list(deltas.items())
+        chunks = [items[i:i + cls.BULK_UPDATE_CHUNK_SIZE] for i in range(0, len(items), cls.BULK_UPDATE_CHUNK_SIZE)]
+        ret = {}
+        with transaction.atomic(using=using):
+            if batch_id is not None:
+                try:
+                    with transaction.atomic(using=using):
+                        RatingBatch.objects.using(using).create(batch_id=batch_id)
+                except IntegrityError:
+                    return ret
+            for chunk in chunks:
+                user_ids = [user_id for user_id, _ in chunk]
+                d_rating = Case(*[When(user_id=user_id, then=Value(d)) for user_id, (d, _) in chunk],
+                                default=Value(0), output_field=models.IntegerField())
+                d_money = Case(*[When(user_id=user_id, then=Value(d)) for user_id, (_, d) in chunk],
+                               default=Value(0), output_field=models.IntegerField())
+                floor = Case(*[When(user_id=user_id, then=Value(floors[user_id])) for user_id in user_ids
+                               if floors.get(user_id)], default=Value(0), output_field=models.IntegerField())
+                cls.objects.using(using).filter(user_id__in=user_ids) \
+                    .update(rating=Greatest(F('rating') + d_rating, floor), money=F('money') + d_money)
+            for chunk in chunks:
+                qs = cls.objects.using(using).filter(user_id__in=[user_id for user_id, _ in chunk])
+                ret.update({user_id: (rating, money) for user_id, rating, money in
+                            qs.values_list('user_id', 'rating', 'money')})
+        return ret
+
+    def get_rank(self):
+        """
+        Место в общем рейтинге (при равном рейтинге место общее)
+        """
+        rank = leaderboard.rank(self.user_id)
+        if rank is None:
+            rank = sum(Profile.objects.using(x).filter(rating__gt=self.rating).count() for x in get_shards()) + 1
+        return rank
+
+    @classmethod
+    def get_top(cls, limit: int):
+        """
+        Топ игроков по рейтингу
+        :return: Список пар (user_id, rating)
+        """
+        top = leaderboard.top(limit)
+        if top is None:
+            # При равном рейтинге -- по user_id: он уникален во всех шардах, и так же сортирует зеркало в редисе
+            top = list(sharded(cls.objects.order_by('-rating', 'user_id').values_list('user_id', 'rating'))[:limit])
+        return top
 
     def __str__(self):
         return f'Profile({self.id}) for user {self.user_id}'
+
+
+class UnlockedPin(models.Model):
+    """
+    Купленный пользователем пин
+    """
+    profile = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='pins')
+    pin_id = models.PositiveIntegerField(null=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['profile', 'pin_id'], name='unique_profile_pin'),
+        ]
+
+    def __str__(self):
+        return f'Pin {self.pin_id} of profile {self.profile_id}'
+
+
+class ProfileAchievement(models.Model):
+    """
+    Полученная пользователем ачивка
+    """
+    profile = models.ForeignKey(Profile, on_delete=models.CASCADE, related_name='achievements')
+    achievement_id = models.PositiveIntegerField(null=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['profile', 'achievement_id'], name='unique_profile_achievement'),
+        ]
+
+    def __str__(self):
+        return f'Achievement {self.achievement_id} of profile {self.profile_id}'
+
+
+class IdempotencyKey(models.Model):
+    """
+    Результат запроса с заголовком Idempotency-Key: повтор с тем же ключом получает сохраненный ответ
+    """
+    KEY_MAX_LENGTH = 255
+
+    # scope вьюхи, аргументы урла и хэш клиента
+    scope = models.CharField(max_length=128, null=False)
+    key = models.CharField(max_length=KEY_MAX_LENGTH, null=False)
+    # HMAC тела запроса: тот же ключ с другим телом -- ошибка клиента
+    fingerprint = models.CharField(max_length=64, null=False)
+    # None -- запрос еще выполняется (in_progress) или упал и ключ свободен для повтора
+    status_code = models.PositiveSmallIntegerField(null=True)
+    in_progress = models.BooleanField(null=False, default=True)
+    response = models.TextField(null=False, default='')
+    # Что упавший запрос успел сделать и повтор делать заново не должен
+    checkpoint = models.TextField(null=False, default='')
+    created_dt = models.DateTimeField(auto_now_add=True)
+    expires_dt = models.DateTimeField(null=False, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['scope', 'key'], name='unique_idempotency_key'),
+        ]
+
+    def __str__(self):
+        return f'Idempotency key {self.key} for {self.scope}'
+
+
+class RatingBatch(models.Model):
+    """
+    Пачка отложенных изменений рейтинга, уже записанная в этот шард (есть в каждом шарде)
+    Пишется в одной транзакции с самими изменениями, так что пачка из журнала после падения не применится дважды
+    """
+    BATCH_ID_MAX_LENGTH = 128
+
+    batch_id = models.CharField(max_length=BATCH_ID_MAX_LENGTH, null=False, unique=True)
+    created_dt = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'Rating batch {self.batch_id}'
@@ -0,0 +1,52 @@
+from django.conf import settings
+from rest_framework.pagination import BasePagination, LimitOffsetPagination, CursorPagination
+from Users import sharding
+
+
+class ProfilesCursorPagination(CursorPagination):
+    """
+    Keyset-пагинация по id: без COUNT(*) и без пропуска строк на глубоких страницах
+    """
+    ordering = 'id'
+    page_size = settings.PROFILES_CURSOR_PAGE_SIZE
+    page_size_query_param = 'limit'
+    max_page_size = settings.PROFILES_CURSOR_MAX_PAGE_SIZE
+
+    def get_ordering(self, request, queryset, view):
+        # id в разных шардах повторяются, а user_id уникален на все шарды
+        if sharding.is_enabled():
+            return ('user_id', )
+        return super().get_ordering(request, queryset, view)
+
+
+class ProfilesListPagination(BasePagination):
+    """
+    Пагинация списка профилей
+    По умолчанию limit/offset (как раньше), курсоры -- если передан ?cursor= или ?pagination=cursor
+    """
+    CURSOR_MODE = 'cursor'
+
+    def __init__(self):
+        self.paginator = None
+
+    def _is_cursor_mode(self, request):
+        params = request.query_params
+        return ProfilesCursorPagination.cursor_query_param in params or params.get('pagination') == self.CURSOR_MODE
+
+    def get_ordering_fields(self, request, view=None) -> tuple:
+        """
+        Поля, которые должны быть в строках страницы: по ним строится курсор
+        """
+        if not self._is_cursor_mode(request):
+            return ()
+        return tuple(x.lstrip('-') for x in ProfilesCursorPagination().get_ordering(request, None, view))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self._is_cursor_mode(request):
+            self.paginator = ProfilesCursorPagination()
+        else:
+            self.paginator = LimitOffsetPagination()
+        return self.paginator.paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        return self.paginator.get_paginated_response(data)
@@ -1,8 +1,22 @@
 from rest_framework.permissions import BasePermission
-from ApiRequesters.Auth.AuthRequester import AuthRequester
-from ApiRequesters.utils import get_token_from_request
-from ApiRequesters.exceptions import BaseApiRequestError
-from Users.models import Profile
+from ApiRequesters.exceptions import BaseApiRequestError, UnexpectedResponse
+from Users.auth import get_auth_context, AuthServiceError
+
+
+class IsAuthenticated(BasePermission):
+    """
+    Пермишн на доступ только аутентифицированным юзерам (информация о юзере кладется в контекст запроса)
+    """
+    def has_permission(self, request, view):
+        try:
+            _ = get_auth_context(request).user_info
+        except UnexpectedResponse as e:
+            if e.code in (401, 403):
+                return False
+            raise AuthServiceError(e)
+        except BaseApiRequestError as e:
+            raise AuthServiceError(e)
+        return True
 
 
 class EditableByMeAndAdminPermission(BasePermission):
@@ -12,9 +26,8 @@ class EditableByMeAndAdminPermission(BasePermission):
     def has_permission(self, request, view):
         if request.method == 'GET':
             return True
-        r = AuthRequester()
         try:
-            _, auth_json = r.get_user_info(get_token_from_request(request))
+            auth_json = get_auth_context(request).user_info
         except BaseApiRequestError:
             return False
         return int(view.kwargs[view.lookup_url_kwarg]) == auth_json['id'] or auth_json['is_superuser']
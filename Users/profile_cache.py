@@ -0,0 +1,156 @@
+import hashlib
+import json
+from typing import Optional
+from django.conf import settings
+from django.db import transaction
+from django.utils.http import quote_etag
+from Users.caches import TTLLRUCache
+
+
+class CachedProfile:
+    """
+    Сериализованный профиль вместе с ETag для условного GET
+    Last-Modified не отдаем: времени изменения профиля в базе нет, а время построения записи с точностью до секунды
+    давало бы ложный 304 на изменение в ту же секунду
+    """
+    def __init__(self, data: dict, etag: str = None):
+        self.data = data
+        self.etag = etag or quote_etag(hashlib.md5(json.dumps(data, sort_keys=True).encode()).hexdigest())
+
+    def to_json(self):
+        return json.dumps({'data': self.data, 'etag': self.etag})
+
+    @classmethod
+    def from_json(cls, raw):
+        obj = json.loads(raw)
+        return cls(obj['data'], obj['etag'])
+
+    @property
+    def headers(self):
+        return {
+            'ETag': self.etag,
+        }
+
+
+class LocMemProfileCacheBackend:
+    """
+    LRU-кэш профилей в памяти процесса
+    Запись сбрасывается только в том процессе, где профиль изменили, поэтому при нескольких воркерах остальные
+    отдают старый профиль до конца TTL. Отсюда свой короткий PROFILE_CACHE_MEMORY_TTL, общий кэш -- это 'redis'
+    """
+    def __init__(self):
+        self._cache = TTLLRUCache(settings.PROFILE_CACHE_SIZE, settings.PROFILE_CACHE_MEMORY_TTL)
+
+    def get(self, key) -> Optional[CachedProfile]:
+        return self._cache.get(key)
+
+    def set(self, key, entry: CachedProfile):
+        self._cache.set(key, entry)
+
+    def delete(self, key):
+        self._cache.delete(key)
+
+    def metrics(self):
+        return self._cache.metrics()
+
+
+class RedisProfileCacheBackend:
+    """
+    Кэш профилей в редисе (общий для всех воркеров)
+    """
+    PREFIX = 'profile:'
+
+    def __init__(self):
+        import redis
+        self._client = redis.Redis.from_url(settings.PROFILE_CACHE_REDIS_URL)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key) -> Optional[CachedProfile]:
+        raw = self._client.get(f'{self.PREFIX}{key}')
+        if raw is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return CachedProfile.from_json(raw)
+
+    def set(self, key, entry: CachedProfile):
+        self._client.set(f'{self.PREFIX}{key}', entry.to_json(), ex=settings.PROFILE_CACHE_TTL)
+
+    def delete(self, key):
+        self._client.delete(f'{self.PREFIX}{key}')
+
+    def metrics(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+class ProfileCache:
+    """
+    Read-through кэш сериализованных профилей по user_id
+    Бэкенд выбирается настройкой PROFILE_CACHE_BACKEND ('memory', 'redis' или None -- кэш выключен)
+    """
+    BACKENDS = {
+        'memory': LocMemProfileCacheBackend,
+        'redis': RedisProfileCacheBackend,
+    }
+
+    def __init__(self):
+        self._backend = None
+        self._backend_settings = None
+
+    @property
+    def backend(self):
+        backend_settings = (settings.PROFILE_CACHE_BACKEND, settings.PROFILE_CACHE_SIZE, settings.PROFILE_CACHE_TTL,
+                            settings.PROFILE_CACHE_MEMORY_TTL)
+        if backend_settings != self._backend_settings:
+            name = settings.PROFILE_CACHE_BACKEND
+            self._backend = self.BACKENDS[name]() if name else None
+            self._backend_settings = backend_settings
+        return self._backend
+
+    def get(self, user_id: int) -> Optional[CachedProfile]:
+        backend = self.backend
+        if backend is None:
+            return None
+        try:
+            return backend.get(user_id)
+        except Exception:
+            # Кэш не источник правды -- при его недоступности просто идем в базу
+            return None
+
+    def set(self, user_id: int, data: dict) -> CachedProfile:
+        entry = CachedProfile(data)
+        backend = self.backend
+        if backend is not None:
+            try:
+                backend.set(user_id, entry)
+            except Exception:
+                pass
+        return entry
+
+    def _delete(self, user_id: int):
+        backend = self.backend
+        if backend is None:
+            return
+        try:
+            backend.delete(user_id)
+        except Exception:
+            pass
+
+    def invalidate(self, user_id: int, using: str = None):
+        """
+        Сброс записи сразу и еще раз после коммита, чтобы параллельное чтение не закэшировало старые данные
+        :param using: База (шард), в транзакции которой изменился профиль
+        """
+        self._delete(user_id)
+        transaction.on_commit(lambda: self._delete(user_id), using=using)
+
+    def metrics(self):
+        backend = self.backend
+        return backend.metrics() if backend is not None else {}
+
+
+profile_cache = ProfileCache()
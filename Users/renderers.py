@@ -0,0 +1,57 @@
+import msgpack
+import orjson
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+from Users.timing import phase
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer на orjson, вывод совпадает с обычным JSONRenderer байт в байт
+    Все, что orjson не умеет так же (отступы, ensure_ascii, неподдерживаемые типы), рендерится обычным JSONRenderer
+    """
+    _encoder = JSONEncoder()
+
+    def _default(self, obj):
+        return self._encoder.default(obj)
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        with phase('serialization'):
+            return self._render(data, accepted_media_type, renderer_context)
+
+    def _render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        if indent is not None or self.ensure_ascii or not self.compact:
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data, default=self._default,
+                               option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS)
+        except TypeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        # Как и JSONRenderer, экранируем \u2028 и \u2029
+        if b'\xe2\x80\xa8' in ret or b'\xe2\x80\xa9' in ret:
+            ret = ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+        return ret
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    Ответы в MessagePack (Accept: application/msgpack или ?format=msgpack)
+    Типы, которых нет в MessagePack (даты, Decimal, UUID), превращаются в то же, что и в JSON
+    """
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+    _encoder = JSONEncoder()
+
+    def _default(self, obj):
+        return self._encoder.default(obj)
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        with phase('serialization'):
+            return msgpack.packb(data, default=self._default, use_bin_type=True)
@@ -0,0 +1,192 @@
+import hashlib
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from typing import List, Optional
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, DEFAULT_DB_ALIAS
+from Users.sharding import is_enabled as sharding_enabled, shard_for
+
+
+# Отставание реплики Postgres в секундах (0, если она догнала мастер или это не реплика)
+POSTGRES_LAG_SQL = '''
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+'''
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class ReplicaMonitor:
+    """
+    Реплики в ротации: отстающие больше чем на REPLICA_MAX_LAG секунд или недоступные из нее выводятся
+    Отставание перепроверяется не чаще раза в REPLICA_LAG_CHECK_INTERVAL секунд
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._replicas = ()
+        self._healthy = []
+        self._checked_at = None
+        self.lags = {}
+
+    def measure_lag(self, alias: str) -> Optional[float]:
+        """
+        :return: Отставание в секундах или None, если до реплики не достучаться
+        """
+        connection = connections[alias]
+        try:
+            if connection.vendor != 'postgresql':
+                # Для остальных баз (SQLite в тестах и локально) отставание не меряем
+                return 0.0
+            with connection.cursor() as cursor:
+                cursor.execute(POSTGRES_LAG_SQL)
+                return float(cursor.fetchone()[0])
+        except Exception:
+            return None
+
+    def check(self):
+        replicas = tuple(settings.DATABASE_REPLICAS)
+        lags = {alias: self.measure_lag(alias) for alias in replicas}
+        self.lags = lags
+        self._healthy = [x for x in replicas if lags[x] is not None and lags[x] <= settings.REPLICA_MAX_LAG]
+        self._replicas = replicas
+        self._checked_at = time.monotonic()
+
+    def _is_stale(self):
+        return self._checked_at is None or self._replicas != tuple(settings.DATABASE_REPLICAS) or \
+            time.monotonic() - self._checked_at >= settings.REPLICA_LAG_CHECK_INTERVAL
+
+    def healthy(self) -> List[str]:
+        if not settings.DATABASE_REPLICAS:
+            return []
+        if self._is_stale():
+            with self._lock:
+                if self._is_stale():
+                    self.check()
+        return self._healthy
+
+    def metrics(self):
+        ret = {
+            'replicas': len(settings.DATABASE_REPLICAS),
+            'in_rotation': len(self._healthy),
+        }
+        ret.update({f'lag_seconds_{alias}': lag for alias, lag in self.lags.items()})
+        return ret
+
+
+replica_monitor = ReplicaMonitor()
+
+
+class _RequestState:
+    __slots__ = ('pinned', 'wrote')
+
+    def __init__(self, pinned: bool):
+        self.pinned = pinned
+        self.wrote = False
+
+
+_state = ContextVar('replica_request_state', default=None)
+
+
+def _pin_key(request) -> Optional[str]:
+    auth = request.META.get('HTTP_AUTHORIZATION')
+    return 'replica_pin:' + hashlib.sha1(auth.encode()).hexdigest() if auth else None
+
+
+@contextmanager
+def replica_request(request):
+    """
+    Границы запроса для ReplicaRouter
+    Пишущие запросы целиком идут в мастер, а после записи запросы того же клиента (по Authorization) еще
+    REPLICA_READ_YOUR_WRITES_WINDOW секунд читают из мастера, чтобы видеть свои изменения
+    Метки лежат в джанговском кэше, так что для нескольких воркеров нужен общий бэкенд кэша
+    """
+    if not settings.DATABASE_REPLICAS:
+        yield None
+        return
+    key = _pin_key(request)
+    pinned = request.method not in SAFE_METHODS or (key is not None and cache.get(key) is not None)
+    state = _RequestState(pinned)
+    token = _state.set(state)
+    try:
+        yield state
+    finally:
+        _state.reset(token)
+        if state.wrote and key is not None:
+            cache.set(key, True, settings.REPLICA_READ_YOUR_WRITES_WINDOW)
+
+
+class ReplicaRouter:
+    """
+    Чтение -- с реплик из DATABASE_REPLICAS (которые не отстают), запись -- в мастер
+    В мастер идет и чтение внутри транзакции и после записи в том же запросе
+    """
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is not None and state.pinned:
+            return DEFAULT_DB_ALIAS
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        replicas = replica_monitor.healthy()
+        return random.choice(replicas) if replicas else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None:
+            state.pinned = state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        aliases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Реплики получают схему репликацией с мастера
+        return False if db in settings.DATABASE_REPLICAS else None
+
+
+class ShardRouter:
+    """
+    Профили с пинами и ачивками лежат в шарде по user_id (DATABASE_SHARDS)
+    Запросы без объекта на руках шард не выбирают -- для них есть Profile.objects.for_user() и sharding.sharded(),
+    а здесь связанные запросы и сохранение объекта идут в базу, где лежит он сам (или его профиль)
+    """
+    SHARDED_MODELS = ('profile', 'unlockedpin', 'profileachievement')
+    # Есть в каждом шарде, но к профилю не привязаны и пишутся только с явным .using()
+    SHARD_LOCAL_MODELS = ('ratingbatch', )
+
+    def _is_sharded(self, model):
+        return model._meta.app_label == 'Users' and model._meta.model_name in self.SHARDED_MODELS
+
+    def _instance_shard(self, instance):
+        if instance._state.db is not None:
+            return instance._state.db
+        if instance._meta.model_name == 'profile':
+            return shard_for(instance.user_id)
+        field = instance._meta.get_field('profile')
+        if field.is_cached(instance):
+            return field.get_cached_value(instance)._state.db
+        return None
+
+    def _route(self, model, **hints):
+        instance = hints.get('instance')
+        if not sharding_enabled() or instance is None or not self._is_sharded(model) or \
+                not self._is_sharded(type(instance)):
+            return None
+        return self._instance_shard(instance)
+
+    db_for_read = _route
+    db_for_write = _route
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # В шардах кроме default лежат только профили с пинами и ачивками (model_name нет у RunPython)
+        if db == DEFAULT_DB_ALIAS or db not in settings.DATABASE_SHARDS:
+            return None
+        return app_label == 'Users' and \
+            (model_name is None or model_name in self.SHARDED_MODELS or model_name in self.SHARD_LOCAL_MODELS)
@@ -1,17 +1,84 @@
+from typing import Optional, Tuple
 from Users.models import Profile
 from rest_framework import serializers
 from rest_framework.validators import UniqueValidator
-from ApiRequesters.Media.MediaRequester import MediaRequester
 from ApiRequesters.utils import get_token_from_request
-from ApiRequesters.exceptions import BaseApiRequestError
+from Users.media import image_validator
+from Users.timing import phase
+from Users.sharding import shard_for
 
 
-class ProfilesListSerializer(serializers.ModelSerializer):
+class ShardUniqueValidator(UniqueValidator):
+    """
+    Проверка уникальности user_id в том шарде, куда попадет профиль
+    """
+    def filter_queryset(self, value, queryset, field_name):
+        return super().filter_queryset(value, queryset.using(shard_for(value)), field_name)
+
+
+class TimedDataMixin:
+    """
+    Замер сериализации (фаза serialization) при обращении к .data
+    """
+    @property
+    def data(self):
+        with phase('serialization'):
+            return super().data
+
+
+class SparseFieldsMixin:
+    """
+    Sparse fieldsets: сериализатор с fields=[...] отдает (и считает, включая method-поля) только эти поля
+    """
+    FIELDS_PARAM = 'fields'
+
+    def __init__(self, *args, fields=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+    @classmethod
+    def get_requested_fields(cls, request) -> Optional[Tuple[str, ...]]:
+        """
+        Поля из ?fields= в порядке полей сериализатора
+        :return: None, если поля не указаны (нужны все)
+        :raises ValidationError: Если запрошено неизвестное поле
+        """
+        raw = request.query_params.get(cls.FIELDS_PARAM, '')
+        requested = {x.strip() for x in raw.split(',') if x.strip()}
+        if not requested:
+            return None
+        unknown = requested - set(cls.Meta.fields)
+        if unknown:
+            raise serializers.ValidationError({cls.FIELDS_PARAM: f'Неизвестные поля: {", ".join(sorted(unknown))}'})
+        return tuple(x for x in cls.Meta.fields if x in requested)
+
+
+class PicIdValidationMixin:
+    """
+    Валидация pic_id через media-сервис (с кэшем), несуществующая картинка превращается в None
+    """
+    def validate_pic_id(self, value: int):
+        if value is None:
+            return value
+        token = get_token_from_request(self.context['request'])
+        return value if image_validator.is_valid(value, token) else None
+
+
+class TimedListSerializer(TimedDataMixin, serializers.ListSerializer):
+    """
+    Списковый сериализатор с замером сериализации
+    """
+    pass
+
+
+class ProfilesListSerializer(TimedDataMixin, PicIdValidationMixin, SparseFieldsMixin, serializers.ModelSerializer):
     """
     Сериализатор спискового представления юзера
     """
     pic_id = serializers.IntegerField(min_value=1, required=False, allow_null=True, default=None)
-    user_id = serializers.IntegerField(min_value=1, validators=[UniqueValidator(queryset=Profile.objects.all())])
+    user_id = serializers.IntegerField(min_value=1, validators=[ShardUniqueValidator(queryset=Profile.objects.all())])
 
     class Meta:
         model = Profile
@@ -20,27 +87,20 @@ class ProfilesListSerializer(serializers.ModelSerializer):
             'user_id',
             'pic_id',
         ]
-
-    def validate_pic_id(self, value: int):
-        if value is None:
-            return value
-        r = MediaRequester()
-        token = get_token_from_request(self.context['request'])
-        try:
-            _ = r.get_image_info(value, token)
-            return value
-        except BaseApiRequestError:
-            return None
+        list_serializer_class = TimedListSerializer
 
     def create(self, validated_data):
         new = Profile.objects.create(**validated_data)
         return new
 
 
-class ProfileSerializer(serializers.ModelSerializer):
+class ProfileSerializer(TimedDataMixin, PicIdValidationMixin, SparseFieldsMixin, serializers.ModelSerializer):
     """
     Сериализатор юзера
     """
+    # Связи, которые нужно подгрузить для method-полей
+    PREFETCH_FIELDS = {'unlocked_pins': 'pins', 'achievements': 'achievements'}
+
     rating = serializers.IntegerField(read_only=True)
     pin_sprite = serializers.IntegerField(required=False)
     money = serializers.IntegerField(read_only=True)
@@ -65,6 +125,7 @@ class ProfileSerializer(serializers.ModelSerializer):
             'pic_id',
             'created_dt',
         ]
+        list_serializer_class = TimedListSerializer
 
     def get_unlocked_pins(self, instance: Profile):
         return instance.get_unlocked_pins()
@@ -72,21 +133,12 @@ class ProfileSerializer(serializers.ModelSerializer):
     def get_achievements(self, instance: Profile):
         return instance.get_achievements()
 
-    def validate_pic_id(self, value: int):
-        if value is None:
-            return value
-        r = MediaRequester()
-        token = get_token_from_request(self.context['request'])
-        try:
-            _ = r.get_image_info(value, token)
-            return value
-        except BaseApiRequestError:
-            return None
-
     def update(self, instance: Profile, validated_data):
         for attr, val in validated_data.items():
             setattr(instance, attr, val)
-        instance.save()
+        # Только измененные поля: деньги и рейтинг меняются условными UPDATE'ами, и старые значения из instance
+        # перетерли бы их параллельные изменения
+        instance.save(update_fields=list(validated_data))
         return instance
 
 
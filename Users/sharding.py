@@ -0,0 +1,159 @@
+import bisect
+import hashlib
+import heapq
+from collections import defaultdict
+from itertools import chain, islice
+from typing import Dict, Iterable, List, Optional
+from django.conf import settings
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Консистентное хэширование: у каждого шарда vnodes точек на кольце, ключ попадает в шард ближайшей точки
+    по часовой стрелке. При добавлении шарда к нему переезжает примерно 1/N ключей, остальные остаются на месте
+    """
+    def __init__(self, nodes: Iterable[str], vnodes: int):
+        self.nodes = tuple(nodes)
+        self.vnodes = vnodes
+        points = sorted((_hash(f'{node}#{i}'), node) for node in self.nodes for i in range(vnodes))
+        self._hashes = [x for x, _ in points]
+        self._nodes = [x for _, x in points]
+
+    def get_node(self, key) -> str:
+        i = bisect.bisect(self._hashes, _hash(str(key))) % len(self._hashes)
+        return self._nodes[i]
+
+
+_ring = None
+
+
+def is_enabled() -> bool:
+    return bool(settings.DATABASE_SHARDS)
+
+
+def get_ring() -> HashRing:
+    global _ring
+    shards = tuple(settings.DATABASE_SHARDS)
+    if _ring is None or _ring.nodes != shards or _ring.vnodes != settings.SHARD_VIRTUAL_NODES:
+        _ring = HashRing(shards, settings.SHARD_VIRTUAL_NODES)
+    return _ring
+
+
+def get_shards() -> List[Optional[str]]:
+    """
+    Алиасы шардов; без шардирования -- [None], то есть базу как обычно выбирают роутеры
+    """
+    return list(settings.DATABASE_SHARDS) or [None]
+
+
+def shard_for(user_id) -> Optional[str]:
+    """
+    Алиас базы, в которой лежит профиль user_id (None без шардирования)
+    """
+    if not is_enabled():
+        return None
+    return get_ring().get_node(int(user_id))
+
+
+def group_by_shard(user_ids: Iterable) -> Dict[Optional[str], list]:
+    """
+    Раскладка user_id по шардам (порядок внутри шарда сохраняется)
+    """
+    ret = defaultdict(list)
+    for user_id in user_ids:
+        ret[shard_for(user_id)].append(user_id)
+    return dict(ret)
+
+
+class ShardedQuerySet:
+    """
+    Один и тот же запрос ко всем шардам: filter/order_by/values применяются к каждому, а итерация и срезы сливают
+    уже отсортированные базами результаты. Этого хватает пагинаторам DRF (count, срезы, filter по курсору)
+    Поля, сортируемые по убыванию, должны быть числовыми, а строки сливаются только по тем полям сортировки,
+    которые есть в выборке
+    """
+    def __init__(self, querysets: Iterable):
+        self.querysets = list(querysets)
+
+    def _chain(self, method: str, *args, **kwargs):
+        return ShardedQuerySet(getattr(qs, method)(*args, **kwargs) for qs in self.querysets)
+
+    def filter(self, *args, **kwargs):
+        return self._chain('filter', *args, **kwargs)
+
+    def exclude(self, *args, **kwargs):
+        return self._chain('exclude', *args, **kwargs)
+
+    def order_by(self, *field_names):
+        return self._chain('order_by', *field_names)
+
+    def values(self, *fields):
+        return self._chain('values', *fields)
+
+    def values_list(self, *fields, **kwargs):
+        return self._chain('values_list', *fields, **kwargs)
+
+    def only(self, *fields):
+        return self._chain('only', *fields)
+
+    def prefetch_related(self, *lookups):
+        return self._chain('prefetch_related', *lookups)
+
+    def count(self) -> int:
+        return sum(qs.count() for qs in self.querysets)
+
+    def exists(self) -> bool:
+        return any(qs.exists() for qs in self.querysets)
+
+    def _sort_key(self, ordering):
+        names = self.querysets[0]._fields
+        fields = [(x.lstrip('-'), x.startswith('-')) for x in ordering]
+        if names:
+            # Сливаем по началу сортировки, которое есть среди выбранных полей
+            known = [name in names for name, _ in fields] + [False]
+            fields = fields[:known.index(False)]
+
+        def get(row, name):
+            if isinstance(row, dict):
+                return row[name]
+            if isinstance(row, tuple):
+                return row[names.index(name)]
+            return getattr(row, name)
+
+        return lambda row: tuple(-get(row, name) if desc else get(row, name) for name, desc in fields)
+
+    def _merge(self, iterables):
+        ordering = self.querysets[0].query.order_by
+        if not ordering:
+            return chain.from_iterable(iterables)
+        return heapq.merge(*iterables, key=self._sort_key(ordering))
+
+    def iterator(self, chunk_size: int = 2000):
+        return self._merge([qs.iterator(chunk_size=chunk_size) for qs in self.querysets])
+
+    def __iter__(self):
+        return iter(self._merge(self.querysets))
+
+    def __getitem__(self, k):
+        if isinstance(k, int):
+            return self[k:k + 1][0]
+        if k.step is not None:
+            raise ValueError('Шаг среза не поддерживается')
+        start, stop = k.start or 0, k.stop
+        if stop is None:
+            return list(islice(iter(self), start, None))
+        # Из каждого шарда хватает первых stop строк
+        return list(islice(self._merge([qs[:stop] for qs in self.querysets]), start, stop))
+
+
+def sharded(queryset):
+    """
+    Запрос по всем шардам (без шардирования -- сам queryset)
+    """
+    if not is_enabled():
+        return queryset
+    return ShardedQuerySet(queryset.using(x) for x in get_shards())
@@ -0,0 +1,120 @@
+import atexit
+from functools import wraps
+from queue import Queue, Full
+from threading import Thread, Lock
+from django.conf import settings
+from ApiRequesters.Stats.decorators import collect_request_stats_decorator as _collect_request_stats_decorator
+from Users.timing import phase
+
+
+class StatsQueue:
+    """
+    Ограниченная очередь событий статистики в памяти процесса
+    Фоновый поток отправляет события по одному, при переполнении события выкидываются
+    Пачками не шлем: у stats-сервиса нет пакетного запроса, так что пачка экономила бы не походы, а только время
+    """
+    def __init__(self):
+        self._queue = None
+        self._thread = None
+        self._lock = Lock()
+        self.enqueued = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            if self._queue is None:
+                self._queue = Queue(maxsize=settings.STATS_QUEUE_SIZE)
+            self._thread = Thread(target=self._run, name='stats-queue', daemon=True)
+            self._thread.start()
+
+    def put(self, event) -> bool:
+        """
+        Кладет событие в очередь, не блокируясь
+        :param event: Функция без аргументов, которая отправляет статистику
+        :return: False, если очередь переполнена и событие выкинуто
+        """
+        self._ensure_started()
+        try:
+            self._queue.put_nowait(event)
+        except Full:
+            self.dropped += 1
+            return False
+        self.enqueued += 1
+        return True
+
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            if send_event(event):
+                self.sent += 1
+            else:
+                self.failed += 1
+            self._queue.task_done()
+
+    def flush(self):
+        """
+        Ждет, пока фоновый поток разберет все, что уже лежит в очереди
+        """
+        if self._queue is not None and self._thread is not None and self._thread.is_alive():
+            self._queue.join()
+
+    def metrics(self):
+        return {
+            'size': self._queue.qsize() if self._queue is not None else 0,
+            'enqueued': self.enqueued,
+            'sent': self.sent,
+            'failed': self.failed,
+            'dropped': self.dropped,
+        }
+
+
+def send_event(event) -> bool:
+    try:
+        event()
+    except Exception:
+        return False
+    return True
+
+
+stats_queue = StatsQueue()
+atexit.register(stats_queue.flush)
+
+
+def collect_request_stats_decorator(another_stats_funcs=None):
+    """
+    Обертка над collect_request_stats_decorator из ApiRequesters с выбором режима через STATS_MODE:
+    sync -- статистика отправляется внутри запроса (как раньше),
+    queue -- отправка уходит в фоновую очередь StatsQueue,
+    off -- статистика не собирается
+    """
+    collect = _collect_request_stats_decorator(another_stats_funcs=another_stats_funcs)
+
+    def decorator(func):
+        @wraps(func)
+        def view(*args, **kwargs):
+            # Внутри фазы stats сама вьюха ставит ее на паузу
+            with phase('app'):
+                return func(*args, **kwargs)
+        collected = collect(view)
+
+        @wraps(func)
+        def wrapper(self, request, *args, **kwargs):
+            mode = settings.STATS_MODE
+            if mode == 'sync':
+                with phase('stats'):
+                    return collected(self, request, *args, **kwargs)
+            result = func(self, request, *args, **kwargs)
+            if mode == 'queue':
+                # Повторяем оригинальный декоратор в фоне, подсунув ему уже посчитанный результат вьюхи
+                replay = collect(lambda *a, **kw: result)
+                with phase('stats'):
+                    stats_queue.put(lambda: replay(self, request, *args, **kwargs))
+            return result[0] if isinstance(result, tuple) else result
+        return wrapper
+    return decorator
@@ -1,5 +1,55 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import StringIO
+from threading import Event, Thread
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from unittest import mock
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
+import types
+import brotli
+import jwt
+import msgpack
+import requests
+from django.db import connection, connections, DatabaseError, OperationalError
+from django.core.cache import cache
+from django.utils import timezone
+from django.test.utils import CaptureQueriesContext
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.exceptions import ImproperlyConfigured
 from TestUtils.models import BaseTestCase
-from Users.models import Profile
+from TestUtils.token import TestToken, TestMockToken
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.testing import HttpCommunicator, WebsocketCommunicator
+from ApiRequesters.exceptions import UnexpectedResponse
+from UsersService.routing import application
+from Users.models import Profile, IdempotencyKey
+from Users.leaderboard import leaderboard
+from Users.auth import AuthRequester, get_token_info_cache, decode_token_locally
+from Users.caches import TTLLRUCache
+from Users.media import image_validator, MediaRequester
+from Users.stats import StatsQueue, stats_queue
+from Users.profile_cache import profile_cache, CachedProfile
+from Users.serializers import ProfileSerializer, ProfilesListSerializer
+from Users.renderers import FastJSONRenderer
+from rest_framework.renderers import JSONRenderer
+from Users.timing import RequestTimings
+from Users.views import SignUpView
+from Users.metrics import request_duration
+from Users.http_pool import pool_stats, pooled_requests, PooledHTTPAdapter, install as install_http_pool
+from Users.db import db_health
+from Users.routers import ReplicaRouter, replica_monitor, replica_request
+from Users.sharding import HashRing, shard_for
+from Users.updates import profile_updates
+from Users.write_behind import RatingBuffer, _Segment
 
 
 class LocalBaseTestCase(BaseTestCase):
@@ -24,6 +74,27 @@ class ProfilesListTestCase(LocalBaseTestCase):
         self.fields_test(response, needed_fields=['id', 'user_id', 'pic_id'], allow_extra_fields=False)
         self.list_test(response, Profile)
 
+    def testGet200_LimitOffset(self):
+        response = self.get_response_and_check_status(url=self.path, data={'limit': 1, 'offset': 0})
+        self.assertEqual(response['count'], Profile.objects.count())
+        self.assertEqual(len(response['results']), 1)
+
+    def testGet200_Cursor(self):
+        for user_id in range(1, 6):
+            Profile.objects.create(user_id=user_id)
+        ids = []
+        data = {'pagination': 'cursor', 'limit': 2}
+        with CaptureQueriesContext(connection) as queries:
+            response = self.get_response_and_check_status(url=self.path, data=data)
+            while True:
+                self.assertNotIn('count', response)
+                ids += [x['id'] for x in response['results']]
+                if not response['next']:
+                    break
+                response = self.get_response_and_check_status(url=response['next'])
+        self.assertEqual(ids, list(Profile.objects.order_by('id').values_list('id', flat=True)))
+        self.assertFalse([x for x in queries.captured_queries if 'COUNT(' in x['sql'].upper()])
+
     def testPost201_OK(self):
         _ = self.post_response_and_check_status(url=self.path, data=self.data_201)
 
@@ -195,3 +266,1630 @@ class ChangeRatingTestCase(LocalBaseTestCase):
         self.token.set_error(self.token.ERRORS_KEYS.APP_AUTH, self.token.ERRORS.BAD_CODE_401_TOKEN)
         _ = self.patch_response_and_check_status(url=self.path, data=self.data_202_1, expected_status_code=[401, 403])
 
+
+class ProfileOwnershipTestCase(LocalBaseTestCase):
+    """
+    Тесты для хранения пинов и ачивок в отдельных таблицах
+    """
+    def testDefaultOwnership(self):
+        self.assertEqual(self.profile.get_unlocked_pins(), list(Profile.DEFAULT_UNLOCKED_PINS))
+        self.assertEqual(self.profile.get_achievements(), list(Profile.DEFAULT_ACHIEVEMENTS))
+
+    def testAddPinKeepsOrderAndRejectsDuplicate(self):
+        self.profile.update_rating(0, d_money=100)
+        self.assertTrue(self.profile.add_pin(5, 10))
+        self.assertFalse(self.profile.add_pin(5, 10))
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.money, 90)
+        self.assertEqual(self.profile.get_unlocked_pins(), list(Profile.DEFAULT_UNLOCKED_PINS) + [5])
+
+    def testAddAchievementRejectsDuplicate(self):
+        self.assertTrue(self.profile.add_achievement(4))
+        self.assertFalse(self.profile.add_achievement(4))
+        self.assertEqual(self.profile.get_achievements(), list(Profile.DEFAULT_ACHIEVEMENTS) + [4])
+
+    def testPrefetchedOwnershipWithoutQueries(self):
+        profile = Profile.objects.prefetch_related('pins', 'achievements').get(id=self.profile.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(profile.get_unlocked_pins(), list(Profile.DEFAULT_UNLOCKED_PINS))
+            self.assertEqual(profile.get_achievements(), list(Profile.DEFAULT_ACHIEVEMENTS))
+
+
+class ProfileContentionTestCase(TransactionTestCase):
+    """
+    Тесты на потерю обновлений при параллельных запросах к одному профилю
+    """
+    # Вне транзакции чтение может уйти на реплики, если они настроены
+    databases = '__all__'
+    THREADS = 8
+
+    def setUp(self):
+        self.profile = Profile.objects.create(user_id=100, money=1000, rating=1000)
+
+    def _run_concurrently(self, func, times: int):
+        def worker(i):
+            try:
+                # У SQLite блокировка на всю таблицу -- просто повторяем, на постгресе до этого не доходит
+                while True:
+                    try:
+                        return func(Profile.objects.get(id=self.profile.id), i)
+                    except OperationalError:
+                        continue
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=self.THREADS) as pool:
+            return list(pool.map(worker, range(times)))
+
+    def testConcurrentRatingAndMoney(self):
+        _ = self._run_concurrently(lambda p, i: p.update_rating(10 if i % 2 else -5, d_money=100), 40)
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.rating, 1000 + 20 * 10 - 20 * 5)
+        self.assertEqual(self.profile.money, 1000 + 40 * 100)
+
+    def testConcurrentBuySamePin(self):
+        results = self._run_concurrently(lambda p, i: p.add_pin(5, 100), 20)
+        self.profile.refresh_from_db()
+        self.assertEqual(results.count(True), 1)
+        self.assertEqual(self.profile.money, 900)
+        self.assertEqual(self.profile.get_unlocked_pins().count(5), 1)
+
+    def testConcurrentBuyDifferentPins(self):
+        results = self._run_concurrently(lambda p, i: p.add_pin(10 + i, 100), 15)
+        self.profile.refresh_from_db()
+        self.assertEqual(results.count(True), 10)
+        self.assertEqual(self.profile.money, 0)
+        self.assertEqual(len(self.profile.get_unlocked_pins()), len(Profile.DEFAULT_UNLOCKED_PINS) + 10)
+
+    def testPatchDuringBuy(self):
+        def patch_or_buy(profile, i):
+            if i % 2:
+                serializer = ProfileSerializer(profile, data={'geopin_sprite': i}, partial=True)
+                serializer.is_valid(raise_exception=True)
+                serializer.save()
+                return None
+            return profile.add_pin(10 + i, 100)
+
+        stale = Profile.objects.get(id=self.profile.id)
+        results = self._run_concurrently(patch_or_buy, 10)
+        # PATCH по профилю, прочитанному до покупок, не должен вернуть списанные деньги
+        patch_or_buy(stale, 1)
+        self.profile.refresh_from_db()
+        self.assertEqual(results.count(True), 5)
+        self.assertEqual(self.profile.money, 500)
+        self.assertEqual(self.profile.geopin_sprite, 1)
+
+
+class LeaderboardTestCase(LocalBaseTestCase):
+    """
+    Тесты для /profiles/leaderboard/ и /profiles/<id>/rank/
+    """
+    def setUp(self):
+        super().setUp()
+        for user_id, d_rating in ((1, 50), (2, 300), (3, 50), (4, 10)):
+            Profile.objects.create(user_id=user_id).update_rating(d_rating)
+        self.path = self.path_prefix + 'leaderboard/'
+
+    def _check_leaderboard(self):
+        response = self.get_response_and_check_status(url=self.path, data={'limit': 4})
+        self.assertEqual([x['rating'] for x in response], [300, 50, 50, 10])
+        self.assertEqual([x['rank'] for x in response], [1, 2, 2, 4])
+        # При равном рейтинге -- по возрастанию user_id и в базе, и в зеркале
+        self.assertEqual([x['user_id'] for x in response], [2, 1, 3, 4])
+        response = self.get_response_and_check_status(url=self.path_prefix + '3/rank/')
+        self.assertEqual(response['rank'], 2)
+        Profile.objects.get(user_id=4).update_rating(1000)
+        response = self.get_response_and_check_status(url=self.path_prefix + '2/rank/')
+        self.assertEqual(response['rank'], 2)
+
+    def testGet200_Database(self):
+        self._check_leaderboard()
+
+    @override_settings(LEADERBOARD_REDIS_URL='memory://')
+    def testGet200_Mirror(self):
+        leaderboard.rebuild(Profile.objects.values_list('user_id', 'rating'))
+        self._check_leaderboard()
+        Profile.objects.get(user_id=2).delete()
+        self.assertIsNone(leaderboard.rank(2))
+
+    @override_settings(LEADERBOARD_REDIS_URL='memory://')
+    def testGet200_MirrorNotPopulated(self):
+        leaderboard.client.delete(leaderboard.KEY, leaderboard.POPULATED_KEY)
+        # Зеркало включили без rebuild_leaderboard: в нем только что обновленный игрок, читать из него нельзя
+        Profile.objects.get(user_id=4).update_rating(5)
+        self.assertIsNone(leaderboard.top(4))
+        response = self.get_response_and_check_status(url=self.path, data={'limit': 4})
+        self.assertEqual([x['user_id'] for x in response], [2, 1, 3, 4])
+        call_command('rebuild_leaderboard', stdout=StringIO())
+        self.assertEqual(leaderboard.top(2), [(2, 300), (1, 50)])
+
+    @override_settings(LEADERBOARD_REDIS_URL='memory://')
+    def testWriteFailureStopsMirrorReads(self):
+        call_command('rebuild_leaderboard', stdout=StringIO())
+        with mock.patch.object(leaderboard.client, 'zadd', side_effect=ConnectionError):
+            Profile.objects.get(user_id=4).update_rating(500)
+        # Зеркало отстало от базы: читается база, пока его не перезальют
+        self.assertFalse(leaderboard.populated)
+        self.assertIsNone(leaderboard.top(1))
+        response = self.get_response_and_check_status(url=self.path, data={'limit': 1})
+        self.assertEqual([x['user_id'] for x in response], [4])
+        call_command('rebuild_leaderboard', stdout=StringIO())
+        self.assertEqual(leaderboard.top(1), [(4, 510)])
+
+    def testGet400_WrongLimit(self):
+        _ = self.get_response_and_check_status(url=self.path, data={'limit': 'a'}, expected_status_code=400)
+        _ = self.get_response_and_check_status(url=self.path, data={'limit': 0}, expected_status_code=400)
+
+    def testGet404_WrongId(self):
+        _ = self.get_response_and_check_status(url=self.path_prefix + '1000/rank/', expected_status_code=404)
+
+
+class AuthContextTestCase(LocalBaseTestCase):
+    """
+    Тесты на количество походов в auth-сервис за один запрос
+    """
+    def setUp(self):
+        super().setUp()
+        self.profile = Profile.objects.create(user_id=1)
+        self.detail_path = self.path_prefix + f'{self.profile.user_id}/'
+
+    def _count_auth_calls(self, func, *args, **kwargs):
+        with mock.patch.object(AuthRequester, 'get_user_info', autospec=True,
+                               side_effect=AuthRequester.get_user_info) as get_user_info:
+            _ = func(*args, **kwargs)
+        return get_user_info.call_count
+
+    def testProfilesListPost_OneCall(self):
+        self.profile.delete()
+        calls = self._count_auth_calls(self.post_response_and_check_status, url=self.path_prefix, data={})
+        self.assertEqual(calls, 1)
+
+    def testProfilesListGet_OneCall(self):
+        calls = self._count_auth_calls(self.get_response_and_check_status, url=self.path_prefix)
+        self.assertEqual(calls, 1)
+
+    def testProfileGet_NoCalls(self):
+        calls = self._count_auth_calls(self.get_response_and_check_status, url=self.detail_path)
+        self.assertEqual(calls, 0)
+
+    def testProfilePatch_OneCall(self):
+        calls = self._count_auth_calls(self.patch_response_and_check_status, url=self.detail_path,
+                                       data={'pin_sprite': 2})
+        self.assertEqual(calls, 1)
+
+    def testProfileDelete_OneCall(self):
+        calls = self._count_auth_calls(self.delete_response_and_check_status, url=self.detail_path)
+        self.assertEqual(calls, 1)
+
+
+class TTLLRUCacheTestCase(TestCase):
+    """
+    Тесты для TTLLRUCache
+    """
+    def setUp(self):
+        self.now = 0
+        self.cache = TTLLRUCache(maxsize=2, ttl=10, timer=lambda: self.now)
+
+    def testEviction(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.cache.set('c', 3)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.metrics()['evictions'], 1)
+        self.assertEqual(self.cache.metrics()['size'], 2)
+
+    def testExpiration(self):
+        self.cache.set('a', 1)
+        self.now = 11
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(self.cache.metrics()['expirations'], 1)
+
+    def testHitRatio(self):
+        self.cache.set('a', 1)
+        _ = self.cache.get('a')
+        _ = self.cache.get('b')
+        self.assertEqual(self.cache.hit_ratio, 0.5)
+
+
+class TokenInfoTestCase(LocalBaseTestCase):
+    """
+    Тесты на локальную проверку JWT и кэш информации о токенах
+    """
+    def setUp(self):
+        super().setUp()
+        self.profile = Profile.objects.create(user_id=1)
+        self.path = self.path_prefix + f'{self.profile.user_id}/'
+        get_token_info_cache().clear()
+
+    def _patch_auth(self):
+        return mock.patch.object(AuthRequester, 'get_user_info', autospec=True,
+                                 side_effect=AuthRequester.get_user_info)
+
+    @override_settings(AUTH_JWT_VERIFY_KEY='secret')
+    def testLocalJwt_NoAuthCalls(self):
+        self.token = TestToken(jwt.encode({'user_id': self.profile.user_id, 'is_superuser': False,
+                                           'token_type': 'access'}, 'secret', algorithm='HS256').decode())
+        with self._patch_auth() as get_user_info:
+            _ = self.patch_response_and_check_status(url=self.path, data={'pin_sprite': 2})
+        self.assertEqual(get_user_info.call_count, 0)
+
+    @override_settings(AUTH_JWT_VERIFY_KEY='secret')
+    def testLocalJwt_Fallback(self):
+        wrong_key = jwt.encode({'user_id': 1, 'is_superuser': False}, 'not-secret', algorithm='HS256').decode()
+        no_claims = jwt.encode({'user_id': 1}, 'secret', algorithm='HS256').decode()
+        self.assertIsNone(decode_token_locally(wrong_key))
+        self.assertIsNone(decode_token_locally(no_claims))
+        self.assertIsNone(decode_token_locally(self.token.token))
+
+    @override_settings(AUTH_JWT_VERIFY_KEY='secret', AUTH_JWT_AUDIENCE='users', AUTH_JWT_ISSUER='auth')
+    def testLocalJwt_TypeAudienceIssuer(self):
+        claims = {'user_id': 1, 'is_superuser': False, 'token_type': 'access', 'aud': 'users', 'iss': 'auth'}
+
+        def encode(**kwargs):
+            return jwt.encode(dict(claims, **kwargs), 'secret', algorithm='HS256').decode()
+
+        self.assertEqual(decode_token_locally(encode()), {'id': 1, 'is_superuser': False})
+        self.assertIsNone(decode_token_locally(encode(token_type='refresh')))
+        self.assertIsNone(decode_token_locally(encode(aud='media')))
+        self.assertIsNone(decode_token_locally(encode(iss='other')))
+        with override_settings(AUTH_JWT_AUDIENCE=None, AUTH_JWT_ISSUER=None):
+            self.assertIsNone(decode_token_locally(jwt.encode({'user_id': 1, 'is_superuser': False}, 'secret',
+                                                              algorithm='HS256').decode()))
+
+    @override_settings(AUTH_TOKEN_CACHE_TTL=60)
+    def testCachedTokenInfo(self):
+        with self._patch_auth() as get_user_info:
+            _ = self.patch_response_and_check_status(url=self.path, data={'pin_sprite': 2})
+            _ = self.patch_response_and_check_status(url=self.path, data={'pin_sprite': 3})
+        self.assertEqual(get_user_info.call_count, 1)
+        self.assertEqual(get_token_info_cache().metrics()['hits'], 1)
+
+
+class ImageValidationTestCase(LocalBaseTestCase):
+    """
+    Тесты на кэширование проверки pic_id
+    """
+    def setUp(self):
+        super().setUp()
+        image_validator.cache.clear()
+
+    def _patch_media(self):
+        return mock.patch.object(MediaRequester, 'get_image_info', autospec=True,
+                                 side_effect=MediaRequester.get_image_info)
+
+    def testCachedValidation(self):
+        with self._patch_media() as get_image_info:
+            self.assertTrue(image_validator.is_valid(1, self.token.token))
+            self.assertTrue(image_validator.is_valid(1, self.token.token))
+        self.assertEqual(get_image_info.call_count, 1)
+
+    def testOnlyNotFoundCachedAsInvalid(self):
+        for code in (401, 403, 500):
+            with mock.patch.object(MediaRequester, 'get_image_info', side_effect=UnexpectedResponse({}, code)):
+                self.assertFalse(image_validator.is_valid(1, self.token.token))
+            # Чужой токен или сбой media-сервиса не должны сделать картинку невалидной для всех
+            self.assertIsNone(image_validator.cache.get(1))
+        with mock.patch.object(MediaRequester, 'get_image_info', side_effect=UnexpectedResponse({}, 404)):
+            self.assertFalse(image_validator.is_valid(1, self.token.token))
+        self.assertIs(image_validator.cache.get(1), False)
+
+    def testPatchProfile_CachedPicId(self):
+        path = self.path_prefix + '1/'
+        _ = Profile.objects.create(user_id=1)
+        with self._patch_media() as get_image_info:
+            _ = self.patch_response_and_check_status(url=path, data={'pic_id': 5})
+            _ = self.patch_response_and_check_status(url=path, data={'pic_id': 5})
+        self.assertEqual(get_image_info.call_count, 1)
+
+
+class ProfilesBatchTestCase(LocalBaseTestCase):
+    """
+    Тесты для /profiles/batch/
+    """
+    def setUp(self):
+        super().setUp()
+        self.path = self.path_prefix + 'batch/'
+        for user_id in range(1, 4):
+            Profile.objects.create(user_id=user_id)
+
+    def testGet200_OK(self):
+        response = self.get_response_and_check_status(url=self.path, data={'user_ids': '1,2,3,1000'})
+        self.assertEqual(set(response['profiles'].keys()), {'1', '2', '3'})
+        self.assertEqual(response['missing'], [1000])
+        self.fields_test(list(response['profiles'].values()),
+                         needed_fields=['id', 'user_id', 'pin_sprite', 'geopin_sprite', 'created_dt',
+                                        'unlocked_pins', 'pic_id', 'achievements', 'money', 'rating'],
+                         allow_extra_fields=False)
+
+    def testPost200_OK(self):
+        response = self.post_response_and_check_status(url=self.path, data={'user_ids': [1, 2]},
+                                                       expected_status_code=200)
+        self.assertEqual(set(response['profiles'].keys()), {'1', '2'})
+        self.assertEqual(response['missing'], [])
+
+    def testGet200_ConstantQueries(self):
+        with self.assertNumQueries(3):
+            _ = self.get_response_and_check_status(url=self.path, data={'user_ids': '1,2,3'})
+
+    def testGet400_WrongIds(self):
+        _ = self.get_response_and_check_status(url=self.path, data={'user_ids': '1,a'}, expected_status_code=400)
+        _ = self.get_response_and_check_status(url=self.path, expected_status_code=400)
+
+    @override_settings(PROFILES_BATCH_MAX_SIZE=2)
+    def testGet400_TooManyIds(self):
+        _ = self.get_response_and_check_status(url=self.path, data={'user_ids': '1,2,3'}, expected_status_code=400)
+
+
+class BulkChangeRatingTestCase(LocalBaseTestCase):
+    """
+    Тесты для /profiles/update_rating/
+    """
+    def setUp(self):
+        super().setUp()
+        self.path = self.path_prefix + 'update_rating/'
+        self.other = Profile.objects.create(user_id=101, rating=50)
+        self.data_202 = {
+            'updates': [
+                {'user_id': self.profile.user_id, 'd_rating': 30},
+                {'user_id': self.other.user_id, 'd_rating': -100},
+                {'user_id': 1000, 'd_rating': 10},
+                {'d_rating': 10},
+                {'user_id': self.profile.user_id, 'd_rating': 5},
+            ],
+        }
+
+    def testPost202_PartialFailure(self):
+        response = self.post_response_and_check_status(url=self.path, data=self.data_202, expected_status_code=202)
+        self.assertEqual(response['failed'], 2)
+        self.assertEqual([('error' in x) for x in response['results']], [False, False, True, True, False])
+        self.profile.refresh_from_db()
+        self.other.refresh_from_db()
+        self.assertEqual((self.profile.rating, self.profile.money), (35, 2 * Profile.MATCH_REWARD))
+        self.assertEqual((self.other.rating, self.other.money), (0, Profile.MATCH_REWARD))
+        self.assertEqual(response['results'][0]['rating'], 35)
+
+    def testPost400_WrongJSON(self):
+        _ = self.post_response_and_check_status(url=self.path, data={}, expected_status_code=400)
+
+    def testPost401_403_WrongAppToken(self):
+        self.token.set_error(self.token.ERRORS_KEYS.APP_AUTH, self.token.ERRORS.BAD_CODE_401_TOKEN)
+        _ = self.post_response_and_check_status(url=self.path, data=self.data_202, expected_status_code=[401, 403])
+
+
+@override_settings(STATS_QUEUE_SIZE=2)
+class StatsQueueTestCase(TestCase):
+    """
+    Тесты для фоновой очереди статистики
+    """
+    def setUp(self):
+        self.queue = StatsQueue()
+        self.sent = []
+
+    def testDropWhenFull(self):
+        started, release = Event(), Event()
+
+        def blocker():
+            started.set()
+            release.wait(5)
+
+        self.assertTrue(self.queue.put(blocker))
+        self.assertTrue(started.wait(5))
+        self.assertTrue(self.queue.put(lambda: self.sent.append(1)))
+        self.assertTrue(self.queue.put(lambda: self.sent.append(2)))
+        self.assertFalse(self.queue.put(lambda: self.sent.append(3)))
+        release.set()
+        self.queue.flush()
+        self.assertEqual(self.sent, [1, 2])
+        self.assertEqual(self.queue.metrics()['dropped'], 1)
+        self.assertEqual(self.queue.metrics()['sent'], 3)
+
+    def testFailedEventsCounted(self):
+        self.queue.put(lambda: 1 / 0)
+        self.queue.put(lambda: self.sent.append(1))
+        self.queue.flush()
+        self.assertEqual(self.sent, [1])
+        self.assertEqual(self.queue.metrics()['failed'], 1)
+
+
+class QueuedStatsTestCase(LocalBaseTestCase):
+    """
+    Тесты на отправку статистики вьюх через фоновую очередь
+    """
+    def setUp(self):
+        super().setUp()
+        self.path = self.path_prefix + f'{self.profile.user_id}/add_achievement/'
+
+    @override_settings(STATS_MODE='queue')
+    def testPost201_Queued(self):
+        enqueued = stats_queue.metrics()['enqueued']
+        _ = self.post_response_and_check_status(url=self.path, data={'achievement_id': 2})
+        stats_queue.flush()
+        self.assertEqual(stats_queue.metrics()['enqueued'], enqueued + 1)
+
+    @override_settings(STATS_MODE='off')
+    def testPost201_Off(self):
+        enqueued = stats_queue.metrics()['enqueued']
+        _ = self.post_response_and_check_status(url=self.path, data={'achievement_id': 2})
+        self.assertEqual(stats_queue.metrics()['enqueued'], enqueued)
+
+
+@override_settings(PROFILE_CACHE_BACKEND='memory')
+class ProfileCacheTestCase(LocalBaseTestCase):
+    """
+    Тесты на кэш профилей и условный GET /profiles/<id>/
+    """
+    def setUp(self):
+        super().setUp()
+        self.path = self.path_prefix + f'{self.profile.user_id}/'
+        profile_cache.invalidate(self.profile.user_id)
+
+    def _get(self, **headers):
+        client = self._get_api_client()
+        client.credentials(HTTP_AUTHORIZATION=self.token.token)
+        return client.get(self.path, **headers)
+
+    def testGet200_FromCache(self):
+        first = self._get()
+        self.assertEqual(first.status_code, 200)
+        self.assertIn('ETag', first)
+        self.assertNotIn('Last-Modified', first)
+        with self.assertNumQueries(0):
+            second = self._get()
+        self.assertEqual(second.json(), first.json())
+
+    def testGet304_NotModified(self):
+        etag = self._get()['ETag']
+        with self.assertNumQueries(0):
+            response = self._get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # Без точного времени изменения If-Modified-Since не поддерживаем (иначе ложный 304 в ту же секунду)
+        self.assertEqual(self._get(HTTP_IF_MODIFIED_SINCE='Wed, 01 Jan 2100 00:00:00 GMT').status_code, 200)
+
+    def testInvalidateOnShardCommit(self):
+        with mock.patch('Users.profile_cache.transaction.on_commit') as on_commit:
+            profile_cache.invalidate(self.profile.user_id, using='shard_1')
+        self.assertEqual(on_commit.call_args[1], {'using': 'shard_1'})
+
+    @override_settings(DATABASE_REPLICAS=['replica_lagging'])
+    def testCacheFilledFromPrimary(self):
+        with mock.patch('Users.routers.ReplicaRouter.db_for_read', return_value='replica_lagging') as db_for_read:
+            response = self._get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['user_id'], self.profile.user_id)
+        db_for_read.assert_not_called()
+
+    @override_settings(PROFILE_CACHE_MEMORY_TTL=0)
+    def testMemoryTTL(self):
+        _ = self._get()
+        with CaptureQueriesContext(connection) as queries:
+            _ = self._get()
+        self.assertTrue(queries.captured_queries)
+
+    def testWriteInvalidates(self):
+        etag = self._get()['ETag']
+        self.profile.update_rating(10)
+        response = self._get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['rating'], 10)
+        self.assertTrue(self.profile.add_achievement(5))
+        self.assertIn(5, self._get().json()['achievements'])
+        self.profile.delete()
+        self.assertEqual(self._get().status_code, 404)
+
+
+class FastSerializationTestCase(LocalBaseTestCase):
+    """
+    Тесты на быстрый путь чтения: JSON должен совпадать с обычными сериализаторами байт в байт
+    """
+    def setUp(self):
+        super().setUp()
+        profile_cache.invalidate(self.profile.user_id)
+        self.profile.add_achievement(7)
+        self.profile.add_pin(5, 0)
+        Profile.objects.create(user_id=101, pic_id=3)
+
+    def _get_raw(self, url, data=None):
+        client = self._get_api_client()
+        client.credentials(HTTP_AUTHORIZATION=self.token.token)
+        response = client.get(url, data=data)
+        self.assertEqual(response.status_code, 200)
+        return response.content
+
+    def testListParity(self):
+        expected = JSONRenderer().render(ProfilesListSerializer(instance=Profile.objects.all(), many=True).data)
+        self.assertEqual(self._get_raw(self.path_prefix), expected)
+
+    def testDetailParity(self):
+        profile = Profile.objects.get(user_id=self.profile.user_id)
+        expected = JSONRenderer().render(ProfileSerializer(instance=profile).data)
+        self.assertEqual(self._get_raw(self.path_prefix + f'{self.profile.user_id}/'), expected)
+
+    def testDetail404(self):
+        client = self._get_api_client()
+        client.credentials(HTTP_AUTHORIZATION=self.token.token)
+        self.assertEqual(client.get(self.path_prefix + '100500/').status_code, 404)
+
+    def testRendererParity(self):
+        data = {
+            'text': 'строка \u2028 \u2029 "кавычки"',
+            'dt': self.profile.created_dt,
+            'list': [1, None, True, 1.5],
+            'nested': {'id': 1},
+        }
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(FastJSONRenderer().render({'big': 2 ** 70}), JSONRenderer().render({'big': 2 ** 70}))
+
+
+class SparseFieldsTestCase(LocalBaseTestCase):
+    """
+    Тесты на ?fields=: в ответе только запрошенные поля, а из базы читаются только их колонки
+    """
+    def setUp(self):
+        super().setUp()
+        profile_cache.invalidate(self.profile.user_id)
+        self.profile.add_pin(5, 0)
+        self.profile.add_achievement(7)
+        self.profile.update_rating(10, 30)
+
+    def _get(self, url, fields, **data):
+        client = self._get_api_client()
+        client.credentials(HTTP_AUTHORIZATION=self.token.token)
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url, data=dict(data, fields=fields))
+        return response, [x['sql'] for x in queries.captured_queries]
+
+    @staticmethod
+    def _columns(sql):
+        return re.findall(r'"Users_profile"\."(\w+)"', sql.split(' FROM ')[0])
+
+    def testDetail(self):
+        url = self.path_prefix + f'{self.profile.user_id}/'
+        response, queries = self._get(url, 'money,rating')
+        self.assertEqual(response.json(), {'rating': 10, 'money': 30})
+        # Одна узкая выборка, без запросов за пинами и ачивками
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(self._columns(queries[0]), ['rating', 'money'])
+        response, queries = self._get(url, 'achievements')
+        self.assertEqual(response.json(), {'achievements': [1, 7]})
+        self.assertEqual(self._columns(queries[0]), ['id'])
+        self.assertNotIn('Users_unlockedpin', ' '.join(queries))
+
+    @override_settings(PROFILE_CACHE_BACKEND='memory')
+    def testDetailFromCache(self):
+        url = self.path_prefix + f'{self.profile.user_id}/'
+        full, _ = self._get(url, '')
+        self.assertEqual(full.status_code, 200)
+        response, queries = self._get(url, 'unlocked_pins,user_id')
+        self.assertEqual(queries, [])
+        self.assertEqual(response.json(), {'user_id': self.profile.user_id, 'unlocked_pins': [1, 2, 5]})
+        self.assertNotEqual(response['ETag'], full['ETag'])
+
+    def testUnknownField400(self):
+        response, _ = self._get(self.path_prefix + f'{self.profile.user_id}/', 'money,password')
+        self.assertEqual(response.status_code, 400)
+        response, _ = self._get(self.path_prefix, 'pin_sprite')
+        self.assertEqual(response.status_code, 400)
+
+    def testList(self):
+        _ = Profile.objects.create(user_id=101)
+        response, queries = self._get(self.path_prefix, 'user_id')
+        self.assertEqual(response.json(), [{'user_id': 100}, {'user_id': 101}])
+        self.assertEqual(self._columns(queries[-1]), ['user_id'])
+        # Курсору нужна колонка сортировки, но в ответ она не попадает
+        client = self._get_api_client()
+        client.credentials(HTTP_AUTHORIZATION=self.token.token)
+        response = client.get(self.path_prefix, data={'fields': 'pic_id', 'pagination': 'cursor', 'limit': 1})
+        self.assertEqual(response.json()['results'], [{'pic_id': None}])
+        self.assertEqual(client.get(response.json()['next']).json()['results'], [{'pic_id': None}])
+
+    def testBatch(self):
+        response, queries = self._get(self.path_prefix + 'batch/', 'money,unlocked_pins', user_ids='100')
+        self.assertEqual(response.json()['profiles'], {'100': {'money': 30, 'unlocked_pins': [1, 2, 5]}})
+        self.assertEqual(len(queries), 2)
+        self.assertEqual(self._columns(queries[0]), ['id', 'user_id', 'money'])
+        self.assertIn('Users_unlockedpin', queries[1])
+
+
+class ResponseFormatsTestCase(LocalBaseTestCase):
+    """
+    Тесты на MessagePack, быстрый JSON-парсер и сжатие ответов
+    """
+    def setUp(self):
+        super().setUp()
+        self.client = self._get_api_client()
+        self.client.credentials(HTTP_AUTHORIZATION=self.token.token)
+        self.detail_path = self.path_prefix + f'{self.profile.user_id}/'
+
+    def testMessagePackResponse(self):
+        for path in [self.path_prefix, self.detail_path]:
+            response = self.client.get(path, HTTP_ACCEPT='application/msgpack')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response['Content-Type'], 'application/msgpack')
+            self.assertEqual(msgpack.unpackb(response.content), self.client.get(path).json())
+        self.assertEqual(self.client.get(self.detail_path, data={'format': 'msgpack'})['Content-Type'],
+                         'application/msgpack')
+
+    def testMessagePackRequest(self):
+        body = msgpack.packb({'updates': [{'user_id': self.profile.user_id, 'd_rating': 30}]})
+        response = self.client.post(self.path_prefix + 'update_rating/', body, content_type='application/msgpack')
+        self.assertEqual(response.status_code, 202)
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.rating, 30)
+        response = self.client.post(self.path_prefix + 'update_rating/', b'\xc1', content_type='application/msgpack')
+        self.assertEqual(response.status_code, 400)
+
+    def testFastJSONParser400(self):
+        response = self.client.post(self.path_prefix + 'update_rating/', b'{"updates": [',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('JSON parse error', response.json()['detail'])
+
+    @override_settings(RESPONSE_COMPRESSION_MIN_SIZE=100)
+    def testGzip(self):
+        for user_id in range(1, 20):
+            Profile.objects.create(user_id=user_id)
+        plain = self.client.get(self.path_prefix)
+        self.assertNotIn('Content-Encoding', plain)
+        self.assertIn('Accept-Encoding', plain['Vary'])
+        response = self.client.get(self.path_prefix, HTTP_ACCEPT_ENCODING='br;q=0, gzip;q=0.5')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+        self.assertLess(len(response.content), len(plain.content))
+        self.assertEqual(int(response['Content-Length']), len(response.content))
+        # Меньше порога и без gzip в Accept-Encoding не сжимаем
+        response = self.client.get(self.path_prefix, HTTP_ACCEPT_ENCODING='gzip;q=0, identity')
+        self.assertNotIn('Content-Encoding', response)
+        with override_settings(RESPONSE_COMPRESSION_MIN_SIZE=100000):
+            self.assertNotIn('Content-Encoding', self.client.get(self.path_prefix, HTTP_ACCEPT_ENCODING='gzip'))
+
+    @override_settings(RESPONSE_COMPRESSION_MIN_SIZE=100)
+    def testBrotli(self):
+        for user_id in range(1, 20):
+            Profile.objects.create(user_id=user_id)
+        plain = self.client.get(self.path_prefix)
+        response = self.client.get(self.path_prefix, HTTP_ACCEPT_ENCODING='br;q=1.0, gzip;q=0.5')
+        self.assertEqual(response['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(response.content), plain.content)
+
+    @override_settings(RESPONSE_COMPRESSION_MIN_SIZE=1, PROFILE_CACHE_BACKEND='memory')
+    def testGzipConditionalGet(self):
+        profile_cache.invalidate(self.profile.user_id)
+        response = self.client.get(self.detail_path, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertTrue(response['ETag'].startswith('W/"'))
+        response = self.client.get(self.detail_path, HTTP_ACCEPT_ENCODING='gzip', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+
+class RequestTimingTestCase(LocalBaseTestCase):
+    """
+    Тесты на замер фаз запроса (Server-Timing) и /metrics
+    """
+    def setUp(self):
+        super().setUp()
+        self.path = self.path_prefix + f'{self.profile.user_id}/'
+        profile_cache.invalidate(self.profile.user_id)
+        request_duration.clear()
+
+    def _server_timing(self, response):
+        ret = {}
+        for item in response['Server-Timing'].split(', '):
+            name, *params = item.split(';')
+            ret[name] = dict(x.split('=', 1) for x in params)
+        return ret
+
+    def testServerTimingHeader(self):
+        self.token.set_role(self.token.ROLES.SUPERUSER)
+        client = self._get_api_client()
+        client.credentials(HTTP_AUTHORIZATION=self.token.token)
+        response = client.patch(self.path, data={'pin_sprite': 3}, format='json')
+        self.assertEqual(response.status_code, 202)
+        timing = self._server_timing(response)
+        self.assertEqual(set(timing), set(RequestTimings.PHASES) | {'app', 'total'})
+        self.assertNotEqual(timing['db']['desc'], '"0 queries"')
+        measured = sum(float(x['dur']) for name, x in timing.items() if name != 'total')
+        self.assertAlmostEqual(measured, float(timing['total']['dur']), delta=0.01)
+
+    @override_settings(REQUEST_TIMING_ENABLED=False)
+    def testDisabled(self):
+        client = self._get_api_client()
+        client.credentials(HTTP_AUTHORIZATION=self.token.token)
+        self.assertNotIn('Server-Timing', client.get(self.path))
+
+    def testNestedPhasesDoNotOverlap(self):
+        with mock.patch('Users.timing.time.perf_counter', side_effect=[0, 1, 3, 6, 7, 10]):
+            timings = RequestTimings()
+            with timings.phase('stats'):
+                with timings.phase('db'):
+                    pass
+            timings.finish()
+        self.assertEqual(timings.phases['stats'], 3)
+        self.assertEqual(timings.phases['db'], 3)
+        self.assertEqual(timings.phases['app'], 4)
+        self.assertEqual(timings.total, 10)
+
+    @override_settings(METRICS_TOKEN='metrics-secret')
+    def testMetricsEndpoint(self):
+        _ = self.get_response_and_check_status(url=self.path)
+        response = self._get_api_client().get('/metrics/', HTTP_AUTHORIZATION='Bearer metrics-secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        content = response.content.decode()
+        self.assertIn('users_request_duration_seconds_count{view="ProfileDetailView",status="200"} 1', content)
+        self.assertIn('users_request_phase_duration_seconds_bucket{view="ProfileDetailView",status="200",'
+                      'phase="db",le="+Inf"} 1', content)
+        self.assertIn('users_stats_queue_dropped', content)
+
+    @override_settings(METRICS_TOKEN='metrics-secret', METRICS_ALLOWED_IPS=['10.0.0.1'])
+    def testMetricsProtected(self):
+        client = self._get_api_client()
+        self.assertEqual(client.get('/metrics/').status_code, 403)
+        self.assertEqual(client.get('/metrics/', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.assertEqual(client.get('/metrics/', REMOTE_ADDR='10.0.0.1').status_code, 200)
+
+
+class _KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        body = json.dumps({'cookie': self.headers.get('Cookie')}).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Set-Cookie', 'sessionid=secret')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class HttpPoolTestCase(TestCase):
+    """
+    Тесты на общую сессию с keep-alive для запросов в другие сервисы
+    """
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), _KeepAliveHandler)
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def testConnectionReused(self):
+        before = pool_stats.metrics()
+        for _ in range(5):
+            response = pooled_requests.get(self.url)
+            self.assertEqual(response.status_code, 200)
+            # Куки из ответа не должны попадать в следующие запросы
+            self.assertIsNone(response.json()['cookie'])
+        after = pool_stats.metrics()
+        self.assertEqual(after['requests'] - before['requests'], 5)
+        self.assertEqual(after['connections_created'] - before['connections_created'], 1)
+        self.assertEqual(after['in_use'], before['in_use'])
+
+    def testOnlyRequestersPooled(self):
+        requester = types.ModuleType('ApiRequesters.TestRequester')
+        requester.requests = requests
+        requester.post = requests.post
+        with mock.patch.dict(sys.modules, {requester.__name__: requester}):
+            self.assertIn(requester.__name__, install_http_pool())
+        self.assertIs(requester.requests, pooled_requests)
+        self.assertEqual(requester.post, pooled_requests.post)
+        # Остальной процесс ходит обычным requests мимо пула
+        before = pool_stats.metrics()
+        self.assertEqual(requests.get(self.url).status_code, 200)
+        self.assertEqual(pool_stats.metrics()['requests'], before['requests'])
+
+    def testInstallFailsLoudly(self):
+        with mock.patch('Users.http_pool.REQUESTER_MODULES', ('ApiRequesters.Renamed', )), \
+                self.assertRaises(ImproperlyConfigured):
+            install_http_pool()
+        # Реквестеры больше не ходят через requests -- подменять нечего
+        requesters = {x: None for x in sys.modules if x.split('.')[0] == 'ApiRequesters'}
+        with mock.patch('Users.http_pool.REQUESTER_MODULES', ()), mock.patch.dict(sys.modules, requesters), \
+                self.assertRaises(ImproperlyConfigured):
+            install_http_pool()
+
+    @override_settings(HTTP_POOL_TIMEOUT=0.05)
+    def testPoolWaitBounded(self):
+        session = requests.Session()
+        session.mount('http://', PooledHTTPAdapter(pool_connections=1, pool_maxsize=1, pool_block=True))
+        pool = session.get_adapter(self.url).poolmanager.connection_from_url(self.url)
+        conn = pool._get_conn()
+        before = pool_stats.metrics()
+        try:
+            with self.assertRaises(requests.ConnectionError):
+                session.get(self.url)
+        finally:
+            pool._put_conn(conn)
+            session.close()
+        after = pool_stats.metrics()
+        self.assertEqual(after['pool_timeouts'] - before['pool_timeouts'], 1)
+        self.assertGreaterEqual(after['max_wait_seconds'], 0.05)
+
+
+class DbHealthCheckTestCase(TransactionTestCase):
+    """
+    Тесты на проверку постоянных соединений с базой
+    """
+    databases = '__all__'
+
+    def testDeadConnectionClosed(self):
+        Profile.objects.count()
+        failures = db_health.health_check_failures
+        connection.health_checked_at = 0
+        # close() у SQLite в памяти ничего не делает, поэтому проверяем сам вызов
+        with mock.patch.object(connection, 'is_usable', return_value=False), \
+                mock.patch.object(connection, 'close') as close:
+            db_health.check()
+        close.assert_called_once_with()
+        self.assertEqual(db_health.health_check_failures, failures + 1)
+
+    def testCheckedOncePerInterval(self):
+        Profile.objects.count()
+        connection.health_checked_at = 0
+        with mock.patch.object(connection, 'is_usable', return_value=True) as is_usable:
+            db_health.check()
+            db_health.check()
+        self.assertEqual(is_usable.call_count, 1)
+        self.assertIsNotNone(connection.connection)
+
+
+class SignUpTestCase(LocalBaseTestCase):
+    """
+    Тесты для /profiles/register/
+    """
+    def setUp(self):
+        super().setUp()
+        self.path = self.path_prefix + 'register/'
+        self.data = {'username': 'test', 'password': '123456'}
+        access = jwt.encode({'user_id': 777, 'token_type': 'access'}, 'auth-secret', algorithm='HS256').decode()
+        patcher = mock.patch.object(AuthRequester, 'sign_up', autospec=True,
+                                    return_value=(None, {'access': access, 'refresh': 'refresh'}))
+        self.sign_up = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _post(self, data=None, key=None):
+        client = self._get_api_client()
+        headers = {'HTTP_IDEMPOTENCY_KEY': key} if key else {}
+        return client.post(self.path, data=data or self.data, format='json', **headers)
+
+    def testUserIdFromIssuedToken(self):
+        with mock.patch.object(AuthRequester, 'get_user_info', autospec=True) as get_user_info:
+            response = self._post()
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['user']['id'], 777)
+        self.assertEqual(response.json()['profile']['user_id'], 777)
+        get_user_info.assert_not_called()
+
+    def testRefreshTokenNotTrusted(self):
+        refresh = jwt.encode({'user_id': 666, 'token_type': 'refresh'}, 'auth-secret', algorithm='HS256').decode()
+        self.sign_up.return_value = (None, {'access': refresh, 'refresh': refresh})
+        with mock.patch.object(AuthRequester, 'get_user_info', autospec=True,
+                               return_value=(None, {'id': 777, 'username': 'test'})) as get_user_info:
+            response = self._post()
+        self.assertEqual(response.json()['profile']['user_id'], 777)
+        get_user_info.assert_called_once()
+
+    def testRetryWithIdempotencyKey(self):
+        first = self._post(key='signup-1')
+        second = self._post(key='signup-1')
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(second.status_code, 201)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(self.sign_up.call_count, 1)
+        # Токены не хранятся и при повторе не отдаются
+        self.assertNotIn('refresh', IdempotencyKey.objects.get(key='signup-1').response)
+        self.assertNotIn('token', second.json())
+        self.assertEqual(second.json(), {'user': {'id': 777}, 'profile': first.json()['profile']})
+
+    def testKeyReusedWithOtherBody(self):
+        self.assertEqual(self._post(key='signup-1').status_code, 201)
+        self.assertEqual(self._post(data={'username': 'test', 'password': '654321'}, key='signup-1').status_code,
+                         422)
+
+    def testFingerprintIsKeyed(self):
+        self._post(key='signup-1')
+        # По хэшу из дампа базы пароль перебором не подобрать
+        plain = hashlib.sha256(json.dumps(self.data, sort_keys=True).encode()).hexdigest()
+        self.assertNotEqual(IdempotencyKey.objects.get(key='signup-1').fingerprint, plain)
+
+    def testKeysScopedByUsername(self):
+        other = {'username': 'other', 'password': '123456'}
+        self.assertEqual(self._post(key='signup-1').status_code, 201)
+        self.assertEqual(self._post(data=other, key='signup-1').status_code, 201)
+        self.assertEqual(self.sign_up.call_count, 2)
+
+    def testRetryAfterServerError(self):
+        tokens = self.sign_up.return_value
+
+        def check_claimed(*args):
+            # В auth идем, уже захватив ключ, но не держа открытой транзакцию с ним
+            self.assertTrue(IdempotencyKey.objects.filter(key='signup-1', status_code=None).exists())
+            return tokens
+        self.sign_up.side_effect = check_claimed
+        create_profile = SignUpView.create_profile
+        with mock.patch.object(SignUpView, 'create_profile', side_effect=DatabaseError('db is down')), \
+                mock.patch('Users.idempotency._run_in_transaction') as run_in_transaction, \
+                self.assertRaises(DatabaseError):
+            self._post(key='signup-1')
+        run_in_transaction.assert_not_called()
+        with mock.patch.object(SignUpView, 'create_profile', side_effect=create_profile):
+            retry = self._post(key='signup-1')
+        # Повтор не регистрирует юзера второй раз, а доделывает профиль
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry.json()['profile']['user_id'], 777)
+        self.assertNotIn('token', retry.json())
+        self.assertEqual(self.sign_up.call_count, 1)
+        self.assertEqual(self._post(key='signup-1')['Idempotent-Replayed'], 'true')
+
+    def testKeyInProgress(self):
+        response = self._post(key='signup-1')
+        IdempotencyKey.objects.filter(key='signup-1').update(status_code=None)
+        self.assertEqual(self._post(key='signup-1').status_code, 409)
+        self.assertEqual(response.status_code, 201)
+
+    def testCreateMissingProfilesFromAuth(self):
+        pages = {
+            '/users/': {'results': [{'id': self.profile.user_id}, {'id': 300}], 'next': None},
+            '/users/?page=1': {'results': [{'id': 301}, {'id': 300}], 'next': '/users/'},
+        }
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                page = dict(pages[self.path])
+                if page['next']:
+                    page['next'] = f'http://127.0.0.1:{self.server.server_port}{page["next"]}'
+                body = json.dumps(page).encode()
+                self.send_response(200 if self.headers.get('Authorization') == 'Bearer app-token' else 401)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        out = StringIO()
+        with override_settings(AUTH_USERS_URL=f'http://127.0.0.1:{server.server_port}/users/?page=1',
+                               AUTH_USERS_TOKEN='app-token'):
+            call_command('create_missing_profiles', '--from-auth', '--chunk-size', '1', stdout=out)
+            self.assertEqual(set(Profile.objects.values_list('user_id', flat=True)), {self.profile.user_id, 300, 301})
+            self.assertIn('Created 2 missing profiles of 3 users', out.getvalue())
+            with override_settings(AUTH_USERS_TOKEN='wrong'), self.assertRaises(CommandError):
+                call_command('create_missing_profiles', '--from-auth', stdout=out)
+
+    def testCreateMissingProfiles(self):
+        call_command('create_missing_profiles', self.profile.user_id, 200, 201, stdout=mock.MagicMock())
+        self.assertEqual(Profile.objects.filter(user_id__in=[200, 201]).count(), 2)
+        self.assertEqual(Profile.objects.get(user_id=200).get_unlocked_pins(), list(Profile.DEFAULT_UNLOCKED_PINS))
+        self.assertEqual(Profile.objects.get(user_id=201).get_achievements(), list(Profile.DEFAULT_ACHIEVEMENTS))
+        self.assertEqual(Profile.create_for_users([200, 201, 202]), [Profile.objects.get(user_id=202)])
+
+
+@override_settings(DATABASE_REPLICAS=['replica_1', 'replica_2'], REPLICA_MAX_LAG=10)
+class ReplicaRouterTestCase(TestCase):
+    """
+    Тесты на роутинг чтения по репликам
+    """
+    def setUp(self):
+        self.router = ReplicaRouter()
+        self.lags = {'replica_1': 0.0, 'replica_2': 0.0}
+        cache.clear()
+        replica_monitor._checked_at = None
+        patchers = [
+            mock.patch.object(replica_monitor, 'measure_lag', side_effect=lambda alias: self.lags[alias]),
+            # Сам тест идет в транзакции, а чтение внутри транзакции всегда уходит в мастер
+            mock.patch.object(connections['default'], 'in_atomic_block', False),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _request(self, method='GET', token='token-1'):
+        return mock.Mock(method=method, META={'HTTP_AUTHORIZATION': token})
+
+    def testReadsFromReplicas(self):
+        reads = {self.router.db_for_read(Profile) for _ in range(50)}
+        self.assertEqual(reads, {'replica_1', 'replica_2'})
+        self.assertEqual(self.router.db_for_write(Profile), 'default')
+
+    def testWriteRequestPinnedToPrimary(self):
+        with replica_request(self._request('POST')):
+            self.assertEqual(self.router.db_for_read(Profile), 'default')
+
+    def testReadYourWrites(self):
+        with replica_request(self._request()):
+            self.assertIn(self.router.db_for_read(Profile), self.lags)
+            self.router.db_for_write(Profile)
+            self.assertEqual(self.router.db_for_read(Profile), 'default')
+        with replica_request(self._request()):
+            self.assertEqual(self.router.db_for_read(Profile), 'default')
+        with replica_request(self._request(token='token-2')):
+            self.assertIn(self.router.db_for_read(Profile), self.lags)
+        # Вне запроса запись не закрепляет чтение за мастером
+        self.router.db_for_write(Profile)
+        self.assertIn(self.router.db_for_read(Profile), self.lags)
+
+    def testLaggingReplicaRemoved(self):
+        self.lags['replica_2'] = 60.0
+        self.assertEqual({self.router.db_for_read(Profile) for _ in range(20)}, {'replica_1'})
+        self.lags['replica_1'] = None
+        replica_monitor._checked_at = None
+        self.assertEqual(self.router.db_for_read(Profile), 'default')
+        self.lags['replica_1'] = self.lags['replica_2'] = 0.0
+        replica_monitor._checked_at = None
+        self.assertEqual({self.router.db_for_read(Profile) for _ in range(50)}, {'replica_1', 'replica_2'})
+
+    def testNoMigrationsOnReplicas(self):
+        self.assertFalse(self.router.allow_migrate('replica_1', 'Users'))
+        self.assertIsNone(self.router.allow_migrate('default', 'Users'))
+
+
+SHARD_TEST_ALIASES = ('shard_test_1', 'shard_test_2')
+
+
+@override_settings(DATABASE_SHARDS=['default', *SHARD_TEST_ALIASES])
+class ShardingTestCase(LocalBaseTestCase):
+    """
+    Тесты на шардирование профилей по user_id (дополнительные шарды -- SQLite в памяти)
+    """
+    databases = {'default', *SHARD_TEST_ALIASES}
+
+    @classmethod
+    def setUpClass(cls):
+        with override_settings(DATABASE_SHARDS=['default', *SHARD_TEST_ALIASES]):
+            for alias in SHARD_TEST_ALIASES:
+                connections.databases[alias] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}
+                call_command('migrate', database=alias, verbosity=0)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        for alias in SHARD_TEST_ALIASES:
+            del connections[alias]
+            del connections.databases[alias]
+
+    def setUp(self):
+        super().setUp()
+        self.user_ids = [self.profile.user_id]
+        for user_id in range(1, 31):
+            Profile.objects.create(user_id=user_id, rating=user_id * 10)
+            self.user_ids.append(user_id)
+        # Профиль не из default, чтобы проверить, что вьюхи ходят в нужный шард
+        self.remote_user_id = next(x for x in range(1, 31) if shard_for(x) != 'default')
+
+    def _shard_user_ids(self, alias):
+        return set(Profile.objects.using(alias).values_list('user_id', flat=True))
+
+    def testRingMovesOnlyToNewShard(self):
+        old = HashRing(['a', 'b'], 128)
+        new = HashRing(['a', 'b', 'c'], 128)
+        keys = range(1, 3001)
+        moved = [x for x in keys if old.get_node(x) != new.get_node(x)]
+        self.assertTrue(all(new.get_node(x) == 'c' for x in moved))
+        self.assertTrue(0.2 < len(moved) / len(keys) < 0.45)
+
+    def testProfilesSpreadAcrossShards(self):
+        for alias in ShardingTestCase.databases:
+            user_ids = self._shard_user_ids(alias)
+            self.assertTrue(user_ids)
+            self.assertTrue(all(shard_for(x) == alias for x in user_ids))
+        self.assertEqual(sum(len(self._shard_user_ids(x)) for x in ShardingTestCase.databases), len(self.user_ids))
+
+    def testSingleProfileViews(self):
+        path = f'{self.path_prefix}{self.remote_user_id}/'
+        response = self.get_response_and_check_status(url=path)
+        self.assertEqual(response['unlocked_pins'], list(Profile.DEFAULT_UNLOCKED_PINS))
+        _ = self.post_response_and_check_status(url=path + 'add_achievement/', data={'achievement_id': 5})
+        response = self.patch_response_and_check_status(url=path + 'update_rating/', data={'d_rating': 1})
+        self.assertEqual(response['money'], Profile.MATCH_REWARD)
+        response = self.post_response_and_check_status(url=path + 'buy_pin/', data={'pin_id': 7, 'price': 10})
+        self.assertIn(7, response['unlocked_pins'])
+        self.assertIn(5, response['achievements'])
+        response = self.get_response_and_check_status(url=path + 'rank/')
+        self.assertEqual(response['rank'], 30 - self.remote_user_id + 1)
+        self.assertEqual(Profile.objects.using('default').filter(user_id=self.remote_user_id).count(), 0)
+
+    def testIdempotentOnShard(self):
+        path = f'{self.path_prefix}{self.remote_user_id}/update_rating/'
+        client = self._get_api_client()
+        client.credentials(HTTP_AUTHORIZATION=self.token.token)
+        for _ in range(2):
+            response = client.patch(path, data={'d_rating': 5}, format='json', HTTP_IDEMPOTENCY_KEY='rating-1')
+            self.assertEqual(response.status_code, 202)
+        self.assertEqual(response['Idempotent-Replayed'], 'true')
+        self.assertEqual(Profile.objects.for_user(self.remote_user_id).get(user_id=self.remote_user_id).rating,
+                         self.remote_user_id * 10 + 5)
+
+    def testCreateInOwnShard(self):
+        self.profile.delete()
+        with mock.patch.object(AuthRequester, 'get_user_info', autospec=True,
+                               return_value=(None, {'id': 1000, 'is_superuser': False})):
+            _ = self.post_response_and_check_status(url=self.path_prefix, data={})
+            _ = self.post_response_and_check_status(url=self.path_prefix, data={}, expected_status_code=400)
+        profile = Profile.objects.for_user(1000).get(user_id=1000)
+        self.assertEqual(profile._state.db, shard_for(1000))
+        self.assertEqual(profile.get_unlocked_pins(), list(Profile.DEFAULT_UNLOCKED_PINS))
+
+    def testListFanOut(self):
+        user_ids = []
+        for offset in range(0, len(self.user_ids), 7):
+            response = self.get_response_and_check_status(url=self.path_prefix, data={'limit': 7, 'offset': offset})
+            self.assertEqual(response['count'], len(self.user_ids))
+            user_ids += [x['user_id'] for x in response['results']]
+        self.assertEqual(sorted(user_ids), sorted(self.user_ids))
+
+        user_ids = []
+        response = self.get_response_and_check_status(url=self.path_prefix, data={'pagination': 'cursor', 'limit': 4})
+        while True:
+            user_ids += [x['user_id'] for x in response['results']]
+            if not response['next']:
+                break
+            response = self.get_response_and_check_status(url=response['next'])
+        self.assertEqual(user_ids, sorted(self.user_ids))
+
+    def testBatchAndLeaderboard(self):
+        response = self.get_response_and_check_status(url=self.path_prefix + 'batch/',
+                                                      data={'user_ids': '1,2,3,4,5,6,999'})
+        self.assertEqual(sorted(int(x) for x in response['profiles']), [1, 2, 3, 4, 5, 6])
+        self.assertEqual(response['missing'], [999])
+        response = self.get_response_and_check_status(url=self.path_prefix + 'leaderboard/', data={'limit': 5})
+        self.assertEqual([x['user_id'] for x in response], [30, 29, 28, 27, 26])
+        updated = Profile.bulk_update_rating({1: (1000, 0), 2: (2000, 0), 999: (1, 0)})
+        self.assertEqual(set(updated), {1, 2})
+        self.assertEqual([x for x, _ in Profile.get_top(2)], [2, 1])
+
+    def testRebalance(self):
+        with override_settings(DATABASE_SHARDS=['default']):
+            for user_id in range(101, 121):
+                Profile.objects.create(user_id=user_id).add_pin(5, 0)
+        created = {x.user_id: x.created_dt for x in Profile.objects.using('default').filter(user_id__gt=100)}
+        call_command('rebalance_shards', chunk_size=7, stdout=StringIO())
+        for alias in ShardingTestCase.databases:
+            self.assertTrue(all(shard_for(x) == alias for x in self._shard_user_ids(alias)))
+        for user_id, created_dt in created.items():
+            profile = Profile.objects.for_user(user_id).get(user_id=user_id)
+            self.assertEqual(profile.created_dt, created_dt)
+            self.assertEqual(profile.get_unlocked_pins(), list(Profile.DEFAULT_UNLOCKED_PINS) + [5])
+            self.assertEqual(profile.get_achievements(), list(Profile.DEFAULT_ACHIEVEMENTS))
+        out = StringIO()
+        call_command('rebalance_shards', stdout=out)
+        self.assertIn('Moved 0 profiles', out.getvalue())
+
+
+class AsgiViewsTestCase(TransactionTestCase):
+    """
+    Тесты для асинхронных (ASGI) вьюх
+    """
+    databases = '__all__'
+
+    def setUp(self):
+        self.token = TestMockToken()
+        self.profile = Profile.objects.create(user_id=1)
+
+    def _request(self, method: str, path: str, data: dict = None, extra_headers: list = None):
+        body = json.dumps(data).encode() if data is not None else b''
+        headers = [(b'authorization', self.token.token.encode()), (b'content-type', b'application/json'),
+                   (b'content-length', str(len(body)).encode()), (b'host', b'testserver')] + (extra_headers or [])
+        communicator = HttpCommunicator(application, method, path, body=body, headers=headers)
+        response = async_to_sync(communicator.get_response)(timeout=5)
+        self.headers = dict(response['headers'])
+        return response['status'], json.loads(response['body']) if response['body'] else None
+
+    def testGetProfile200(self):
+        status, body = self._request('GET', f'/api/profiles/{self.profile.user_id}/')
+        self.assertEqual(status, 200)
+        self.assertEqual(body['unlocked_pins'], list(Profile.DEFAULT_UNLOCKED_PINS))
+        self.assertIn(b'db;dur=', self.headers[b'Server-Timing'])
+        # Ответ прошел через мидлвари Django
+        self.assertEqual(self.headers[b'X-Frame-Options'], b'DENY')
+
+    def testPatchProfile202_OneAuthCall(self):
+        with mock.patch.object(AuthRequester, 'get_user_info', autospec=True,
+                               side_effect=AuthRequester.get_user_info) as get_user_info:
+            status, _ = self._request('PATCH', f'/api/profiles/{self.profile.user_id}/', {'pin_sprite': 3})
+        self.assertEqual(status, 202)
+        self.assertEqual(get_user_info.call_count, 1)
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.pin_sprite, 3)
+
+    def testProfilesList(self):
+        self.profile.delete()
+        status, _ = self._request('POST', '/api/profiles/', {})
+        self.assertEqual(status, 201)
+        status, body = self._request('GET', '/api/profiles/')
+        self.assertEqual(status, 200)
+        self.assertEqual(len(body), 1)
+
+    def testSignUp(self):
+        self.profile.delete()
+        status, body = self._request('POST', '/api/profiles/register/', {'username': 'test', 'password': '123456'})
+        self.assertIn(status, [201, 400])
+        status, _ = self._request('POST', '/api/profiles/register/', {'username': 'test'})
+        self.assertEqual(status, 400)
+
+    def testSignUpWithIdempotencyKey(self):
+        self.profile.delete()
+        data = {'username': 'test', 'password': '123456'}
+        headers = [(b'idempotency-key', b'signup-1')]
+        with mock.patch.object(AuthRequester, 'sign_up', autospec=True, side_effect=AuthRequester.sign_up) as sign_up:
+            first_status, first = self._request('POST', '/api/profiles/register/', data, headers)
+            second_status, second = self._request('POST', '/api/profiles/register/', data, headers)
+        self.assertEqual(second_status, first_status)
+        self.assertEqual(second['profile'], first['profile'])
+        self.assertEqual(sign_up.call_count, 1)
+
+    def testSignUpThroughView(self):
+        self.profile.delete()
+        data = {'username': 'test', 'password': '123456'}
+        with mock.patch.object(AuthRequester, 'sign_up', autospec=True, side_effect=AuthRequester.sign_up) as sign_up:
+            status, body = self._request('POST', '/api/profiles/register/', data)
+        self.assertEqual(status, 201)
+        self.assertEqual(body['profile']['user_id'], body['user']['id'])
+        # В auth сходил только консюмер, вьюха взяла его результат
+        self.assertEqual(sign_up.call_count, 1)
+        with mock.patch.object(AuthRequester, 'sign_up', autospec=True, side_effect=UnexpectedResponse({}, 400)):
+            status, body = self._request('POST', '/api/profiles/register/', data)
+        self.assertEqual((status, body), (400, {'error': 'Error on creating new profile with user'}))
+
+    def testFallbackToDjangoHandler(self):
+        status, body = self._request('GET', f'/api/profiles/{self.profile.user_id}/rank/')
+        self.assertEqual(status, 200)
+        self.assertEqual(body['rank'], 1)
+
+
+@override_settings(PROFILE_UPDATES_ENABLED=True, CHANNEL_LAYERS={'default': {
+    'BACKEND': 'channels.layers.InMemoryChannelLayer'}})
+class ProfileUpdatesTestCase(TransactionTestCase):
+    """
+    Тесты для подписки на изменения профилей по WebSocket
+    """
+    databases = '__all__'
+
+    def setUp(self):
+        self.profile = Profile.objects.create(user_id=1)
+        self.other = Profile.objects.create(user_id=2)
+
+    async def _connect(self):
+        communicator = WebsocketCommunicator(application, '/ws/profiles/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def _subscribe(self, communicator, user_id):
+        await communicator.send_json_to({'action': 'subscribe', 'user_id': user_id})
+        return await communicator.receive_json_from()
+
+    async def _diffs(self):
+        communicator = await self._connect()
+        message = await self._subscribe(communicator, self.profile.user_id)
+        self.assertEqual(message['type'], 'profile')
+        self.assertEqual(message['data']['unlocked_pins'], list(Profile.DEFAULT_UNLOCKED_PINS))
+
+        await database_sync_to_async(self.profile.update_rating)(10, d_money=100)
+        message = await communicator.receive_json_from()
+        self.assertEqual(message, {'type': 'diff', 'user_id': 1, 'changes': {'rating': 10, 'money': 100}})
+        await database_sync_to_async(self.profile.add_pin)(5, 30)
+        message = await communicator.receive_json_from()
+        self.assertEqual(message['changes'], {'money': 70, 'unlocked_pins': [1, 2, 5]})
+        # Изменения чужого профиля и сохранение без изменений не приходят
+        await database_sync_to_async(self.other.update_rating)(10)
+        await database_sync_to_async(self.profile.save)()
+        self.assertTrue(await communicator.receive_nothing())
+
+        await database_sync_to_async(self.profile.delete)()
+        self.assertEqual(await communicator.receive_json_from(), {'type': 'deleted', 'user_id': 1})
+        await communicator.disconnect()
+
+    def testDiffs(self):
+        async_to_sync(self._diffs)()
+
+    async def _diffs_bypass_cache(self):
+        communicator = await self._connect()
+        message = await self._subscribe(communicator, self.profile.user_id)
+        # Старый профиль в кэше (или на реплике) не должен глушить разницу
+        stale = CachedProfile(message['data'])
+        with mock.patch.object(profile_cache, 'get', return_value=stale):
+            await database_sync_to_async(self.profile.update_rating)(10)
+            message = await communicator.receive_json_from()
+        self.assertEqual(message['changes']['rating'], 10)
+        await communicator.disconnect()
+
+    @override_settings(PROFILE_CACHE_BACKEND='memory')
+    def testDiffsBypassCache(self):
+        async_to_sync(self._diffs_bypass_cache)()
+
+    async def _subscriptions(self):
+        communicator = await self._connect()
+        message = await self._subscribe(communicator, 1000)
+        self.assertEqual(message['type'], 'error')
+        await communicator.send_to(text_data='not json')
+        self.assertEqual((await communicator.receive_json_from())['type'], 'error')
+        _ = await self._subscribe(communicator, self.other.user_id)
+        self.assertEqual(profile_updates.subscriptions, 1)
+        await communicator.send_json_to({'action': 'unsubscribe', 'user_id': self.other.user_id})
+        self.assertEqual((await communicator.receive_json_from())['type'], 'unsubscribed')
+        await database_sync_to_async(self.other.update_rating)(10)
+        self.assertTrue(await communicator.receive_nothing())
+        self.assertEqual(profile_updates.subscriptions, 0)
+        await communicator.disconnect()
+
+    def testSubscriptions(self):
+        async_to_sync(self._subscriptions)()
+
+    @override_settings(PROFILE_UPDATES_ENABLED=False)
+    def testDisabled(self):
+        with mock.patch.object(profile_updates, '_send') as send:
+            self.profile.update_rating(10)
+        send.assert_not_called()
+
+
+class RatingWriteBehindTestCase(LocalBaseTestCase):
+    """
+    Тесты для отложенной записи изменений рейтинга
+    """
+    def setUp(self):
+        super().setUp()
+        self.path = self.path_prefix + f'{self.profile.user_id}/update_rating/'
+        journal_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(journal_dir.cleanup)
+        self.journal_dir = journal_dir.name
+        self.buffer = self._new_buffer()
+        overridden = override_settings(RATING_WRITE_BEHIND=True, RATING_JOURNAL_DIR=self.journal_dir)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        patcher = mock.patch('Users.views.rating_buffer', self.buffer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _new_buffer(self):
+        buffer = RatingBuffer()
+        # Пишем в базу только явным flush() из теста
+        buffer._ensure_started = lambda: None
+        return buffer
+
+    def _journal_files(self):
+        return [x for x in os.listdir(self.journal_dir) if x != RatingBuffer.OWNER_LOCK]
+
+    def _crash(self, buffer):
+        # Процесс упал: его журнал и владение каталогом больше никто не держит
+        buffer._journal.close()
+        buffer._owner.close()
+
+    def testCoalescedUpdates(self):
+        for _ in range(5):
+            response = self.patch_response_and_check_status(url=self.path, data={'d_rating': 2})
+        self.assertEqual((response['rating'], response['money']), (10, 5 * Profile.MATCH_REWARD))
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.rating, 0)
+        response = self.get_response_and_check_status(url=f'{self.path_prefix}{self.profile.user_id}/')
+        self.assertEqual(response['rating'], 10)
+
+        with CaptureQueriesContext(connection) as queries:
+            self.buffer.flush()
+        updates = [x for x in queries.captured_queries if x['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.profile.refresh_from_db()
+        self.assertEqual((self.profile.rating, self.profile.money), (10, 5 * Profile.MATCH_REWARD))
+        self.assertEqual(self.buffer.pending(self.profile.user_id), (0, 0))
+        response = self.get_response_and_check_status(url=f'{self.path_prefix}{self.profile.user_id}/')
+        self.assertEqual(response['rating'], 10)
+        # Остался только пустой журнал процесса
+        self.assertEqual(len(self._journal_files()), 1)
+
+    def testRecoverAfterCrash(self):
+        for d_rating in (3, 4):
+            _ = self.patch_response_and_check_status(url=self.path, data={'d_rating': d_rating})
+        with open(os.path.join(self.journal_dir, self._journal_files()[0]), 'a') as journal:
+            journal.write('[100, 1')
+        # Процесс упал, не записав изменения
+        self._crash(self.buffer)
+        buffer = self._new_buffer()
+        buffer.recover()
+        self.assertEqual(buffer.pending(self.profile.user_id), (7, 2 * Profile.MATCH_REWARD))
+        buffer.flush()
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.rating, 7)
+        self.assertEqual(self._journal_files(), [])
+
+    def testClampedPerUpdate(self):
+        Profile.objects.filter(pk=self.profile.pk).update(rating=5)
+        _ = self.patch_response_and_check_status(url=self.path, data={'d_rating': -10})
+        response = self.patch_response_and_check_status(url=self.path, data={'d_rating': 10})
+        # Как и без отложенной записи: 5 - 10 обрезается до 0, потом +10
+        self.assertEqual(response['rating'], 10)
+        self.buffer.flush()
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.rating, 10)
+
+    def testNoDoubleApplyAfterCrash(self):
+        _ = self.patch_response_and_check_status(url=self.path, data={'d_rating': 3})
+
+        def crash(segment):
+            segment.file.close()
+            raise RuntimeError('crashed before the segment was removed')
+
+        with mock.patch.object(_Segment, 'discard', autospec=True, side_effect=crash):
+            with self.assertRaises(RuntimeError):
+                self.buffer.flush()
+        self._crash(self.buffer)
+        buffer = self._new_buffer()
+        buffer.recover()
+        buffer.flush()
+        self.profile.refresh_from_db()
+        self.assertEqual((self.profile.rating, self.profile.money), (3, Profile.MATCH_REWARD))
+        self.assertEqual(self._journal_files(), [])
+
+    def testSingleOwner(self):
+        _ = self.patch_response_and_check_status(url=self.path, data={'d_rating': 3})
+        with self.assertRaises(ImproperlyConfigured):
+            self._new_buffer().recover()
+
+    def testFailedFlushKeepsDeltas(self):
+        _ = self.patch_response_and_check_status(url=self.path, data={'d_rating': 3})
+        with mock.patch.object(Profile, 'bulk_update_rating', side_effect=OperationalError):
+            self.buffer.flush()
+        self.assertEqual(self.buffer.pending(self.profile.user_id), (3, Profile.MATCH_REWARD))
+        _ = self.patch_response_and_check_status(url=self.path, data={'d_rating': 1})
+        self.buffer.flush()
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.rating, 4)
+        self.assertEqual(self.buffer.metrics()['failed_flushes'], 1)
+
+
+class IdempotentAwardsTestCase(LocalBaseTestCase):
+    """
+    Тесты для Idempotency-Key на покупке пина, выдаче ачивки и изменении рейтинга
+    """
+    def setUp(self):
+        super().setUp()
+        self.path = f'{self.path_prefix}{self.profile.user_id}/'
+        self.profile.money = 100
+        self.profile.save()
+
+    def _request(self, method, path, data, key):
+        client = self._get_api_client()
+        client.credentials(HTTP_AUTHORIZATION=self.token.token)
+        return getattr(client, method)(self.path + path, data=data, format='json', HTTP_IDEMPOTENCY_KEY=key)
+
+    def testBuyPinRetry(self):
+        data = {'pin_id': 3, 'price': 30}
+        first = self._request('post', 'buy_pin/', data, 'buy-1')
+        with CaptureQueriesContext(connection) as queries:
+            second = self._request('post', 'buy_pin/', data, 'buy-1')
+        self.assertEqual((first.status_code, second.status_code), (201, 201))
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        # Повтор -- одно чтение ключа, без профиля
+        self.assertEqual(len(queries.captured_queries), 1)
+        self.assertIn('users_idempotencykey', queries.captured_queries[0]['sql'].lower())
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.money, 70)
+        self.assertEqual(self._request('post', 'buy_pin/', {'pin_id': 4, 'price': 30}, 'buy-1').status_code, 422)
+
+    def testAchievementAndRatingRetry(self):
+        for _ in range(2):
+            response = self._request('post', 'add_achievement/', {'achievement_id': 7}, 'award-1')
+            self.assertEqual(response.status_code, 201)
+        for _ in range(2):
+            response = self._request('patch', 'update_rating/', {'d_rating': 5}, 'rating-1')
+            self.assertEqual(response.status_code, 202)
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.rating, 5)
+        self.assertEqual(self.profile.money, 100 + Profile.MATCH_REWARD)
+        # Тот же ключ для другого юзера -- другой запрос
+        other = Profile.objects.create(user_id=101)
+        self.path = f'{self.path_prefix}{other.user_id}/'
+        self.assertEqual(self._request('patch', 'update_rating/', {'d_rating': 5}, 'rating-1').status_code, 202)
+        other.refresh_from_db()
+        self.assertEqual(other.rating, 5)
+
+    def testResponseSavedWithChanges(self):
+        data = {'pin_id': 3, 'price': 30}
+        with mock.patch('Users.idempotency._save_response', side_effect=OperationalError('database is locked')):
+            with self.assertRaises(OperationalError):
+                _ = self._request('post', 'buy_pin/', data, 'buy-1')
+        # Ответ не сохранился -- не сохранилась и покупка, так что повтор не спишет деньги дважды
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.money, 100)
+        self.assertFalse(IdempotencyKey.objects.exists())
+        self.assertEqual(self._request('post', 'buy_pin/', data, 'buy-1').status_code, 201)
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.money, 70)
+
+    def testKeyInProgressNotReclaimed(self):
+        IdempotencyKey.objects.create(scope=f'buy_pin:{self.profile.user_id}', key='buy-1', fingerprint='x',
+                                      expires_dt=timezone.now() + timedelta(hours=1))
+        IdempotencyKey.objects.update(created_dt=timezone.now() - timedelta(hours=1))
+        data = {'pin_id': 3, 'price': 30}
+        with mock.patch('Users.idempotency.get_fingerprint', return_value='x'):
+            self.assertEqual(self._request('post', 'buy_pin/', data, 'buy-1').status_code, 409)
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.money, 100)
+
+    def testPurgeExpiredKeys(self):
+        _ = self._request('post', 'add_achievement/', {'achievement_id': 7}, 'award-1')
+        _ = self._request('post', 'add_achievement/', {'achievement_id': 8}, 'award-2')
+        IdempotencyKey.objects.filter(key='award-1').update(expires_dt=timezone.now() - timedelta(seconds=1))
+        out = StringIO()
+        call_command('purge_idempotency_keys', stdout=out)
+        self.assertIn('Deleted 1 expired', out.getvalue())
+        self.assertEqual(list(IdempotencyKey.objects.values_list('key', flat=True)), ['award-2'])
+
+
+class ProfileDumpTestCase(LocalBaseTestCase):
+    """
+    Тесты для export_profiles и import_profiles
+    """
+    def setUp(self):
+        super().setUp()
+        self.profile.add_pin(5, 0)
+        self.profile.update_rating(10, 30)
+        for user_id in range(101, 104):
+            Profile.objects.create(user_id=user_id, pic_id=user_id)
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def _snapshot(self):
+        profiles = Profile.objects.order_by('user_id').prefetch_related('pins', 'achievements')
+        return [dict(x, id=None) for x in ProfileSerializer(instance=profiles, many=True).data]
+
+    def _export(self, path='-', **options):
+        out, err = StringIO(), StringIO()
+        call_command('export_profiles', path, stdout=out, stderr=err, **options)
+        return out.getvalue(), err.getvalue()
+
+    def _import(self, path, **options):
+        out = StringIO()
+        call_command('import_profiles', path, stdout=out, **options)
+        return out.getvalue()
+
+    def testExportJsonl(self):
+        with CaptureQueriesContext(connection) as queries:
+            out, err = self._export(chunk_size=2)
+        records = [json.loads(x) for x in out.splitlines()]
+        self.assertEqual([dict(x, id=None) for x in records], self._snapshot())
+        # Строки профилей читаются одним курсором, пины и ачивки -- по два запроса на пачку
+        self.assertEqual(len(queries.captured_queries), 1 + 2 * 2)
+        self.assertIn('exported 4', err)
+
+    def testRoundTrip(self):
+        expected = self._snapshot()
+        for name in ['dump.jsonl', 'dump.csv']:
+            path = os.path.join(self.dir.name, name)
+            _ = self._export(path)
+            Profile.objects.all().delete()
+            out = self._import(path, chunk_size=3)
+            self.assertIn('Processed 3 records', out)
+            self.assertIn('Imported 4 records: 4 created, 0 updated, 0 skipped', out)
+            self.assertEqual(self._snapshot(), expected)
+
+    def testImportUpdate(self):
+        path = os.path.join(self.dir.name, 'dump.csv')
+        with open(path, 'w') as f:
+            f.write('user_id,rating,unlocked_pins\n100,50,7\n200,5,\n')
+        self.assertIn('1 created, 0 updated, 1 skipped', self._import(path))
+        self.profile.refresh_from_db()
+        self.assertEqual(self.profile.rating, 10)
+        self.assertIn('0 created, 2 updated', self._import(path, update=True))
+        self.profile.refresh_from_db()
+        self.assertEqual((self.profile.rating, self.profile.money), (50, 30))
+        self.assertEqual(self.profile.get_unlocked_pins(), [1, 2, 5, 7])
+        created = Profile.objects.get(user_id=200)
+        self.assertEqual((created.rating, created.get_unlocked_pins()), (5, list(Profile.DEFAULT_UNLOCKED_PINS)))
+
+    def testImportWrongRecord(self):
+        path = os.path.join(self.dir.name, 'dump.jsonl')
+        with open(path, 'w') as f:
+            f.write('{"user_id": 300}\n{"user_id": "abc"}\n')
+        with self.assertRaisesMessage(CommandError, 'line 2'):
+            _ = self._import(path, chunk_size=1)
+        self.assertTrue(Profile.objects.filter(user_id=300).exists())
@@ -0,0 +1,140 @@
+import time
+from contextlib import ExitStack
+from contextvars import ContextVar
+from typing import Optional
+from django.conf import settings
+from django.db import connections
+from Users.metrics import observe_request
+
+
+_current = ContextVar('request_timings', default=None)
+
+
+class _Phase:
+    """
+    Замер одной фазы запроса, вложенная фаза ставит родительскую на паузу (время фаз не пересекается)
+    """
+    __slots__ = ('_timings', '_name')
+
+    def __init__(self, timings, name: str):
+        self._timings = timings
+        self._name = name
+
+    def __enter__(self):
+        self._timings._enter(self._name)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._timings._exit()
+
+
+class _NullPhase:
+    """
+    Фаза вне замеряемого запроса (фоновые потоки, тесты) -- ничего не делает
+    """
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_null_phase = _NullPhase()
+
+
+class RequestTimings:
+    """
+    Время, которое запрос провел в базе, в запросах к другим сервисам, в сериализации и в отправке статистики
+    Все, что не попало ни в одну фазу, считается фазой app
+    """
+    PHASES = ('db', 'requesters', 'serialization', 'stats')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.total = None
+        self.phases = dict.fromkeys(self.PHASES + ('app', ), 0.0)
+        self.db_queries = 0
+        self._stack = []
+
+    def _enter(self, name: str):
+        now = time.perf_counter()
+        if self._stack:
+            parent = self._stack[-1]
+            self.phases[parent[0]] += now - parent[1]
+        self._stack.append([name, now])
+
+    def _exit(self):
+        now = time.perf_counter()
+        name, started = self._stack.pop()
+        self.phases[name] += now - started
+        if self._stack:
+            self._stack[-1][1] = now
+
+    def phase(self, name: str) -> _Phase:
+        return _Phase(self, name)
+
+    def db_wrapper(self, execute, sql, params, many, context):
+        self.db_queries += 1
+        with self.phase('db'):
+            return execute(sql, params, many, context)
+
+    def track_db(self) -> ExitStack:
+        """
+        Замер всех запросов в базу в текущем потоке (по всем алиасам)
+        """
+        stack = ExitStack()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(self.db_wrapper))
+        return stack
+
+    def finish(self):
+        self.total = time.perf_counter() - self.started
+        measured = sum(v for k, v in self.phases.items() if k != 'app')
+        self.phases['app'] = max(self.total - measured, 0.0)
+        return self
+
+    def server_timing(self) -> str:
+        """
+        :return: Значение заголовка Server-Timing (длительности в миллисекундах)
+        """
+        items = []
+        for name, duration in self.phases.items():
+            if name == 'db':
+                items.append(f'db;dur={duration * 1000:.3f};desc="{self.db_queries} queries"')
+            else:
+                items.append(f'{name};dur={duration * 1000:.3f}')
+        items.append(f'total;dur={self.total * 1000:.3f}')
+        return ', '.join(items)
+
+
+def start_request() -> RequestTimings:
+    timings = RequestTimings()
+    _current.set(timings)
+    return timings
+
+
+def end_request():
+    _current.set(None)
+
+
+def finish_request(timings: RequestTimings, view: str, response):
+    """
+    Завершение замера: запись в гистограммы и заголовок Server-Timing
+    """
+    timings.finish()
+    observe_request(view, response.status_code, timings)
+    if settings.SERVER_TIMING_HEADER:
+        response['Server-Timing'] = timings.server_timing()
+
+
+def get_current() -> Optional[RequestTimings]:
+    return _current.get()
+
+
+def phase(name: str):
+    """
+    Замер фазы текущего запроса:
+        with phase('requesters'):
+            AuthRequester().get_user_info(token)
+    """
+    timings = _current.get()
+    return _null_phase if timings is None else timings.phase(name)
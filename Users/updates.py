@@ -0,0 +1,52 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+
+
+class ProfileUpdates:
+    """
+    Рассылка изменений профилей подписчикам по WebSocket через channel layer
+    В группу профиля уходит только user_id, а сам профиль (и разницу с отправленным) достает consumer подписчика
+    """
+    EVENT_TYPE = 'profile.changed'
+
+    def __init__(self):
+        self.connections = 0
+        self.subscriptions = 0
+        self.notified = 0
+        self.errors = 0
+
+    @staticmethod
+    def group_name(user_id: int) -> str:
+        return f'profile_{user_id}'
+
+    def _send(self, user_id: int):
+        layer = get_channel_layer()
+        if layer is None:
+            return
+        try:
+            async_to_sync(layer.group_send)(self.group_name(user_id), {'type': self.EVENT_TYPE, 'user_id': user_id})
+            self.notified += 1
+        except Exception:
+            # Рассылка -- не источник правды, запись в базу из-за нее не падает
+            self.errors += 1
+
+    def notify(self, user_id: int, using: str = None):
+        """
+        Оповещение подписчиков профиля после коммита транзакции, в которой он изменился
+        """
+        if not settings.PROFILE_UPDATES_ENABLED:
+            return
+        transaction.on_commit(lambda: self._send(user_id), using=using)
+
+    def metrics(self):
+        return {
+            'connections': self.connections,
+            'subscriptions': self.subscriptions,
+            'notified': self.notified,
+            'errors': self.errors,
+        }
+
+
+profile_updates = ProfileUpdates()
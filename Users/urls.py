@@ -5,8 +5,12 @@ from Users import views
 urlpatterns = [
     url(r'^profiles/$', views.ProfilesListView.as_view()),
     url(r'^profiles/register/$', views.SignUpView.as_view()),
+    url(r'^profiles/leaderboard/$', views.LeaderboardView.as_view()),
+    url(r'^profiles/batch/$', views.ProfilesBatchView.as_view()),
+    url(r'^profiles/update_rating/$', views.BulkChangeRatingView.as_view()),
     url(r'^profiles/(?P<user_id>\d+)/$', views.ProfileDetailView.as_view()),
     url(r'^profiles/(?P<user_id>\d+)/add_achievement/$', views.AddNewAchievementView.as_view()),
     url(r'^profiles/(?P<user_id>\d+)/buy_pin/$', views.BuyPinView.as_view()),
     url(r'^profiles/(?P<user_id>\d+)/update_rating/$', views.ChangeRatingView.as_view()),
+    url(r'^profiles/(?P<user_id>\d+)/rank/$', views.ProfileRankView.as_view()),
 ]
@@ -1,38 +1,67 @@
+import hmac
 from rest_framework.views import APIView, Response, Request
 from rest_framework.generics import ListCreateAPIView, RetrieveUpdateDestroyAPIView
-from rest_framework.pagination import LimitOffsetPagination
-from ApiRequesters.Auth.permissions import IsAuthenticated, IsAppTokenCorrect
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+from django.http import Http404, HttpResponse
+from django.views import View
+from django.utils.http import parse_etags
+from ApiRequesters.Auth.permissions import IsAppTokenCorrect
 from ApiRequesters.Auth.AuthRequester import AuthRequester
-from ApiRequesters.utils import get_token_from_request
 from ApiRequesters.exceptions import BaseApiRequestError, UnexpectedResponse
 from ApiRequesters.Awards.AwardsRequester import AwardsRequester
-from ApiRequesters.Stats.decorators import collect_request_stats_decorator, CollectStatsMixin
+from ApiRequesters.Stats.decorators import CollectStatsMixin
 from Users.models import Profile
 from Users.serializers import ProfileSerializer, ProfilesListSerializer, SignUpSerializer
-from Users.permissions import EditableByMeAndAdminPermission
+from Users.permissions import EditableByMeAndAdminPermission, IsAuthenticated
+from Users.auth import get_auth_context, get_token_info_cache, read_issued_token
+from Users.stats import collect_request_stats_decorator, stats_queue
+from Users.pagination import ProfilesListPagination
+from Users.profile_cache import profile_cache, CachedProfile
+from Users.fast_serializers import profiles_list_reader, profile_reader, get_owned_ids
+from Users.media import image_validator
+from Users.metrics import render_metrics
+from Users.http_pool import pool_stats
+from Users.db import db_health
+from Users.routers import replica_monitor
+from Users.timing import phase
+from Users.idempotency import idempotent, get_checkpoint, save_checkpoint
+from Users.sharding import sharded, shard_for, group_by_shard
+from Users.updates import profile_updates
+from Users.write_behind import rating_buffer
 
 
 class ProfilesListView(ListCreateAPIView, CollectStatsMixin):
     """
     Вьюха для спискового представления профилей
     """
-    pagination_class = LimitOffsetPagination
+    pagination_class = ProfilesListPagination
     serializer_class = ProfilesListSerializer
     permission_classes = (IsAuthenticated, )
 
     def get_queryset(self):
-        return Profile.objects.all()
+        # С шардами -- запрос во все шарды со слиянием страниц
+        return sharded(Profile.objects.all())
 
     @collect_request_stats_decorator()
     def get(self, request, *args, **kwargs):
         return super().get(request, *args, **kwargs)
 
+    def list(self, request, *args, **kwargs):
+        # Чтение идет мимо моделей и полей DRF: .values() и заранее собранные конвертеры
+        reader = profiles_list_reader.only(ProfilesListSerializer.get_requested_fields(request))
+        # Из базы берутся только колонки запрошенных полей и те, по которым строится курсор
+        columns = dict.fromkeys(reader.columns + self.paginator.get_ordering_fields(request, self))
+        queryset = self.filter_queryset(self.get_queryset()).values(*columns)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(reader.many(page))
+        return Response(reader.many(queryset))
+
     @collect_request_stats_decorator()
     def post(self, request, **kwargs):
-        r = AuthRequester()
-        token = get_token_from_request(request)
         try:
-            auth_info = r.get_user_info(token)[1]
+            auth_info = get_auth_context(request).user_info
         except UnexpectedResponse as e:
             return Response(data=e.body, status=e.code)
         except BaseApiRequestError as e:
@@ -57,11 +86,66 @@ class ProfileDetailView(RetrieveUpdateDestroyAPIView, CollectStatsMixin):
     lookup_url_kwarg = 'user_id'
 
     def get_queryset(self):
-        return Profile.objects.all()
+        return Profile.objects.for_user(self.kwargs[self.lookup_url_kwarg]).prefetch_related('pins', 'achievements')
+
+    def _is_not_modified(self, request, entry):
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if not if_none_match:
+            return False
+        # Сравнение слабое: сжатый ответ уходит со слабым ETag
+        etags = [x[2:] if x.startswith('W/') else x for x in parse_etags(if_none_match)]
+        return '*' in etags or entry.etag in etags
+
+    @staticmethod
+    def _read_profile(user_id: int, fields=None, primary=False) -> dict:
+        """
+        Быстрое чтение профиля для GET (тот же JSON, что и у ProfileSerializer)
+        :param fields: Только эти поля: читаются только их колонки, а пины и ачивки -- только если они нужны
+        :param primary: Читать из мастера, а не с реплики (для записи в кэш)
+        """
+        shard = shard_for(user_id) or (DEFAULT_DB_ALIAS if primary else None)
+        reader = profile_reader.only(fields)
+        # id нужен, чтобы достать пины и ачивки
+        columns = dict.fromkeys(reader.columns + (('id', ) if reader.extra_fields else ()))
+        row = Profile.objects.using(shard).filter(user_id=user_id).values(*columns).first()
+        if row is None:
+            raise Http404
+        if not reader.extra_fields:
+            return reader.to_representation(row)
+        return reader.to_representation(row, get_owned_ids([row['id']], shard, reader.extra_fields)[row['id']])
+
+    @classmethod
+    def get_entry(cls, user_id: int, fields=None, fresh=False):
+        """
+        Профиль из кэша или из базы (для GET и для подписок по WebSocket)
+        :param fields: Только эти поля (?fields=)
+        :param fresh: Мимо кэша, из мастера (запись в кэше заодно обновляется)
+        :raises Http404: Если профиля нет
+        """
+        entry = None if fresh else profile_cache.get(user_id)
+        if fields is None:
+            if entry is None:
+                # Кэш наполняем только из мастера: отстающая реплика после сброса записи вернула бы старый профиль,
+                # и он отдавался бы (и получал 304) до конца TTL
+                entry = profile_cache.set(user_id, cls._read_profile(user_id, primary=True))
+        elif entry is None:
+            # Урезанный профиль в кэш не кладем
+            entry = CachedProfile(cls._read_profile(user_id, fields))
+        else:
+            entry = CachedProfile({x: entry.data[x] for x in fields})
+        if settings.RATING_WRITE_BEHIND:
+            # В кэше значение из базы, а еще не записанные изменения рейтинга накладываем сверху (со своим ETag)
+            data = rating_buffer.apply(entry.data, user_id)
+            if data is not entry.data:
+                entry = CachedProfile(data)
+        return entry
 
     @collect_request_stats_decorator()
     def get(self, request, *args, **kwargs):
-        return super().get(request, *args, **kwargs)
+        entry = self.get_entry(int(kwargs[self.lookup_url_kwarg]), ProfileSerializer.get_requested_fields(request))
+        if self._is_not_modified(request, entry):
+            return Response(status=304, headers=entry.headers)
+        return Response(entry.data, status=200, headers=entry.headers)
 
     @collect_request_stats_decorator()
     def update(self, request, *args, **kwargs):
@@ -71,6 +155,47 @@ class ProfileDetailView(RetrieveUpdateDestroyAPIView, CollectStatsMixin):
         return response
 
 
+class ProfilesBatchView(APIView, CollectStatsMixin):
+    """
+    Вьюха для получения пачки профилей одним запросом (для других сервисов)
+    """
+    def _get_profiles(self, user_ids):
+        try:
+            user_ids = list(dict.fromkeys(int(x) for x in user_ids))
+        except (TypeError, ValueError):
+            return Response({'error': 'user_ids должен быть списком чисел'}, status=400)
+        if not user_ids:
+            return Response({'error': 'Необходимо указать user_ids'}, status=400)
+        if len(user_ids) > settings.PROFILES_BATCH_MAX_SIZE:
+            return Response({'error': f'Нельзя запросить больше {settings.PROFILES_BATCH_MAX_SIZE} профилей'},
+                            status=400)
+
+        # С ?fields= читаются только нужные колонки и связи
+        fields = ProfileSerializer.get_requested_fields(self.request)
+        reader = profile_reader.only(fields)
+        prefetch = [ProfileSerializer.PREFETCH_FIELDS[x] for x in reader.extra_fields]
+        profiles = [profile for shard, shard_user_ids in group_by_shard(user_ids).items() for profile in
+                    Profile.objects.using(shard).filter(user_id__in=shard_user_ids).only('user_id', *reader.columns)
+                    .prefetch_related(*prefetch)]
+        data = ProfileSerializer(instance=profiles, many=True, fields=fields).data
+        found = {profile.user_id: x for profile, x in zip(profiles, data)}
+        ret_data = {
+            'profiles': {str(x): found[x] for x in user_ids if x in found},
+            'missing': [x for x in user_ids if x not in found],
+        }
+        return Response(ret_data, status=200)
+
+    @collect_request_stats_decorator()
+    def get(self, request: Request):
+        user_ids = request.query_params.get('user_ids', '')
+        return self._get_profiles([x for x in user_ids.split(',') if x])
+
+    @collect_request_stats_decorator()
+    def post(self, request: Request):
+        user_ids = request.data.get('user_ids', []) if isinstance(request.data, dict) else None
+        return self._get_profiles(user_ids)
+
+
 class AddNewAchievementView(APIView, CollectStatsMixin):
     """
     Вьюха для добавления нового пина
@@ -78,9 +203,10 @@ class AddNewAchievementView(APIView, CollectStatsMixin):
     permission_classes = (IsAppTokenCorrect, )
 
     @collect_request_stats_decorator(another_stats_funcs=[CollectStatsMixin.collect_achievement_stats])
+    @idempotent('add_achievement')
     def post(self, request: Request, user_id: int):
         try:
-            profile = Profile.objects.get(user_id=user_id)
+            profile = Profile.objects.for_user(user_id).get(user_id=user_id)
         except Profile.DoesNotExist:
             return Response({'error': 'Такого пользователя не существует'}, status=404)
 
@@ -89,9 +215,8 @@ class AddNewAchievementView(APIView, CollectStatsMixin):
         except KeyError:
             return Response({'error': 'Необходимо указать achievement_id'}, status=400)
 
-        if achievement_id in profile.get_achievements():
+        if not profile.add_achievement(achievement_id):
             return Response({'error': 'У пользователя уже есть это достижение'}, status=400)
-        profile.add_achievement(achievement_id)
         s = ProfileSerializer(instance=profile)
         stats_kwargs = [{
             'achievement_id': achievement_id,
@@ -107,9 +232,10 @@ class BuyPinView(APIView, CollectStatsMixin):
     permission_classes = (IsAppTokenCorrect, )
 
     @collect_request_stats_decorator(another_stats_funcs=[CollectStatsMixin.collect_pin_purchase_stats])
+    @idempotent('buy_pin')
     def post(self, request, user_id):
         try:
-            profile = Profile.objects.get(user_id=user_id)
+            profile = Profile.objects.for_user(user_id).get(user_id=user_id)
         except Profile.DoesNotExist:
             return Response({'error': 'Такого пользователя не существует'}, status=404)
 
@@ -119,11 +245,11 @@ class BuyPinView(APIView, CollectStatsMixin):
         except KeyError:
             return Response({'error': 'Необходимо указать id и price пина'}, status=400)
 
-        if pin_id in profile.get_unlocked_pins():
-            return Response({'error': 'У вас уже есть этот пин'}, status=400)
-        if profile.money < price:
+        if not profile.add_pin(pin_id, price):
+            # Причину отказа выясняем только в неуспешном случае
+            if profile.has_pin(pin_id):
+                return Response({'error': 'У вас уже есть этот пин'}, status=400)
             return Response({'error': 'Недостаточно баллов для покупки'}, status=400)
-        profile.add_pin(pin_id, price)
         s = ProfileSerializer(instance=profile)
         stats_kwargs = [{
             'pin_id': pin_id,
@@ -139,42 +265,251 @@ class ChangeRatingView(APIView, CollectStatsMixin):
     permission_classes = (IsAppTokenCorrect, )
 
     @collect_request_stats_decorator()
+    @idempotent('change_rating')
     def patch(self, request: Request, user_id: int):
         try:
-            profile = Profile.objects.get(user_id=user_id)
+            profile = Profile.objects.for_user(user_id).get(user_id=user_id)
         except Profile.DoesNotExist:
             return Response({'error': 'Такого пользователя не существует'}, status=404)
 
         try:
-            d_rating = request.data['d_rating']
-        except KeyError:
+            d_rating = int(request.data['d_rating'])
+        except (KeyError, TypeError, ValueError):
             return Response({'error': 'Необходимо указать d_rating'}, status=400)
 
-        profile.update_rating(d_rating, save=False)
-        profile.money += 100
-        profile.save()
+        if settings.RATING_WRITE_BEHIND:
+            # В базу изменение попадет пачкой, а в ответе -- уже с ним
+            rating_buffer.add(profile.user_id, d_rating, Profile.MATCH_REWARD)
+            return Response(rating_buffer.apply(ProfileSerializer(instance=profile).data), status=202)
+        profile.update_rating(d_rating, d_money=Profile.MATCH_REWARD)
         s = ProfileSerializer(instance=profile)
         return Response(s.data, status=202)
 
 
+class BulkChangeRatingView(APIView, CollectStatsMixin):
+    """
+    Вьюха для пакетного изменения рейтинга по итогам матча
+    """
+    permission_classes = (IsAppTokenCorrect, )
+
+    @collect_request_stats_decorator()
+    def post(self, request: Request):
+        updates = request.data.get('updates') if isinstance(request.data, dict) else request.data
+        if not isinstance(updates, list) or not updates:
+            return Response({'error': 'Необходимо указать список updates из {user_id, d_rating}'}, status=400)
+        if len(updates) > settings.RATING_BATCH_MAX_SIZE:
+            return Response({'error': f'Нельзя обновить больше {settings.RATING_BATCH_MAX_SIZE} профилей'},
+                            status=400)
+
+        results = []
+        deltas = {}
+        for update in updates:
+            try:
+                user_id, d_rating = int(update['user_id']), int(update['d_rating'])
+            except (KeyError, TypeError, ValueError):
+                results.append({'user_id': update.get('user_id') if isinstance(update, dict) else None,
+                                'error': 'Необходимо указать user_id и d_rating'})
+                continue
+            prev_d_rating, prev_d_money = deltas.get(user_id, (0, 0))
+            deltas[user_id] = (prev_d_rating + d_rating, prev_d_money + Profile.MATCH_REWARD)
+            results.append({'user_id': user_id})
+
+        updated = Profile.bulk_update_rating(deltas)
+        for result in results:
+            if 'error' in result:
+                continue
+            try:
+                result['rating'], result['money'] = updated[result['user_id']]
+            except KeyError:
+                result['error'] = 'Такого пользователя не существует'
+        ret_data = {
+            'results': results,
+            'failed': sum(1 for x in results if 'error' in x),
+        }
+        return Response(ret_data, status=202)
+
+
+class LeaderboardView(APIView, CollectStatsMixin):
+    """
+    Вьюха для топа игроков по рейтингу
+    """
+    @collect_request_stats_decorator()
+    def get(self, request: Request):
+        try:
+            limit = int(request.query_params.get('limit', settings.LEADERBOARD_DEFAULT_LIMIT))
+        except ValueError:
+            return Response({'error': 'limit должен быть числом'}, status=400)
+        if not 0 < limit <= settings.LEADERBOARD_MAX_LIMIT:
+            return Response({'error': f'limit должен быть от 1 до {settings.LEADERBOARD_MAX_LIMIT}'}, status=400)
+
+        ret_data = []
+        for i, (user_id, rating) in enumerate(Profile.get_top(limit)):
+            # При равном рейтинге место общее
+            rank = ret_data[-1]['rank'] if ret_data and ret_data[-1]['rating'] == rating else i + 1
+            ret_data.append({'user_id': user_id, 'rating': rating, 'rank': rank})
+        return Response(ret_data, status=200)
+
+
+class ProfileRankView(APIView, CollectStatsMixin):
+    """
+    Вьюха для места пользователя в рейтинге
+    """
+    @collect_request_stats_decorator()
+    def get(self, request: Request, user_id: int):
+        try:
+            profile = Profile.objects.for_user(user_id).only('user_id', 'rating').get(user_id=user_id)
+        except Profile.DoesNotExist:
+            return Response({'error': 'Такого пользователя не существует'}, status=404)
+        ret_data = {
+            'user_id': profile.user_id,
+            'rating': profile.rating,
+            'rank': profile.get_rank(),
+        }
+        return Response(ret_data, status=200)
+
+
+def _sign_up_to_store(data: dict) -> dict:
+    # Токены и данные юзера в ключе идемпотентности не храним, только id профиля
+    return {'user_id': data['profile']['user_id']} if 'profile' in data else data
+
+
+def _sign_up_client(request) -> str:
+    # Ключи регистрации -- свои у каждого username
+    return str(request.data.get('username', '')) if isinstance(request.data, dict) else ''
+
+
+def _sign_up_replay(stored: dict) -> dict:
+    """
+    Повтор регистрации: текущий профиль без токенов (их клиент получает входом в auth)
+    """
+    if 'user_id' not in stored:
+        return stored
+    user_id = stored['user_id']
+    profile = Profile.objects.for_user(user_id).filter(user_id=user_id).first()
+    return {
+        'user': {'id': user_id},
+        'profile': ProfileSerializer(instance=profile).data if profile is not None else None,
+    }
+
+
 class SignUpView(APIView):
     """
     Вьюха для регистрации (с запросом на auth)
+    Под ASGI запрос в auth заранее и без блокировки воркера делает SignUpConsumer, а вьюха берет его результат
     """
+    # Ошибки регистрации в auth, на которые клиент получает 400
+    REGISTRATION_ERRORS = (BaseApiRequestError, KeyError)
+
+    @staticmethod
+    def user_from_sign_up(tokens: dict, data):
+        """
+        Юзер из ответа на регистрацию: из самого ответа или из выданного access-токена
+        :return: JSON юзера или None, если auth не отдал его id
+        """
+        user = tokens.get('user')
+        if isinstance(user, dict) and 'id' in user:
+            return user
+        claims = read_issued_token(tokens)
+        if claims is None:
+            return None
+        return {
+            'id': claims['id'],
+            'username': data['username'],
+            'email': data.get('email', ''),
+            'is_superuser': claims['is_superuser'],
+        }
+
+    @staticmethod
+    def register_in_auth(data):
+        """
+        Сетевая часть регистрации: создание юзера в auth
+        Информация о юзере запрашивается отдельно, только если ее нельзя достать из ответа на регистрацию
+        :return: Токены и JSON юзера
+        """
+        with phase('requesters'):
+            _, tokens = AuthRequester().sign_up(data['username'], data['password'], data.get('email', ''))
+        auth_json = SignUpView.user_from_sign_up(tokens, data)
+        if auth_json is None:
+            with phase('requesters'):
+                _, auth_json = AuthRequester().get_user_info(tokens['access'])
+        return tokens, auth_json
+
+    @staticmethod
+    def create_profile(tokens, auth_json):
+        """
+        Работа с базой при регистрации: создание профиля (если его еще нет)
+        :param tokens: Токены из auth (None -- их нет, и в ответ они не попадают)
+        :return: JSON для ответа
+        """
+        profile, _ = Profile.objects.for_user(auth_json['id']).get_or_create(user_id=auth_json['id'])
+        profile_json = ProfileSerializer(instance=profile).data
+        ret_data = {
+            'token': tokens,
+            'user': auth_json,
+            'profile': profile_json,
+        }
+        if tokens is None:
+            del ret_data['token']
+        return ret_data
+
+    @staticmethod
+    def get_registration(request):
+        """
+        Результат регистрации в auth: уже полученный SignUpConsumer'ом (request.registration) или запрошенный сейчас
+        :raises REGISTRATION_ERRORS: Если auth не зарегистрировал юзера
+        """
+        prefetched = getattr(request, 'registration', None)
+        if prefetched is None:
+            return SignUpView.register_in_auth(request.data)
+        result, error = prefetched
+        if error is not None:
+            raise error
+        return result
+
+    @idempotent('sign_up', store=_sign_up_to_store, replay=_sign_up_replay, client=_sign_up_client, atomic=False)
     def post(self, request: Request):
         serializer = SignUpSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
+        auth_json = get_checkpoint(request)
+        if auth_json is not None:
+            # Прошлая попытка с этим ключом уже создала юзера в auth, но упала на профиле. Токены не сохраняются,
+            # их клиент получит входом в auth
+            return Response(self.create_profile(None, auth_json), status=201)
         try:
-            _, tokens = AuthRequester().sign_up(request.data['username'], request.data['password'],
-                                                request.data.get('email', ''))
-            _, auth_json = AuthRequester().get_user_info(tokens['access'])
-            profile = Profile.objects.create(user_id=auth_json['id'])
-            profile_json = ProfileSerializer(instance=profile).data
-            ret_data = {
-                'token': tokens,
-                'user': auth_json,
-                'profile': profile_json,
-            }
-            return Response(ret_data, status=201)
-        except (BaseApiRequestError, KeyError):
+            tokens, auth_json = self.get_registration(request)
+        except self.REGISTRATION_ERRORS:
             return Response({'error': 'Error on creating new profile with user'}, status=400)
+        save_checkpoint(request, auth_json)
+        # Юзер в auth уже создан: ошибка базы тут -- это 500, повтор с тем же ключом доделает профиль,
+        # а без ключа его потом доделает create_missing_profiles
+        return Response(self.create_profile(tokens, auth_json), status=201)
+
+
+class MetricsView(View):
+    """
+    Вьюха для метрик в формате Prometheus (гистограммы времени запросов и показатели кэшей и очередей)
+    """
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    @staticmethod
+    def _is_allowed(request) -> bool:
+        auth = request.META.get('HTTP_AUTHORIZATION', '')
+        if settings.METRICS_TOKEN and hmac.compare_digest(auth, f'Bearer {settings.METRICS_TOKEN}'):
+            return True
+        return request.META.get('REMOTE_ADDR') in settings.METRICS_ALLOWED_IPS
+
+    def get(self, request):
+        if not self._is_allowed(request):
+            return HttpResponse(status=403)
+        gauge_sources = {
+            'stats_queue': stats_queue.metrics,
+            'profile_cache': profile_cache.metrics,
+            'media_cache': lambda: image_validator.cache.metrics(),
+            'token_cache': lambda: get_token_info_cache().metrics(),
+            'http_pool': pool_stats.metrics,
+            'db_connections': db_health.metrics,
+            'db_replicas': replica_monitor.metrics,
+            'profile_updates': profile_updates.metrics,
+            'rating_buffer': rating_buffer.metrics,
+        }
+        return HttpResponse(render_metrics(gauge_sources), content_type=self.CONTENT_TYPE)
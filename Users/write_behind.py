@@ -0,0 +1,286 @@
+import atexit
+import fcntl
+import glob
+import json
+import os
+import uuid
+from threading import Thread, Lock, Event
+from typing import Dict, List, Tuple
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections
+from Users.sharding import get_shards
+
+
+class _Segment:
+    """
+    Кусок журнала, который уже забран из памяти, но еще не записан в базу
+    Файл держится открытым под flock, чтобы его не подобрал восстановлением другой процесс
+    """
+    def __init__(self, path: str, file, deltas: Dict[int, List[int]]):
+        self.path = path
+        self.file = file
+        self.deltas = deltas
+
+    @property
+    def batch_id(self) -> str:
+        # Имя файла уникально: в журнал с таким именем пишет только один процесс и только до падения
+        return os.path.basename(self.path)
+
+    def discard(self):
+        os.unlink(self.path)
+        self.file.close()
+
+
+def _lock_file(path: str, mode: str):
+    """
+    :return: Открытый файл под эксклюзивным flock или None, если его держит другой процесс
+    """
+    file = open(path, mode)
+    try:
+        fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        file.close()
+        return None
+    return file
+
+
+def _add(deltas: Dict[int, List[int]], user_id: int, d_rating: int, d_money: int):
+    """
+    Дельта профиля -- [d_rating, floor, d_money]: рейтинг после нее max(rating + d_rating, floor)
+    Рейтинг обрезается нулем на каждом изменении, поэтому кроме суммы копится и нижняя граница
+    (5, потом -10 и +10 -- это 10, а не 5)
+    """
+    item = deltas.setdefault(user_id, [0, 0, 0])
+    item[0] += d_rating
+    item[1] = max(item[1] + d_rating, 0)
+    item[2] += d_money
+
+
+def _compose(first: List[int], second: List[int]) -> List[int]:
+    """
+    Дельта, равная применению first, а потом second
+    """
+    return [first[0] + second[0], max(first[1] + second[0], second[1]), first[2] + second[2]]
+
+
+class RatingBuffer:
+    """
+    Write-behind для изменений рейтинга: дельты копятся в памяти процесса (по user_id) и фоновым потоком раз в
+    RATING_FLUSH_INTERVAL секунд пишутся в базу одним Profile.bulk_update_rating на пачку
+    Каждая дельта сначала дописывается в журнал процесса в RATING_JOURNAL_DIR. Перед записью в базу журнал
+    откладывается в сегмент, который удаляется после коммита, а журналы и сегменты упавших процессов
+    подбираются при старте. Id сегмента пишется в базу в одной транзакции с его дельтами, так что сегмент,
+    не удаленный из-за падения, повторно не применится. Пока пачка пишется, GET может на мгновение увидеть ее дважды
+    Незаписанные дельты видны только своему процессу, поэтому журналом владеет один процесс (flock на OWNER_LOCK),
+    и он же должен обслуживать все запросы к профилям: второй процесс с тем же журналом не стартует
+    """
+    JOURNAL_PATTERN = 'rating-*'
+    OWNER_LOCK = 'owner.lock'
+
+    def __init__(self):
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._wakeup = Event()
+        self._thread = None
+        self._pending = {}
+        self._segments = []
+        self._owner = None
+        self._journal = None
+        self._journal_path = None
+        self._segment_no = 0
+        self.added = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.flushed_profiles = 0
+        self.recovered = 0
+
+    def _read_journal(self, file) -> Dict[int, List[int]]:
+        deltas = {}
+        file.seek(0)
+        for line in file:
+            try:
+                user_id, d_rating, d_money = json.loads(line)
+            except ValueError:
+                # Недописанная при падении строка
+                continue
+            _add(deltas, user_id, d_rating, d_money)
+        return deltas
+
+    def _acquire_owner(self):
+        if self._owner is not None:
+            return
+        os.makedirs(settings.RATING_JOURNAL_DIR, exist_ok=True)
+        self._owner = _lock_file(os.path.join(settings.RATING_JOURNAL_DIR, self.OWNER_LOCK), 'a')
+        if self._owner is None:
+            raise ImproperlyConfigured(f'RATING_WRITE_BEHIND needs a single server process, but '
+                                       f'{settings.RATING_JOURNAL_DIR} is owned by another one')
+
+    def recover(self):
+        """
+        Подбирает журналы и сегменты процессов, которые упали, не успев записать дельты в базу
+        """
+        self._acquire_owner()
+        for path in sorted(glob.glob(os.path.join(settings.RATING_JOURNAL_DIR, self.JOURNAL_PATTERN))):
+            file = _lock_file(path, 'r')
+            if file is None:
+                continue
+            deltas = self._read_journal(file)
+            with self._lock:
+                self._segments.append(_Segment(path, file, deltas))
+            self.recovered += len(deltas)
+
+    def _open_journal(self):
+        if self._journal is not None:
+            return
+        self.recover()
+        self._journal_path = os.path.join(settings.RATING_JOURNAL_DIR,
+                                          f'rating-{os.getpid()}-{uuid.uuid4().hex[:8]}.journal')
+        self._journal = _lock_file(self._journal_path, 'a+')
+
+    def start(self):
+        """
+        Восстановление после падения и запуск фонового потока записи в базу
+        """
+        with self._lock:
+            self._open_journal()
+        self._ensure_started()
+
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = Thread(target=self._run, name='rating-write-behind', daemon=True)
+            self._thread.start()
+
+    def add(self, user_id: int, d_rating: int, d_money: int = 0):
+        self._ensure_started()
+        with self._lock:
+            self._open_journal()
+            self._journal.write(json.dumps([user_id, d_rating, d_money]) + '\n')
+            self._journal.flush()
+            if settings.RATING_JOURNAL_FSYNC:
+                os.fsync(self._journal.fileno())
+            _add(self._pending, user_id, d_rating, d_money)
+            self.added += 1
+            if len(self._pending) >= settings.RATING_FLUSH_MAX_PENDING:
+                self._wakeup.set()
+
+    def _combined(self, user_id: int) -> List[int]:
+        ret = [0, 0, 0]
+        with self._lock:
+            for deltas in [x.deltas for x in self._segments] + [self._pending]:
+                if user_id in deltas:
+                    ret = _compose(ret, deltas[user_id])
+        return ret
+
+    def pending(self, user_id: int) -> Tuple[int, int]:
+        """
+        :return: Еще не записанные в базу (d_rating, d_money) профиля
+        """
+        d_rating, _, d_money = self._combined(user_id)
+        return d_rating, d_money
+
+    def apply(self, data: dict, user_id: int = None) -> dict:
+        """
+        JSON профиля из базы вместе с еще не записанными дельтами
+        :param user_id: Чей профиль, если в data (урезанной через ?fields=) нет user_id
+        """
+        d_rating, floor, d_money = self._combined(data['user_id'] if user_id is None else user_id)
+        if not d_rating and not floor and not d_money:
+            return data
+        ret = dict(data)
+        if 'rating' in ret:
+            ret['rating'] = max(ret['rating'] + d_rating, floor)
+        if 'money' in ret:
+            ret['money'] += d_money
+        return ret
+
+    def _rotate(self):
+        """
+        Забирает накопленное в сегмент и начинает новый журнал
+        """
+        with self._lock:
+            if not self._pending:
+                return
+            self._segment_no += 1
+            path = f'{self._journal_path}.{self._segment_no}'
+            os.rename(self._journal_path, path)
+            self._segments.append(_Segment(path, self._journal, self._pending))
+            self._pending = {}
+            self._journal = _lock_file(self._journal_path, 'a+')
+
+    def flush(self):
+        """
+        Пишет в базу все накопленное; сегменты, которые не удалось записать, остаются до следующей попытки
+        """
+        from Users.models import Profile
+        with self._flush_lock:
+            self._rotate()
+            with self._lock:
+                segments = list(self._segments)
+            for segment in segments:
+                items = {user_id: x for user_id, x in segment.deltas.items() if x != [0, 0, 0]}
+                try:
+                    if items:
+                        Profile.bulk_update_rating({user_id: (x[0], x[2]) for user_id, x in items.items()},
+                                                   floors={user_id: x[1] for user_id, x in items.items()},
+                                                   batch_id=segment.batch_id)
+                except Exception:
+                    self.failed_flushes += 1
+                    return
+                with self._lock:
+                    self._segments.remove(segment)
+                segment.discard()
+                if items:
+                    self._forget_batch(segment.batch_id)
+                self.flushes += 1
+                self.flushed_profiles += len(items)
+
+    @staticmethod
+    def _forget_batch(batch_id: str):
+        """
+        Сегмент удален и повторно примениться не может -- id пачки в базе больше не нужен
+        """
+        from Users.models import RatingBatch
+        try:
+            for shard in get_shards():
+                RatingBatch.objects.using(shard).filter(batch_id=batch_id).delete()
+        except Exception:
+            # Оставшаяся строка ничему не мешает
+            pass
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(settings.RATING_FLUSH_INTERVAL)
+            self._wakeup.clear()
+            # Поток живет дольше запросов, поэтому за соединениями с базой следим сами
+            close_old_connections()
+            self.flush()
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'pending_profiles': len(self._pending),
+                'pending_segments': len(self._segments),
+                'added': self.added,
+                'flushes': self.flushes,
+                'failed_flushes': self.failed_flushes,
+                'flushed_profiles': self.flushed_profiles,
+                'recovered_profiles': self.recovered,
+            }
+
+
+rating_buffer = RatingBuffer()
+atexit.register(rating_buffer.flush)
+
+
+def start_server():
+    """
+    Для процесса сервера: сразу подбираем журналы упавших воркеров, не дожидаясь первого изменения рейтинга
+    Команды manage.py (migrate, shell) сюда не заходят и ни поток, ни журнал не трогают
+    """
+    if settings.RATING_WRITE_BEHIND:
+        rating_buffer.start()
@@ -2,6 +2,8 @@
 ASGI config for UsersService project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Views that wait on other services are served by async consumers (see UsersService/routing.py), run with:
+    daphne UsersService.asgi:application
 
 For more information on this file, see
 https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
@@ -9,8 +11,10 @@ https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from channels.routing import get_default_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'UsersService.settings')
 
-application = get_asgi_application()
+django.setup()
+application = get_default_application()
@@ -0,0 +1,20 @@
+from django.conf.urls import url
+from channels.http import AsgiHandler
+from channels.routing import ProtocolTypeRouter, URLRouter
+from Users import views
+from Users.consumers import ViewConsumer, SignUpConsumer, ProfileUpdatesConsumer
+
+
+application = ProtocolTypeRouter({
+    'http': URLRouter([
+        # Вьюхи, которые ходят в другие сервисы, обслуживаются асинхронно
+        url(r'^api/profiles/$', ViewConsumer.for_view(views.ProfilesListView)),
+        url(r'^api/profiles/register/$', SignUpConsumer.for_view(views.SignUpView)),
+        url(r'^api/profiles/(?P<user_id>\d+)/$', ViewConsumer.for_view(views.ProfileDetailView, auth_on_get=False)),
+        # Все остальное -- обычный джанговский обработчик
+        url(r'', AsgiHandler),
+    ]),
+    'websocket': URLRouter([
+        url(r'^ws/profiles/$', ProfileUpdatesConsumer),
+    ]),
+})
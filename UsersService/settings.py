@@ -29,6 +29,9 @@ ALLOWED_HOSTS = []
 
 
 MIDDLEWARE = [
+    'Users.middleware.RequestTimingMiddleware',
+    'Users.middleware.CompressionMiddleware',
+    'Users.middleware.ReplicaPinningMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -36,6 +39,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'Users.middleware.AuthContextMiddleware',
 ]
 
 
@@ -49,12 +53,13 @@ DJANGO_APPS = [
 ]
 
 DEV_APPS = [
-    'Users',
+    'Users.apps.UsersConfig',
 ]
 
 THIRD_PARTY_APPS = [
     'rest_framework',
     'rest_framework.authtoken',
+    'channels',
 ]
 
 try:
@@ -86,6 +91,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'UsersService.wsgi.application'
+ASGI_APPLICATION = 'UsersService.routing.application'
 
 
 # Database
@@ -98,6 +104,28 @@ DATABASES = {
     }
 }
 
+# Постоянные соединения: сколько секунд держать соединение и как часто проверять его живость перед запросом
+DB_CONN_MAX_AGE = int(os.getenv('DB_CONN_MAX_AGE', 60))
+DB_HEALTH_CHECK_INTERVAL = float(os.getenv('DB_HEALTH_CHECK_INTERVAL', 10))
+
+# Реплики для чтения: URL'ы через запятую в DATABASE_REPLICA_URLS (алиасы replica_1, replica_2, ...)
+DATABASE_REPLICA_URLS = [x for x in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if x]
+DATABASE_REPLICAS = [f'replica_{i + 1}' for i in range(len(DATABASE_REPLICA_URLS))]
+DATABASE_ROUTERS = ['Users.routers.ShardRouter', 'Users.routers.ReplicaRouter']
+# Сколько секунд после записи клиент читает из мастера
+REPLICA_READ_YOUR_WRITES_WINDOW = 5
+# Реплика, отставшая больше чем на столько секунд, выводится из ротации
+REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', 10))
+REPLICA_LAG_CHECK_INTERVAL = 5
+
+# Шардирование профилей по user_id: URL'ы дополнительных шардов через запятую в DATABASE_SHARD_URLS
+# (алиасы shard_1, shard_2, ...), первым шардом остается default. Пусто -- все профили в default
+DATABASE_SHARD_URLS = [x for x in os.getenv('DATABASE_SHARD_URLS', '').split(',') if x]
+DATABASE_SHARDS = ['default'] + [f'shard_{i + 1}' for i in range(len(DATABASE_SHARD_URLS))] \
+    if DATABASE_SHARD_URLS else []
+# Точек на кольце консистентного хэширования на шард (больше -- ровнее раскладка)
+SHARD_VIRTUAL_NODES = 128
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
@@ -152,11 +180,159 @@ REST_FRAMEWORK = {
         'rest_framework.authentication.BasicAuthentication',
     ),
     'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
-    ]
+        'Users.renderers.FastJSONRenderer',
+        'Users.renderers.MessagePackRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'Users.parsers.FastJSONParser',
+        'Users.parsers.MessagePackParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
 }
 
 
+# Response formats
+# Ответы больше порога сжимаются: brotli (если установлен и клиент его принимает), иначе gzip
+RESPONSE_COMPRESSION_ENABLED = os.getenv('RESPONSE_COMPRESSION_ENABLED', '1') == '1'
+RESPONSE_COMPRESSION_MIN_SIZE = int(os.getenv('RESPONSE_COMPRESSION_MIN_SIZE', 1024))
+RESPONSE_COMPRESSION_GZIP_LEVEL = 6
+RESPONSE_COMPRESSION_BROTLI_QUALITY = 5
+
+
+# Auth
+# Локальная проверка JWT (если ключ не задан -- каждый раз спрашиваем auth-сервис)
+AUTH_JWT_VERIFY_KEY = os.getenv('AUTH_JWT_VERIFY_KEY', None)
+AUTH_JWT_ALGORITHM = os.getenv('AUTH_JWT_ALGORITHM', 'HS256')
+AUTH_JWT_USER_ID_CLAIM = 'user_id'
+AUTH_JWT_SUPERUSER_CLAIM = 'is_superuser'
+# Локально принимаются только access-токены (refresh подписан тем же ключом)
+AUTH_JWT_TOKEN_TYPE_CLAIM = 'token_type'
+AUTH_JWT_ACCESS_TOKEN_TYPE = 'access'
+# Если заданы -- aud и iss токена обязаны с ними совпадать
+AUTH_JWT_AUDIENCE = os.getenv('AUTH_JWT_AUDIENCE', None)
+AUTH_JWT_ISSUER = os.getenv('AUTH_JWT_ISSUER', None)
+# Кэш token -> user info для токенов, которые нельзя проверить локально (0 -- выключен)
+AUTH_TOKEN_CACHE_TTL = int(os.getenv('AUTH_TOKEN_CACHE_TTL', 0))
+AUTH_TOKEN_CACHE_SIZE = 10000
+# Список юзеров auth-сервиса для create_missing_profiles --from-auth (JSON-список или страницы с results и next)
+# и токен, с которым он запрашивается
+AUTH_USERS_URL = os.getenv('AUTH_USERS_URL', None)
+AUTH_USERS_TOKEN = os.getenv('AUTH_USERS_TOKEN', None)
+
+
+# Media
+# Кэш проверки pic_id в media-сервисе: найденные картинки живут дольше, чем ненайденные
+MEDIA_VALIDATION_CACHE_SIZE = 10000
+MEDIA_VALIDATION_POSITIVE_TTL = 600
+MEDIA_VALIDATION_NEGATIVE_TTL = 30
+
+
+# Stats
+# sync -- отправка статистики внутри запроса, queue -- через фоновую очередь, off -- не собирать
+STATS_MODE = os.getenv('STATS_MODE', 'sync')
+STATS_QUEUE_SIZE = 10000
+
+
+# Profile cache
+# Кэш сериализованных профилей для GET /profiles/<user_id>/: 'memory', 'redis' или None (выключен)
+# 'memory' сбрасывается только в своем процессе: при нескольких воркерах нужен 'redis'
+PROFILE_CACHE_BACKEND = os.getenv('PROFILE_CACHE_BACKEND', None)
+PROFILE_CACHE_REDIS_URL = os.getenv('PROFILE_CACHE_REDIS_URL', 'redis://localhost:6379/1')
+PROFILE_CACHE_TTL = 300
+# Для 'memory' -- столько секунд другие воркеры могут отдавать старый профиль
+PROFILE_CACHE_MEMORY_TTL = int(os.getenv('PROFILE_CACHE_MEMORY_TTL', 5))
+PROFILE_CACHE_SIZE = 10000
+
+
+# Async
+# Сколько потоков держат блокирующие запросы в другие сервисы под ASGI
+ASYNC_SERVICE_CALL_WORKERS = 64
+
+
+# Rating write-behind
+# Изменения рейтинга из /profiles/<id>/update_rating/ копятся в памяти и пишутся в базу пачкой раз в интервал
+RATING_WRITE_BEHIND = os.getenv('RATING_WRITE_BEHIND', '0') == '1'
+RATING_FLUSH_INTERVAL = float(os.getenv('RATING_FLUSH_INTERVAL', 1.0))
+# Столько профилей с незаписанными изменениями -- пишем, не дожидаясь интервала
+RATING_FLUSH_MAX_PENDING = 1000
+# Незаписанные изменения видны только процессу, который их принял, поэтому write-behind -- только для одного
+# процесса сервера (WEB_CONCURRENCY=1, один dyno), второй процесс с тем же журналом не стартует
+# Журнал незаписанных изменений (переживает рестарт воркера) и fsync на каждую запись в него. Каталог обязателен
+# и должен лежать на постоянном диске (файловая система dyno на Heroku стирается при рестарте)
+RATING_JOURNAL_DIR = os.getenv('RATING_JOURNAL_DIR', None)
+RATING_JOURNAL_FSYNC = os.getenv('RATING_JOURNAL_FSYNC', '0') == '1'
+
+
+# Profile updates
+# Рассылка изменений профилей подписчикам по WebSocket (ws/profiles/)
+PROFILE_UPDATES_ENABLED = os.getenv('PROFILE_UPDATES_ENABLED', '0') == '1'
+PROFILE_UPDATES_MAX_SUBSCRIPTIONS = 100
+# Оповещения пишут воркеры gunicorn, а подписчики сидят в процессе daphne, так что с включенной рассылкой
+# редис обязателен (InMemoryChannelLayer -- только для тестов и локального запуска без рассылки)
+CHANNEL_LAYERS_REDIS_URL = os.getenv('CHANNEL_LAYERS_REDIS_URL', None)
+if CHANNEL_LAYERS_REDIS_URL:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {'hosts': [CHANNEL_LAYERS_REDIS_URL]},
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
+
+
+# HTTP
+# Общая на процесс сессия с keep-alive для запросов в другие сервисы
+HTTP_POOL_ENABLED = os.getenv('HTTP_POOL_ENABLED', '1') == '1'
+# Сколько хостов держать в пуле и сколько соединений на хост (под число потоков ASYNC_SERVICE_CALL_WORKERS)
+HTTP_POOL_HOSTS = 10
+HTTP_POOL_MAXSIZE = int(os.getenv('HTTP_POOL_MAXSIZE', 64))
+# Ждать свободного соединения, а не открывать лишние сверх HTTP_POOL_MAXSIZE, но не дольше HTTP_POOL_TIMEOUT секунд
+HTTP_POOL_BLOCK = True
+HTTP_POOL_TIMEOUT = float(os.getenv('HTTP_POOL_TIMEOUT', 5))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 3.05))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 10))
+HTTP_MAX_RETRIES = 0
+
+
+# Idempotency
+# Сколько хранится ответ на запрос с Idempotency-Key (незавершенный запрос держит ключ столько же)
+IDEMPOTENCY_KEY_TTL = int(os.getenv('IDEMPOTENCY_KEY_TTL', 24 * 60 * 60))
+
+
+# Metrics
+# Замер фаз запросов (заголовок Server-Timing и гистограммы на /metrics)
+REQUEST_TIMING_ENABLED = os.getenv('REQUEST_TIMING_ENABLED', '1') == '1'
+SERVER_TIMING_HEADER = os.getenv('SERVER_TIMING_HEADER', '1') == '1'
+# Границы бакетов гистограмм в секундах
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+# Доступ к /metrics: заголовок Authorization: Bearer <METRICS_TOKEN> или REMOTE_ADDR из METRICS_ALLOWED_IPS
+# (через запятую). Без обоих /metrics закрыт
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', None)
+METRICS_ALLOWED_IPS = [x.strip() for x in os.getenv('METRICS_ALLOWED_IPS', '').split(',') if x.strip()]
+
+
+# Pagination
+PROFILES_CURSOR_PAGE_SIZE = 100
+PROFILES_CURSOR_MAX_PAGE_SIZE = 1000
+# Максимальное количество профилей в одном запросе /profiles/batch/
+PROFILES_BATCH_MAX_SIZE = int(os.getenv('PROFILES_BATCH_MAX_SIZE', 100))
+# Максимальное количество записей в одном запросе /profiles/update_rating/
+RATING_BATCH_MAX_SIZE = int(os.getenv('RATING_BATCH_MAX_SIZE', 1000))
+
+
+# Leaderboard
+# Зеркало рейтинга в сортированном множестве редиса ('memory://' -- заглушка в памяти процесса)
+LEADERBOARD_REDIS_URL = os.getenv('LEADERBOARD_REDIS_URL', None)
+LEADERBOARD_DEFAULT_LIMIT = 10
+LEADERBOARD_MAX_LIMIT = 100
+
+
 try:
     from .settings_local import *
 except ImportError:
@@ -169,7 +345,8 @@ except ImportError as e:
 
 if DEBUG:
     REST_FRAMEWORK['DEFAULT_RENDERER_CLASSES'] = [
-        'rest_framework.renderers.JSONRenderer',
+        'Users.renderers.FastJSONRenderer',
+        'Users.renderers.MessagePackRenderer',
         'rest_framework.renderers.BrowsableAPIRenderer',
     ]
 
@@ -183,3 +360,19 @@ ON_HEROKU = not (os.getenv('ON_HEROKU', '0') == '0')
 if not DEBUG:
     import django_heroku
     django_heroku.settings(locals(), databases=ON_HEROKU, test_runner=False, secret_key=False)
+
+if DATABASE_REPLICA_URLS:
+    import dj_database_url
+    for _alias, _url in zip(DATABASE_REPLICAS, DATABASE_REPLICA_URLS):
+        DATABASES[_alias] = dj_database_url.parse(_url)
+        # В тестах реплика смотрит в тестовую базу мастера
+        DATABASES[_alias]['TEST'] = {'MIRROR': 'default'}
+
+if DATABASE_SHARD_URLS:
+    import dj_database_url
+    for _alias, _url in zip(DATABASE_SHARDS[1:], DATABASE_SHARD_URLS):
+        DATABASES[_alias] = dj_database_url.parse(_url)
+
+# django_heroku выставляет свой conn_max_age, поэтому применяем наш после него
+for _database in DATABASES.values():
+    _database['CONN_MAX_AGE'] = DB_CONN_MAX_AGE
@@ -18,10 +18,12 @@ from django.urls import path
 from django.conf.urls import url, include
 from django.conf.urls.static import static
 from django.conf import settings
+from Users.views import MetricsView
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     url(r'^api/', include('Users.urls')),
+    url(r'^metrics/$', MetricsView.as_view()),
 ]
 
 
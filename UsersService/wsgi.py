@@ -10,7 +10,10 @@ https://docs.djangoproject.com/en/3.0/howto/deployment/wsgi/
 import os
 
 from django.core.wsgi import get_wsgi_application
+from Users.write_behind import start_server
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'UsersService.settings')
 
 application = get_wsgi_application()
+# Поток отложенной записи рейтинга -- только в процессе сервера
+start_server()